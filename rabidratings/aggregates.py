@@ -0,0 +1,152 @@
+import time
+
+from django.utils import timezone
+
+from rabidratings import conf
+
+
+# vote values counted in histogram of Rating (votes_20 ... votes_100 fields)
+HISTOGRAM_VALUES = sorted(conf.RATING_VERBAL_VALUES)
+HISTOGRAM_FIELDS = ['votes_%s' % value for value in HISTOGRAM_VALUES]
+# counters of Rating and RatingShard changed by votes
+COUNTER_FIELDS = ['total_rating', 'total_votes'] + HISTOGRAM_FIELDS
+
+
+def get_histogram_field(value):
+    '''
+    Return name of histogram field counting votes of value
+    (value is put to the nearest bucket) or None for value out of 1..100
+    '''
+    if not 0 < value <= 100:
+        return None
+    bucket = min(HISTOGRAM_VALUES, key=lambda v: (abs(v - value), v))
+    return 'votes_%s' % bucket
+
+
+def get_day(value=None):
+    '''
+    Return day (in UTC if time zone support is enabled) of datetime value
+    (now by default) used as key of daily rollup of votes
+    '''
+    if value is None:
+        value = timezone.now()
+    if timezone.is_aware(value):
+        value = timezone.make_naive(value, timezone.utc)
+    return value.date()
+
+
+def get_score(total_rating, total_votes):
+    '''
+    Return ranking score - Bayesian average of stars with prior set in
+    RABIDRATINGS_SCORE_PRIOR_MEAN and RABIDRATINGS_SCORE_PRIOR_VOTES,
+    so few extreme votes do not outrank many slightly worse ones
+    (zero for rating without votes)
+    '''
+    if total_votes <= 0:
+        return 0.0
+    prior_votes = float(conf.RABIDRATINGS_SCORE_PRIOR_VOTES)
+    return (prior_votes * conf.RABIDRATINGS_SCORE_PRIOR_MEAN + total_rating / 20.0) / (prior_votes + total_votes)
+
+
+def get_score_sql(total_rating, total_votes):
+    '''
+    Return SQL of get_score for given SQL expressions of total rating and votes
+    '''
+    prior_votes = float(conf.RABIDRATINGS_SCORE_PRIOR_VOTES)
+    return 'CASE WHEN %(votes)s > 0 THEN (%(prior_sum)r + (%(rating)s) / 20.0) / (%(prior_votes)r + %(votes)s) ELSE 0 END' % {
+        'votes': total_votes,
+        'rating': total_rating,
+        'prior_sum': prior_votes * conf.RABIDRATINGS_SCORE_PRIOR_MEAN,
+        'prior_votes': prior_votes,
+    }
+
+
+def get_trend_epoch(timestamp=None):
+    '''
+    Return start (unix time) of trending epoch containing timestamp (now by default)
+    '''
+    if timestamp is None:
+        timestamp = time.time()
+    return int(timestamp // conf.RABIDRATINGS_TRENDING_EPOCH * conf.RABIDRATINGS_TRENDING_EPOCH)
+
+
+def get_trend_weight(timestamp=None, epoch=None):
+    '''
+    Return weight of vote made at timestamp (now by default) relative
+    to start of trending epoch - votes lose half of their weight
+    in RABIDRATINGS_TRENDING_HALF_LIFE, so weights of newer votes grow
+    instead of decaying all stored values over time
+    '''
+    if timestamp is None:
+        timestamp = time.time()
+    if epoch is None:
+        epoch = get_trend_epoch(timestamp)
+    return 2.0 ** ((timestamp - epoch) / float(conf.RABIDRATINGS_TRENDING_HALF_LIFE))
+
+
+class RatingDelta(object):
+    """
+    Change of Rating counters caused by one or more votes.
+
+    The delta can be applied to the Rating instance in memory
+    (``Rating.apply_delta``) or directly in database
+    (``Rating.objects.apply_delta``) without reading the row first.
+    """
+
+    def __init__(self, total_rating=0, total_votes=0, histogram=None):
+        self.total_rating = total_rating
+        self.total_votes = total_votes
+        # changes of histogram counters by field name
+        self.histogram = dict(histogram or {})
+        # changes of daily rollup [total rating, total votes] by day
+        self.days = {}
+
+    def __nonzero__(self):
+        return bool(self.total_rating or self.total_votes or any(self.histogram.values()))
+
+    def add_vote(self, value, old_value=0, day=None):
+        """
+        Adds vote with given value. If voter changes his previous vote,
+        the old value is taken away first. If day (when the vote was first
+        cast) is given, the vote is added to daily rollup too.
+        """
+        if old_value > 0:
+            self.total_rating -= old_value
+            self.total_votes -= 1
+            field = get_histogram_field(old_value)
+            if field is not None:
+                self.histogram[field] = self.histogram.get(field, 0) - 1
+        self.total_rating += value
+        self.total_votes += 1
+        field = get_histogram_field(value)
+        if field is not None:
+            self.histogram[field] = self.histogram.get(field, 0) + 1
+        if day is not None:
+            day_delta = self.days.setdefault(day, [0, 0])
+            day_delta[0] += value - old_value
+            day_delta[1] += 0 if old_value > 0 else 1
+
+    def add_counters(self, counters):
+        """
+        Adds counters (dict keyed by names in COUNTER_FIELDS, e.g. of shard).
+        """
+        self.total_rating += counters.get('total_rating') or 0
+        self.total_votes += counters.get('total_votes') or 0
+        for field in HISTOGRAM_FIELDS:
+            self.histogram[field] = self.histogram.get(field, 0) + (counters.get(field) or 0)
+
+    def counters(self):
+        """
+        Returns changes of counters keyed by names in COUNTER_FIELDS.
+        """
+        counters = dict.fromkeys(HISTOGRAM_FIELDS, 0)
+        counters.update(self.histogram)
+        counters.update(total_rating=self.total_rating, total_votes=self.total_votes)
+        return counters
+
+    @classmethod
+    def for_event(cls, event):
+        delta = cls()
+        old_value = event.old_value if getattr(event, 'is_changing', False) else 0
+        delta.add_vote(event.value, old_value, get_day(event.created))
+        return delta
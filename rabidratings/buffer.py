@@ -0,0 +1,90 @@
+from rabidratings import conf
+from rabidratings.utils import get_cache, import_module_member
+
+
+def get_vote_buffer():
+    '''
+    Return instance of vote buffer set in RABIDRATINGS_VOTE_BUFFER
+    or None if votes are not buffered
+    '''
+    if not conf.RABIDRATINGS_VOTE_BUFFER:
+        return None
+    buffer = get_vote_buffer.cache.get(conf.RABIDRATINGS_VOTE_BUFFER, None)
+    if not buffer:
+        buffer = import_module_member(conf.RABIDRATINGS_VOTE_BUFFER)()
+        get_vote_buffer.cache[conf.RABIDRATINGS_VOTE_BUFFER] = buffer
+    return buffer
+get_vote_buffer.cache = {}
+
+
+class CacheVoteBuffer(object):
+    """
+    Queue of votes kept in Django cache backend.
+
+    Every vote is stored under its own key numbered by atomic ``incr``
+    of head counter, so pushing is cheap and does not need any lock.
+    The queue is expected to be drained by single worker
+    (see flush_rating_votes command).
+    """
+    key_prefix = 'rabidratings:votes'
+
+    def __init__(self, cache_alias=None, timeout=None):
+        self.cache = get_cache(cache_alias or conf.RABIDRATINGS_VOTE_BUFFER_CACHE)
+        self.timeout = timeout or conf.RABIDRATINGS_VOTE_BUFFER_TIMEOUT
+        self._missing = None
+
+    def _key(self, name):
+        return '%s:%s' % (self.key_prefix, name)
+
+    def _counter(self, name):
+        return self.cache.get(self._key(name)) or 0
+
+    def push(self, vote):
+        """
+        Appends vote (dict with RatingEvent field values) to the queue.
+        """
+        self.cache.add(self._key('head'), 0, None)
+        index = self.cache.incr(self._key('head'))
+        self.cache.set(self._key(index), vote, self.timeout)
+
+    def push_front(self, votes):
+        """
+        Returns votes (e.g. of failed batch) to the front of the queue
+        keeping their order, so they are popped before newer votes.
+        """
+        tail = self._counter('tail')
+        for i, vote in enumerate(votes):
+            self.cache.set(self._key(tail - len(votes) + 1 + i), vote, self.timeout)
+        self.cache.set(self._key('tail'), tail - len(votes), None)
+
+    def __len__(self):
+        return max(self._counter('head') - self._counter('tail'), 0)
+
+    def pop_many(self, count):
+        """
+        Removes and returns up to count oldest votes from the queue.
+        """
+        tail, head = self._counter('tail'), self._counter('head')
+        if head < tail:
+            # head counter was evicted and numbering started again
+            tail = 0
+        indexes = range(tail + 1, min(head, tail + count) + 1)
+        if not indexes:
+            return []
+        items = self.cache.get_many([self._key(i) for i in indexes])
+
+        votes = []
+        for i in indexes:
+            item = items.get(self._key(i))
+            if item is None and i != self._missing:
+                # vote can be numbered but not stored yet - wait for it,
+                # skip it if it is still missing next time (expired or lost)
+                self._missing = i
+                break
+            if item is not None:
+                votes.append(item)
+            tail = i
+
+        self.cache.delete_many([self._key(i) for i in indexes if i <= tail])
+        self.cache.set(self._key('tail'), tail, None)
+        return votes
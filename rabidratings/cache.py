@@ -0,0 +1,188 @@
+import time
+
+from rabidratings import conf
+from rabidratings.utils import get_cache
+
+
+class RatingCache(object):
+    """
+    Read-through cache of Rating aggregates keyed by rating key.
+
+    Every rating is stored with time of its expiration. Expired rating is
+    still kept in cache for RABIDRATINGS_CACHE_STALE_TIMEOUT and served to all
+    clients but the first one, who gets a miss and refreshes it, so hot
+    rating is not loaded from db by many clients at once.
+    """
+    key_prefix = 'rabidratings:rating'
+
+    def __init__(self, cache_alias=None, timeout=None, stale_timeout=None):
+        self.cache_alias = cache_alias or conf.RABIDRATINGS_CACHE
+        self.timeout = timeout or conf.RABIDRATINGS_CACHE_TIMEOUT
+        self.stale_timeout = stale_timeout or conf.RABIDRATINGS_CACHE_STALE_TIMEOUT
+        self.stats = dict(hits=0, misses=0)
+
+    @property
+    def cache(self):
+        return get_cache(self.cache_alias)
+
+    def _key(self, rating_key):
+        return '%s:%s' % (self.key_prefix, rating_key)
+
+    def get(self, rating_key):
+        return self.get_many([rating_key]).get(rating_key)
+
+    def get_many(self, rating_keys):
+        """
+        Returns dict of cached ratings, missing and expired ones are omitted.
+        """
+        cached = self.cache.get_many([self._key(k) for k in rating_keys])
+        ratings = {}
+        for rating_key in rating_keys:
+            item = cached.get(self._key(rating_key))
+            if item is not None:
+                rating, expires = item
+                if expires > time.time() or not self.cache.add(self._key(rating_key) + ':lock', 1, self.stale_timeout):
+                    ratings[rating_key] = rating
+        self.stats['hits'] += len(ratings)
+        self.stats['misses'] += len(rating_keys) - len(ratings)
+        return ratings
+
+    def set(self, rating):
+        self.set_many([rating])
+
+    def set_many(self, ratings):
+        expires = time.time() + self.timeout
+        self.cache.set_many(
+            dict((self._key(r.key), (r, expires)) for r in ratings),
+            self.timeout + self.stale_timeout
+        )
+        self.cache.delete_many([self._key(r.key) + ':lock' for r in ratings])
+
+    def delete(self, rating_key):
+        self.cache.delete(self._key(rating_key))
+
+    def reset_stats(self):
+        self.stats = dict(hits=0, misses=0)
+
+
+def get_rating_cache():
+    '''
+    Return RatingCache if RABIDRATINGS_CACHE is set, None otherwise
+    '''
+    if not conf.RABIDRATINGS_CACHE:
+        return None
+    rating_cache = get_rating_cache.cache.get(conf.RABIDRATINGS_CACHE, None)
+    if not rating_cache:
+        rating_cache = RatingCache()
+        get_rating_cache.cache[conf.RABIDRATINGS_CACHE] = rating_cache
+    return rating_cache
+get_rating_cache.cache = {}
+
+
+def get_voter_key(user=None, user_id=None, voter_fp=None):
+    '''
+    Return key of voter given by user (or its id) or anonymous voter fingerprint
+    (the same keyword arguments as voter lookup of RatingEvent)
+    '''
+    if user is not None:
+        user_id = user.pk
+    if user_id:
+        return 'user:%s' % user_id
+    return 'fp:%s' % voter_fp
+
+
+class VoterCache(object):
+    """
+    Cache of votes of voters keyed by voter key and rating key. The answer
+    that the voter has not voted is cached too, so the common case is
+    answered without db query.
+
+    Entries are stored under the current version of the voter, which is bumped
+    when votes of the voter are written, so all of them are invalidated at once.
+    """
+    key_prefix = 'rabidratings:voter'
+    not_voted = 0
+
+    def __init__(self, cache_alias=None, timeout=None):
+        self.cache_alias = cache_alias or conf.RABIDRATINGS_VOTER_CACHE
+        self.timeout = timeout or conf.RABIDRATINGS_VOTER_CACHE_TIMEOUT
+        self.stats = dict(hits=0, misses=0)
+
+    @property
+    def cache(self):
+        return get_cache(self.cache_alias)
+
+    def _version_key(self, voter_key):
+        return '%s:%s' % (self.key_prefix, voter_key)
+
+    def get_version(self, voter_key):
+        """
+        Returns current version of voter's entries, to be read before loading
+        votes from db and passed to get_many and set_many.
+        """
+        version = self.cache.get(self._version_key(voter_key))
+        if version is None:
+            # start from time, so entries of evicted version are not reused
+            version = int(time.time() * 1000)
+            if not self.cache.add(self._version_key(voter_key), version, self.timeout):
+                version = self.cache.get(self._version_key(voter_key), version)
+        return version
+
+    def _keys(self, voter_key, rating_keys, version):
+        return dict((k, '%s:%s:%s:%s' % (self.key_prefix, voter_key, version, k)) for k in rating_keys)
+
+    def get_many(self, voter_key, rating_keys, version=None):
+        """
+        Returns dict of cached votes (RatingEvent or None if the voter
+        has not voted) of voter, missing ones are omitted.
+        """
+        if version is None:
+            version = self.get_version(voter_key)
+        keys = self._keys(voter_key, rating_keys, version)
+        cached = self.cache.get_many(keys.values())
+        events = {}
+        for rating_key, key in keys.items():
+            if key in cached:
+                event = cached[key]
+                events[rating_key] = None if event == self.not_voted else event
+        self.stats['hits'] += len(events)
+        self.stats['misses'] += len(rating_keys) - len(events)
+        return events
+
+    def set_many(self, voter_key, events, version=None):
+        """
+        Stores votes of voter given as dict of RatingEvent
+        (or None if the voter has not voted) keyed by rating key.
+        If version read before loading the votes is given and the voter
+        has voted since, the votes may be stale and nothing is stored.
+        """
+        current = self.get_version(voter_key)
+        if version is not None and version != current:
+            return
+        keys = self._keys(voter_key, events.keys(), current)
+        self.cache.set_many(dict((keys[k], self.not_voted if e is None else e) for k, e in events.items()),
+                            self.timeout)
+
+    def invalidate(self, voter_key):
+        try:
+            self.cache.incr(self._version_key(voter_key))
+        except ValueError:
+            # no entries are stored under missing version
+            pass
+
+    def reset_stats(self):
+        self.stats = dict(hits=0, misses=0)
+
+
+def get_voter_cache():
+    '''
+    Return VoterCache if RABIDRATINGS_VOTER_CACHE is set, None otherwise
+    '''
+    if not conf.RABIDRATINGS_VOTER_CACHE:
+        return None
+    voter_cache = get_voter_cache.cache.get(conf.RABIDRATINGS_VOTER_CACHE, None)
+    if not voter_cache:
+        voter_cache = VoterCache()
+        get_voter_cache.cache[conf.RABIDRATINGS_VOTER_CACHE] = voter_cache
+    return voter_cache
+get_voter_cache.cache = {}
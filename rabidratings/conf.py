@@ -22,6 +22,15 @@ RABIDRATINGS_TIME_DELETE_OLD_RATINGS = getattr(settings, 'RABIDRATINGS_TIME_DELE
 # Anonymous users are disabled by default
 RABIDRATINGS_DISABLE_ANONYMOUS_USERS = getattr(settings, 'RABIDRATINGS_DISABLE_ANONYMOUS_USERS', True)
 
+# name of cookie identifying anonymous voter together with ip address
+# (set by record_vote view if missing); only ip is used if None
+RABIDRATINGS_VOTER_COOKIE = getattr(settings, 'RABIDRATINGS_VOTER_COOKIE', None)
+
+# how long (in seconds) votes of anonymous voters are remembered; older ones
+# are anonymized by expire_anonymous_votes command (they still count
+# in ratings, but the voter can vote again)
+RABIDRATINGS_ANONYMOUS_VOTE_TTL = getattr(settings, 'RABIDRATINGS_ANONYMOUS_VOTE_TTL', 60 * 60 * 24 * 30)
+
 # verval values for RatingEvent model numerical value
 RATING_VERBAL_VALUES = {
     20: _('very bad'),
@@ -30,3 +39,76 @@ RATING_VERBAL_VALUES = {
     80: _('fair'),
     100: _('excellent'),
 }
+
+# format of record_vote view response: 'html' (rendered text and average
+# rating) or 'data' (only values, html is built by rabidratings.js)
+RABIDRATINGS_VOTE_RESPONSE_FORMAT = getattr(settings, 'RABIDRATINGS_VOTE_RESPONSE_FORMAT', 'html')
+
+# name of cache used for rate limiting of votes by record_vote and record_votes
+# views (see rabidratings.throttle.VoteThrottle); no limits are applied if None
+RABIDRATINGS_THROTTLE_CACHE = getattr(settings, 'RABIDRATINGS_THROTTLE_CACHE', None)
+
+# rate of votes of one voter and of votes for one object as tuple
+# (burst of votes, period in seconds in which the burst is refilled);
+# the limit is not applied if None
+RABIDRATINGS_VOTER_RATE = getattr(settings, 'RABIDRATINGS_VOTER_RATE', (10, 60))
+RABIDRATINGS_TARGET_RATE = getattr(settings, 'RABIDRATINGS_TARGET_RATE', (100, 10))
+
+# how long (in seconds) repeated identical vote is answered by the result
+# of the first one without touching the database
+RABIDRATINGS_DUPLICATE_VOTE_TTL = getattr(settings, 'RABIDRATINGS_DUPLICATE_VOTE_TTL', 10)
+
+# path to vote buffer class (e.g. 'rabidratings.buffer.CacheVoteBuffer');
+# if set, record_vote only appends votes to the buffer
+# and they are written to db in batches by flush_rating_votes command
+RABIDRATINGS_VOTE_BUFFER = getattr(settings, 'RABIDRATINGS_VOTE_BUFFER', None)
+
+# name of cache used by rabidratings.buffer.CacheVoteBuffer
+RABIDRATINGS_VOTE_BUFFER_CACHE = getattr(settings, 'RABIDRATINGS_VOTE_BUFFER_CACHE', 'default')
+
+# how long (in seconds) buffered votes wait for flush before they expire
+RABIDRATINGS_VOTE_BUFFER_TIMEOUT = getattr(settings, 'RABIDRATINGS_VOTE_BUFFER_TIMEOUT', 60 * 60 * 24)
+
+# number of counter shards for hot content types in natural key form,
+# e.g. {'polls.poll': 16}; votes for these are spread over shard rows
+# and folded into ratings by compact_rating_shards command
+RABIDRATINGS_RATING_SHARDS = getattr(settings, 'RABIDRATINGS_RATING_SHARDS', {})
+
+# set if you do not want to create zero ratings on read (e.g. by show_rating);
+# not saved rating with zero counters is used instead until the first vote
+RABIDRATINGS_LAZY_RATINGS = getattr(settings, 'RABIDRATINGS_LAZY_RATINGS', False)
+
+# name of cache used for rating aggregates (caching is disabled if None)
+RABIDRATINGS_CACHE = getattr(settings, 'RABIDRATINGS_CACHE', None)
+
+# how long (in seconds) cached rating is considered fresh
+RABIDRATINGS_CACHE_TIMEOUT = getattr(settings, 'RABIDRATINGS_CACHE_TIMEOUT', 60 * 10)
+
+# how long (in seconds) expired rating is still served
+# while it is being refreshed by single client (prevents cache stampede)
+RABIDRATINGS_CACHE_STALE_TIMEOUT = getattr(settings, 'RABIDRATINGS_CACHE_STALE_TIMEOUT', 60)
+
+# name of cache used for votes of voters by object, including the fact
+# that the voter has not voted (caching is disabled if None)
+RABIDRATINGS_VOTER_CACHE = getattr(settings, 'RABIDRATINGS_VOTER_CACHE', None)
+
+# how long (in seconds) cached votes of voter are kept
+RABIDRATINGS_VOTER_CACHE_TIMEOUT = getattr(settings, 'RABIDRATINGS_VOTER_CACHE_TIMEOUT', 60 * 60)
+
+# prior of ranking score (Bayesian average of stars) - mean value in stars
+# and number of virtual votes with that value added to every rating
+RABIDRATINGS_SCORE_PRIOR_MEAN = getattr(settings, 'RABIDRATINGS_SCORE_PRIOR_MEAN', 3.0)
+RABIDRATINGS_SCORE_PRIOR_VOTES = getattr(settings, 'RABIDRATINGS_SCORE_PRIOR_VOTES', 10)
+
+# size of materialized leaderboards (top rated objects by score)
+# for content types in natural key form, e.g. {'blog.article': 100};
+# they are updated on votes and rebuilt by rebuild_rating_leaderboards command
+RABIDRATINGS_LEADERBOARDS = getattr(settings, 'RABIDRATINGS_LEADERBOARDS', {})
+
+# half-life (in seconds) of votes in trending ranking (see QuerySet.by_trending)
+RABIDRATINGS_TRENDING_HALF_LIFE = getattr(settings, 'RABIDRATINGS_TRENDING_HALF_LIFE', 60 * 60 * 24)
+
+# period (in seconds) of trending epochs; decayed values are stored relative
+# to the start of epoch and rebased by renormalize_rating_trends command,
+# which should be run at the start of every epoch
+RABIDRATINGS_TRENDING_EPOCH = getattr(settings, 'RABIDRATINGS_TRENDING_EPOCH', 60 * 60 * 24 * 7)
@@ -0,0 +1,25 @@
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+
+from rabidratings.models import RatingDay
+
+
+class Command(NoArgsCommand):
+    help = "Rebuild daily rollups of votes of all ratings from rating events"
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('--batch-size', dest='batch_size', type='int', default=1000,
+                    help='Number of ratings processed in one transaction'),
+    )
+
+    def handle(self, **options):
+        verbosity = int(options.get('verbosity', 1))
+
+        def progress(processed):
+            if verbosity > 1:
+                self.stdout.write('%d ratings processed\n' % processed)
+
+        processed = RatingDay.objects.backfill(batch_size=options['batch_size'], progress=progress)
+        if verbosity:
+            self.stdout.write('Daily rollups of %d ratings rebuilt\n' % processed)
@@ -1,7 +1,12 @@
+import time
 from datetime import timedelta
+from optparse import make_option
 
+from rabidratings.cache import get_rating_cache
 from rabidratings.conf import RABIDRATINGS_TIME_DELETE_OLD_RATINGS
-from rabidratings.models import Rating, RatingEvent
+from rabidratings.managers import delete_targets, get_targets_q
+from rabidratings.models import Rating, RatingDay, RatingEvent, RatingLeader, RatingShard
+from rabidratings.utils.transaction import atomic
 
 from django.core.management.base import NoArgsCommand
 try:
@@ -14,10 +19,58 @@ except ImportError:
 class Command(NoArgsCommand):
     help = "Delete ratings whose last update is older than time spec in settings"
 
+    option_list = NoArgsCommand.option_list + (
+        make_option('--batch-size', dest='batch_size', type='int', default=1000,
+                    help='Number of ratings deleted (with their votes) in one transaction'),
+        make_option('--sleep', dest='sleep', type='float', default=0,
+                    help='Seconds to sleep between batches (to throttle load of db)'),
+        make_option('--dry-run', action='store_true', dest='dry_run', default=False,
+                    help='Only count ratings and votes which would be deleted'),
+        make_option('--max-runtime', dest='max_runtime', type='int', default=0,
+                    help='Stop after given number of seconds (the rest is deleted by next run)'),
+    )
+
     def handle(self, **options):
+        verbosity = int(options.get('verbosity', 1))
+        started = time.time()
         delete_date = now() - timedelta(seconds=RABIDRATINGS_TIME_DELETE_OLD_RATINGS)
-        qs = Rating.objects.filter(updated__lte=delete_date)
-        for rating in qs:
-            RatingEvent.objects.filter(target_ct=rating.target_ct, target_id=rating.target_id).delete()
+        deleted_ratings, deleted_events, last_pk = 0, 0, 0
+        rating_cache = get_rating_cache()
+
+        while True:
+            if options['max_runtime'] and time.time() - started > options['max_runtime']:
+                if verbosity:
+                    self.stdout.write('Max runtime exceeded, stopping\n')
+                break
+
+            with atomic():
+                qs = Rating.objects.filter(updated__lte=delete_date, pk__gt=last_pk).order_by('pk')
+                if not options['dry_run']:
+                    # voted meanwhile ratings are not deleted
+                    qs = qs.select_for_update()
+                batch = list(qs.values_list('pk', 'target_ct_id', 'target_id')[:options['batch_size']])
+                if not batch:
+                    break
+                last_pk = batch[-1][0]
+                targets = [(ct_id, obj_id) for pk, ct_id, obj_id in batch]
+
+                if options['dry_run']:
+                    events = RatingEvent.objects.filter(get_targets_q(targets)).count()
+                else:
+                    events = delete_targets(RatingEvent, targets)
+                    delete_targets(RatingShard, targets)
+                    delete_targets(RatingLeader, targets)
+                    delete_targets(RatingDay, targets)
+                    delete_targets(Rating, targets)
+
+            if rating_cache is not None and not options['dry_run']:
+                for ct_id, obj_id in targets:
+                    rating_cache.delete('%s_%s' % (ct_id, obj_id))
 
-        qs.delete()
+            deleted_ratings += len(batch)
+            deleted_events += events
+            if verbosity:
+                self.stdout.write('%d ratings and %d votes %s\n' % (
+                    deleted_ratings, deleted_events, 'would be deleted' if options['dry_run'] else 'deleted'))
+            if options['sleep']:
+                time.sleep(options['sleep'])
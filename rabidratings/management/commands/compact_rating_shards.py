@@ -0,0 +1,19 @@
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+
+from rabidratings.models import Rating
+
+
+class Command(NoArgsCommand):
+    help = "Fold counters from rating shards into ratings (run periodically if RABIDRATINGS_RATING_SHARDS is set)"
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('--batch-size', dest='batch_size', type='int', default=1000,
+                    help='Number of shards compacted in one transaction'),
+    )
+
+    def handle(self, **options):
+        compacted = Rating.objects.compact_shards(batch_size=options['batch_size'])
+        if int(options.get('verbosity', 1)) > 1:
+            self.stdout.write('%d shards compacted\n' % compacted)
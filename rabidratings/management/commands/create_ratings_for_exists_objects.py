@@ -1,19 +1,74 @@
+import sys
+from multiprocessing import Pool
+from optparse import make_option
+
 from django.core.management.base import NoArgsCommand
-from django.db.models import get_model
-from django.contrib.contenttypes.models import ContentType
+from django.db import connections
+try:
+    from django.apps import apps
+    get_model = apps.get_model
+except ImportError:
+    from django.db.models import get_model
 
 from rabidratings.conf import RABIDRATINGS_CTS_FOR_CREATE_RATING
 from rabidratings.models import Rating
 
 
+def create_ratings(natural_key, batch_size=1000, verbosity=1, stdout=None):
+    '''
+    Create missing ratings for objects of model spec by natural key,
+    return tuple (natural key, number of created ratings)
+    '''
+    model = get_model(*natural_key.split("."))
+
+    def progress(created):
+        if verbosity > 1 and stdout is not None:
+            stdout.write('%s: %d ratings created\n' % (natural_key, created))
+            stdout.flush()
+
+    return natural_key, Rating.objects.create_missing(model, batch_size=batch_size, progress=progress)
+
+
+def _create_ratings_in_worker(args):
+    # every worker process needs its own db connections
+    for connection in connections.all():
+        connection.close()
+    return create_ratings(*args, stdout=sys.stdout)
+
+
 class Command(NoArgsCommand):
     help = """Create ratings for objects that are in db
               and whose models (as natural keys) are in setings"""
 
+    option_list = NoArgsCommand.option_list + (
+        make_option('--batch-size', dest='batch_size', type='int', default=1000,
+                    help='Number of objects (range of ids) processed at once'),
+        make_option('--processes', dest='processes', type='int', default=1,
+                    help='Number of processes creating ratings of different models concurrently'),
+    )
+
     def handle(self, **options):
+        verbosity = int(options.get('verbosity', 1))
+        if options['processes'] > 1 and len(RABIDRATINGS_CTS_FOR_CREATE_RATING) > 1:
+            # do not share connection of this process with forked workers
+            for connection in connections.all():
+                connection.close()
+            pool = Pool(min(options['processes'], len(RABIDRATINGS_CTS_FOR_CREATE_RATING)))
+            try:
+                results = pool.imap_unordered(_create_ratings_in_worker, [
+                    (natural_key, options['batch_size'], verbosity) for natural_key in RABIDRATINGS_CTS_FOR_CREATE_RATING
+                ])
+                for natural_key, created in results:
+                    self._report(natural_key, created, verbosity)
+            finally:
+                pool.close()
+                pool.join()
+            return
+
         for natural_key in RABIDRATINGS_CTS_FOR_CREATE_RATING:
-            model = get_model(*natural_key.split("."))
-            ct = ContentType.objects.get_by_natural_key(*natural_key.split("."))
-            ids = tuple(rating.target_id for rating in Rating.objects.filter(target_ct=ct))
-            for obj in model.objects.exclude(id__in=ids):
-                Rating.objects.create(target_ct=ct, target_id=obj.id)
+            natural_key, created = create_ratings(natural_key, options['batch_size'], verbosity, self.stdout)
+            self._report(natural_key, created, verbosity)
+
+    def _report(self, natural_key, created, verbosity):
+        if verbosity:
+            self.stdout.write('%s: %d ratings created in total\n' % (natural_key, created))
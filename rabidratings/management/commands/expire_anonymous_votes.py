@@ -0,0 +1,25 @@
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+
+from rabidratings.models import RatingEvent
+
+
+class Command(NoArgsCommand):
+    help = "Anonymize votes of anonymous voters older than RABIDRATINGS_ANONYMOUS_VOTE_TTL"
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('--ttl', dest='ttl', type='int', default=None,
+                    help='Override RABIDRATINGS_ANONYMOUS_VOTE_TTL (in seconds)'),
+        make_option('--batch-size', dest='batch_size', type='int', default=1000,
+                    help='Number of votes (range of ids) processed at once'),
+        make_option('--dry-run', action='store_true', dest='dry_run', default=False,
+                    help='Only count votes which would be expired'),
+    )
+
+    def handle(self, **options):
+        verbosity = int(options.get('verbosity', 1))
+        expired = RatingEvent.objects.expire_anonymous(options['ttl'], options['batch_size'], options['dry_run'])
+        if verbosity:
+            self.stdout.write('%d anonymous votes %s\n' % (
+                expired, 'would be expired' if options['dry_run'] else 'expired'))
@@ -0,0 +1,67 @@
+import sys
+import time
+from optparse import make_option
+
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management.base import NoArgsCommand
+from django.utils import six
+
+from rabidratings.buffer import get_vote_buffer
+from rabidratings.models import RatingEvent
+
+
+class Command(NoArgsCommand):
+    help = "Write votes buffered by record_vote to db in batches"
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('--batch-size', dest='batch_size', type='int', default=1000,
+                    help='Number of votes written in one transaction'),
+        make_option('--loop', dest='loop', action='store_true', default=False,
+                    help='Keep running and flush the buffer periodically'),
+        make_option('--interval', dest='interval', type='float', default=1.0,
+                    help='Seconds to wait for new votes when the buffer is empty (with --loop)'),
+        make_option('--max-retries', dest='max_retries', type='int', default=5,
+                    help='Number of failed writes after which a vote is dropped'),
+    )
+
+    def handle(self, **options):
+        vote_buffer = get_vote_buffer()
+        if vote_buffer is None:
+            raise ImproperlyConfigured('RABIDRATINGS_VOTE_BUFFER is not set')
+
+        while True:
+            votes = vote_buffer.pop_many(options['batch_size'])
+            if votes:
+                try:
+                    deltas = RatingEvent.objects.apply_votes(votes, batch_size=options['batch_size'])
+                except Exception:
+                    deltas = self._apply_one_by_one(vote_buffer, votes, options['max_retries'])
+                if int(options.get('verbosity', 1)) > 1:
+                    self.stdout.write('%d votes written, %d ratings updated\n' % (len(votes), len(deltas)))
+            elif not options['loop']:
+                break
+            else:
+                time.sleep(options['interval'])
+
+    def _apply_one_by_one(self, vote_buffer, votes, max_retries):
+        """
+        Writes the last votes of failed batch one by one, so failing ones
+        do not hold back the others. Failing votes are returned to the front
+        of the buffer (before newer votes of the same voters) and the error
+        is raised; votes failed more than max_retries times are dropped.
+        """
+        deltas, failed, exc_info = {}, [], None
+        for vote in RatingEvent.objects.collapse_votes(votes):
+            try:
+                deltas.update(RatingEvent.objects.apply_votes([vote]))
+            except Exception, e:
+                retries = vote.get('retries', 0) + 1
+                if retries > max_retries:
+                    self.stderr.write('vote %r dropped after %d retries: %s\n' % (vote, max_retries, e))
+                    continue
+                failed.append(dict(vote, retries=retries))
+                exc_info = sys.exc_info()
+        if failed:
+            vote_buffer.push_front(failed)
+            six.reraise(*exc_info)
+        return deltas
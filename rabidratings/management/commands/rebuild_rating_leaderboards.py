@@ -0,0 +1,16 @@
+from django.core.management.base import NoArgsCommand
+from django.contrib.contenttypes.models import ContentType
+
+from rabidratings.conf import RABIDRATINGS_LEADERBOARDS
+from rabidratings.models import RatingLeader
+
+
+class Command(NoArgsCommand):
+    help = "Rebuild leaderboards of content types (as natural keys) spec in RABIDRATINGS_LEADERBOARDS"
+
+    def handle(self, **options):
+        for natural_key in RABIDRATINGS_LEADERBOARDS:
+            ct = ContentType.objects.get_by_natural_key(*natural_key.split("."))
+            RatingLeader.objects.rebuild(ct.id)
+            if int(options.get('verbosity', 1)) > 1:
+                self.stdout.write('leaderboard of %s rebuilt\n' % natural_key)
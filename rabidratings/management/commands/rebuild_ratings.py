@@ -0,0 +1,78 @@
+import sys
+from multiprocessing import Pool
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+from django.db import connections
+from django.db.models import Max, Min
+
+from rabidratings.models import Rating
+
+
+def rebuild_ratings(start_pk, end_pk, batch_size=1000, check_only=False, verbosity=1, stdout=None):
+    '''
+    Reconcile counters of ratings in range of primary keys with their events,
+    return tuple (number of checked, number of drifted ratings)
+    '''
+    def progress(checked, drifted, targets):
+        if stdout is None:
+            return
+        if verbosity > 2:
+            for ct_id, obj_id in targets:
+                stdout.write('drifted rating %s_%s\n' % (ct_id, obj_id))
+        if verbosity > 1:
+            stdout.write('ratings %s-%s: %d checked, %d drifted\n' % (start_pk, end_pk, checked, drifted))
+            stdout.flush()
+
+    return Rating.objects.reconcile(start_pk, end_pk, batch_size=batch_size,
+                                    check_only=check_only, progress=progress)
+
+
+def _rebuild_ratings_in_worker(args):
+    # every worker process needs its own db connections
+    for connection in connections.all():
+        connection.close()
+    return rebuild_ratings(*args, stdout=sys.stdout)
+
+
+class Command(NoArgsCommand):
+    help = "Recompute rating counters from votes and fix the ratings which drifted"
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('--batch-size', dest='batch_size', type='int', default=1000,
+                    help='Number of ratings checked (and fixed) in one transaction'),
+        make_option('--check-only', action='store_true', dest='check_only', default=False,
+                    help='Only report drifted ratings'),
+        make_option('--workers', dest='workers', type='int', default=1,
+                    help='Number of processes reconciling ranges of ratings concurrently'),
+    )
+
+    def handle(self, **options):
+        verbosity = int(options.get('verbosity', 1))
+        bounds = Rating.objects.aggregate(min_pk=Min('pk'), max_pk=Max('pk'))
+        if bounds['min_pk'] is None:
+            return
+
+        workers = max(options['workers'], 1)
+        step = (bounds['max_pk'] - bounds['min_pk']) // workers + 1
+        ranges = [(start, start + step - 1, options['batch_size'], options['check_only'], verbosity)
+                  for start in range(bounds['min_pk'], bounds['max_pk'] + 1, step)]
+
+        if len(ranges) > 1:
+            # do not share connection of this process with forked workers
+            for connection in connections.all():
+                connection.close()
+            pool = Pool(len(ranges))
+            try:
+                results = pool.map(_rebuild_ratings_in_worker, ranges)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = [rebuild_ratings(*ranges[0], stdout=self.stdout)]
+
+        if verbosity:
+            checked = sum(r[0] for r in results)
+            drifted = sum(r[1] for r in results)
+            self.stdout.write('%d ratings checked, %d drifted%s\n' % (
+                checked, drifted, '' if options['check_only'] else ' and fixed'))
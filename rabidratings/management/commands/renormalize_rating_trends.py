@@ -0,0 +1,19 @@
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+
+from rabidratings.models import Rating
+
+
+class Command(NoArgsCommand):
+    help = "Rebase decayed trending values of ratings to the current epoch (run at the start of every RABIDRATINGS_TRENDING_EPOCH)"
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('--batch-size', dest='batch_size', type='int', default=10000,
+                    help='Number of ratings (range of ids) updated in one transaction'),
+    )
+
+    def handle(self, **options):
+        updated = Rating.objects.renormalize_trends(batch_size=options['batch_size'])
+        if int(options.get('verbosity', 1)) > 1:
+            self.stdout.write('%d ratings renormalized\n' % updated)
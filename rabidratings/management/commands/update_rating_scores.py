@@ -0,0 +1,19 @@
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+
+from rabidratings.models import Rating
+
+
+class Command(NoArgsCommand):
+    help = "Recompute ranking score of all ratings (run after migration or change of RABIDRATINGS_SCORE_PRIOR_* settings)"
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('--batch-size', dest='batch_size', type='int', default=10000,
+                    help='Number of ratings (range of ids) updated in one transaction'),
+    )
+
+    def handle(self, **options):
+        updated = Rating.objects.update_scores(batch_size=options['batch_size'])
+        if int(options.get('verbosity', 1)) > 1:
+            self.stdout.write('%d ratings updated\n' % updated)
@@ -1,18 +1,46 @@
 import sys
+import zlib
+from datetime import date, datetime, timedelta
+from decimal import Decimal
 
 from django import VERSION
-from django.db import models, IntegrityError
+from django.core.exceptions import ValidationError
+from django.db import models, connections, router, IntegrityError
+from django.db.models import Count, F, Sum
 from django.contrib.contenttypes.models import ContentType
 from django.utils import six
+from django.utils.dateparse import parse_date
+from django.utils.encoding import smart_str
+from django.utils.translation import ugettext_lazy as _
+
+try:
+    from django.utils.timezone import now
+except ImportError:
+    now = datetime.now
 
 if VERSION >= (1, 8):
+    from django.db.models.expressions import RawSQL
     from django.db.models.fields.related import ForeignObjectRel
 else:
     from django.db.models.related import RelatedObject as ForeignObjectRel
     ForeignObjectRel.related_model = property(lambda self: self.model)
+    RawSQL = None
 
-from rabidratings.utils import import_module_member
-from rabidratings.utils.transaction import atomic
+from rabidratings import conf
+from rabidratings.aggregates import (
+                                     COUNTER_FIELDS,
+                                     HISTOGRAM_FIELDS,
+                                     RatingDelta,
+                                     get_day,
+                                     get_histogram_field,
+                                     get_score_sql,
+                                     get_trend_epoch,
+                                     get_trend_weight,
+                                     )
+from rabidratings.cache import get_rating_cache, get_voter_cache, get_voter_key
+from rabidratings.utils import get_voter_fingerprint, import_module_member
+from rabidratings.utils.db import insert_ignore_sql, returning_sql, supports_returning, supports_upsert, upsert_add_sql
+from rabidratings.utils.transaction import atomic, on_commit
 from rabidratings.conf import RABIDRATINGS_GET_OBJECT_FUNC
 
 
@@ -33,6 +61,82 @@ def get_object(model, **kwargs):
 get_object.cache = {}
 
 
+def get_targets_q(targets):
+    '''
+    Return Q matching given (target_ct_id, target_id) pairs,
+    grouped by content type
+    '''
+    ids_by_ct = {}
+    for ct_id, obj_id in targets:
+        ids_by_ct.setdefault(int(ct_id), set()).add(int(obj_id))
+    q = models.Q(pk__in=[])
+    for ct_id, ids in ids_by_ct.items():
+        q |= models.Q(target_ct=ct_id, target_id__in=ids)
+    return q
+
+
+def delete_targets(model, targets, using=None):
+    '''
+    Delete rows of model (rating, event, shard...) for given
+    (target_ct_id, target_id) pairs by single DELETE statement
+    without collecting objects. Return number of deleted rows.
+    '''
+    ids_by_ct = {}
+    for ct_id, obj_id in targets:
+        ids_by_ct.setdefault(int(ct_id), set()).add(int(obj_id))
+    if not ids_by_ct:
+        return 0
+    connection = connections[using or router.db_for_write(model)]
+    qn = connection.ops.quote_name
+    opts = model._meta
+    conditions, params = [], []
+    for ct_id, ids in sorted(ids_by_ct.items()):
+        conditions.append('(%s = %%s AND %s IN (%s))' % (
+            qn(opts.get_field('target_ct').column),
+            qn(opts.get_field('target_id').column),
+            ', '.join(['%s'] * len(ids)),
+        ))
+        params.append(ct_id)
+        params.extend(sorted(ids))
+    cursor = connection.cursor()
+    cursor.execute('DELETE FROM %s WHERE %s' % (qn(opts.db_table), ' OR '.join(conditions)), params)
+    return cursor.rowcount
+
+
+def parse_day(value):
+    '''
+    Return date of value returned by DATE() SQL function
+    (string on some backends)
+    '''
+    if isinstance(value, datetime):
+        return value.date()
+    if isinstance(value, date):
+        return value
+    return parse_date(str(value)[:10])
+
+
+def get_shards_count(target_ct_id):
+    '''
+    Return number of counter shards set for content type
+    in RABIDRATINGS_RATING_SHARDS (0 if the content type is not sharded)
+    '''
+    if not conf.RABIDRATINGS_RATING_SHARDS:
+        return 0
+    ct = ContentType.objects.get_for_id(target_ct_id)
+    return conf.RABIDRATINGS_RATING_SHARDS.get('%s.%s' % (ct.app_label, ct.model), 0)
+
+
+def get_leaderboard_size(target_ct_id):
+    '''
+    Return size of leaderboard set for content type
+    in RABIDRATINGS_LEADERBOARDS (0 if it has no leaderboard)
+    '''
+    if not conf.RABIDRATINGS_LEADERBOARDS:
+        return 0
+    ct = ContentType.objects.get_for_id(target_ct_id)
+    return conf.RABIDRATINGS_LEADERBOARDS.get('%s.%s' % (ct.app_label, ct.model), 0)
+
+
 def get_or_create(model, manager, commit=True, **kwargs):
     assert kwargs, \
                 'get_or_create() must be passed at least one keyword argument'
@@ -80,6 +184,976 @@ class BaseRatingManager(models.Manager):
         return self.get_object(**kwargs)
 
 
+class RatingManager(BaseRatingManager):
+
+    def get_for_object(self, obj, create_if_not=True, **kwargs):
+        rating_cache = get_rating_cache() if not kwargs else None
+        if rating_cache is not None:
+            ct = ContentType.objects.get_for_model(obj.__class__)
+            rating = rating_cache.get('%s_%s' % (ct.id, obj.id))
+            if rating is not None:
+                return rating
+
+        if create_if_not and conf.RABIDRATINGS_LAZY_RATINGS:
+            # do not write on read, the row is created by the first vote
+            try:
+                rating = super(RatingManager, self).get_for_object(obj, False, **kwargs)
+            except self.model.DoesNotExist:
+                ct = ContentType.objects.get_for_model(obj.__class__)
+                rating = self.model(target_ct=ct, target_id=obj.id)
+        else:
+            rating = super(RatingManager, self).get_for_object(obj, create_if_not, **kwargs)
+        rating = self.fold_shards(rating)
+
+        if rating_cache is not None:
+            rating_cache.set(rating)
+        return rating
+
+    def fold_shards(self, rating):
+        """
+        Adds counters not yet compacted from shards to the rating.
+        Folding is done in memory only, folded rating must not be saved.
+        """
+        return self.fold_shards_many([rating])[0]
+
+    def fold_shards_many(self, ratings):
+        """
+        Folds shards into all given ratings by single query.
+        """
+        sharded = [r for r in ratings if r.pk is not None and get_shards_count(r.target_ct_id)]
+        if not sharded:
+            return ratings
+        from rabidratings.models import RatingShard
+        q = get_targets_q((r.target_ct_id, r.target_id) for r in sharded)
+        totals = RatingShard.objects.filter(q).values('target_ct', 'target_id').annotate(
+            **dict((field, Sum(field)) for field in COUNTER_FIELDS)
+        ).order_by()
+        totals = dict(((t['target_ct'], t['target_id']), t) for t in totals)
+        for rating in sharded:
+            t = totals.get((rating.target_ct_id, rating.target_id))
+            if t:
+                delta = RatingDelta()
+                delta.add_counters(t)
+                rating.apply_delta(delta, trend=False)
+        return ratings
+
+    def apply_delta(self, target_ct_id, target_id, delta, voter=None, returning=False):
+        """
+        Applies RatingDelta to the rating of given target by single UPDATE
+        statement, so concurrent votes do not serialize on read-modify-write
+        cycle and no update is lost. Derived columns are computed by database.
+        The rating is created if it does not exist yet.
+
+        Votes for content types in RABIDRATINGS_RATING_SHARDS are spread
+        over shard rows by voter (user id or fingerprint) if it is given.
+
+        If returning is set, the rating with new counters is returned. It is
+        read back by RETURNING clause of the UPDATE where backend supports it.
+        """
+        rating = None
+        shards = get_shards_count(target_ct_id) if voter is not None else 0
+        if not delta:
+            pass
+        elif shards:
+            shard = zlib.crc32(smart_str(voter)) % shards
+            self._apply_shard_delta(target_ct_id, target_id, shard, delta)
+        else:
+            updated, rating = self._update_by_delta(target_ct_id, target_id, delta, returning)
+            if not updated:
+                rating = self.model(target_ct_id=target_ct_id, target_id=target_id)
+                rating.apply_delta(delta)
+                try:
+                    with atomic(using=self.db):
+                        rating.save(force_insert=True)
+                except IntegrityError:
+                    # created meanwhile by concurrent vote
+                    updated, rating = self._update_by_delta(target_ct_id, target_id, delta, returning)
+            if updated and get_leaderboard_size(target_ct_id):
+                # inserted rating updates the leaderboard on save
+                if rating is None:
+                    rating = self.get(target_ct=target_ct_id, target_id=target_id)
+                from rabidratings.models import RatingLeader
+                RatingLeader.objects.update_for(rating)
+        if delta:
+            self._invalidate_cache(target_ct_id, target_id)
+        if delta.days:
+            from rabidratings.models import RatingDay
+            RatingDay.objects.apply_days(target_ct_id, target_id, delta.days)
+
+        if not returning:
+            return None
+        if rating is None:
+            rating = self.get_or_create(commit=False, target_ct_id=target_ct_id, target_id=target_id)[0]
+            rating = self.fold_shards(rating)
+        return rating
+
+    def _invalidate_cache(self, target_ct_id, target_id):
+        rating_cache = get_rating_cache()
+        if rating_cache is not None:
+            # counters are incremented by db, cached rating can not be updated
+            on_commit(lambda: rating_cache.delete('%s_%s' % (target_ct_id, target_id)), using=self.db)
+
+    def _apply_shard_delta(self, target_ct_id, target_id, shard, delta):
+        from rabidratings.models import RatingShard
+        qs = RatingShard.objects.filter(target_ct=target_ct_id, target_id=target_id, shard=shard)
+        counters = delta.counters()
+        values = dict((field, F(field) + change) for field, change in counters.items() if change)
+        if qs.update(**values):
+            return
+        # first vote to the shard, make sure there is a rating to fold it into
+        self.get_or_create(target_ct_id=target_ct_id, target_id=target_id)
+        try:
+            with atomic(using=self.db):
+                RatingShard.objects.create(target_ct_id=target_ct_id, target_id=target_id, shard=shard, **counters)
+        except IntegrityError:
+            qs.update(**values)
+
+    def compact_shards(self, batch_size=1000):
+        """
+        Folds counters from shards into canonical Rating rows. Returns number
+        of compacted shards.
+        """
+        from rabidratings.models import RatingShard
+        compacted, last_pk = 0, 0
+        while True:
+            with atomic(using=self.db):
+                shards = list(RatingShard.objects.select_for_update()
+                              .filter(pk__gt=last_pk)
+                              .exclude(**dict.fromkeys(COUNTER_FIELDS, 0))
+                              .order_by('pk')[:batch_size])
+                if not shards:
+                    return compacted
+
+                deltas, by_values = {}, {}
+                for shard in shards:
+                    counters = dict((field, getattr(shard, field)) for field in COUNTER_FIELDS)
+                    deltas.setdefault((shard.target_ct_id, shard.target_id), RatingDelta()).add_counters(counters)
+                    by_values.setdefault(tuple(sorted(counters.items())), []).append(shard.pk)
+
+                for (ct_id, obj_id), delta in deltas.items():
+                    self.apply_delta(ct_id, obj_id, delta)
+                # subtract what was folded, votes may come in meanwhile on backends without row locks
+                for counters, pks in by_values.items():
+                    RatingShard.objects.filter(pk__in=pks).update(
+                        **dict((field, F(field) - value) for field, value in counters if value))
+            compacted += len(shards)
+            last_pk = shards[-1].pk
+
+    def top_rated(self, model, n=10, min_votes=0):
+        """
+        Returns up to n top rated objects of model (and its subclasses)
+        ordered by ranking score. Objects are read from leaderboards
+        (see RABIDRATINGS_LEADERBOARDS), so at most leaderboard size
+        of objects can be returned. Objects get rating_avg, rating_votes
+        and rating_score attributes.
+        """
+        from rabidratings.models import RatingLeader
+        leaders = RatingLeader.objects.filter(target_ct__in=get_subclasses_ct_ids(model))
+        if min_votes:
+            leaders = leaders.filter(total_votes__gte=min_votes)
+        leaders = list(leaders.order_by('-score', '-total_votes')[:n])
+        objects = model._default_manager.in_bulk([l.target_id for l in leaders])
+        result = []
+        for leader in leaders:
+            obj = objects.get(leader.target_id)
+            if obj is not None:
+                obj.rating_avg = float(leader.avg_rating)
+                obj.rating_votes = leader.total_votes
+                obj.rating_score = leader.score
+                result.append(obj)
+        return result
+
+    def create_missing(self, model, batch_size=1000, progress=None):
+        """
+        Creates zero ratings for objects of model which have none. Objects
+        are streamed in ranges of primary key, rating-less ones are found
+        by anti-join in db and their ratings are inserted in bulk (skipping
+        ones created meanwhile). Optional progress callback is called
+        with number of created ratings after every range.
+        Returns number of created ratings.
+        """
+        ct = ContentType.objects.get_for_model(model)
+        connection = connections[self.db]
+        qn = connection.ops.quote_name
+        opts = self.model._meta
+        not_rated = 'NOT EXISTS (SELECT 1 FROM %s WHERE %s = %%s AND %s = %s.%s)' % (
+            qn(opts.db_table),
+            qn(opts.get_field('target_ct').column),
+            qn(opts.get_field('target_id').column),
+            qn(model._meta.db_table),
+            qn(model._meta.pk.column),
+        )
+        objects = model._default_manager.using(self.db)
+        bounds = objects.aggregate(min_pk=models.Min('pk'), max_pk=models.Max('pk'))
+        if bounds['min_pk'] is None:
+            return 0
+        created = 0
+        for start in range(bounds['min_pk'] - 1, bounds['max_pk'], batch_size):
+            ids = list(objects.filter(pk__gt=start, pk__lte=start + batch_size)
+                       .extra(where=[not_rated], params=[ct.id])
+                       .values_list('pk', flat=True))
+            if ids:
+                timestamp = now()
+                self.bulk_insert_ignore([self.model(target_ct=ct, target_id=obj_id, created=timestamp, updated=timestamp)
+                                         for obj_id in ids])
+                created += len(ids)
+            if progress is not None:
+                progress(created)
+        return created
+
+    def bulk_insert_ignore(self, ratings):
+        """
+        Inserts ratings in bulk, ratings created meanwhile are skipped.
+        """
+        connection = connections[self.db]
+        if supports_upsert(connection):
+            opts = self.model._meta
+            fields = [f for f in opts.local_fields if not f.primary_key]
+            unique = [opts.get_field(name).column for name in ('target_ct', 'target_id')]
+            sql = insert_ignore_sql(connection, opts.db_table, [f.column for f in fields], unique)
+            cursor = connection.cursor()
+            with atomic(using=self.db):
+                cursor.executemany(sql, [[f.get_db_prep_save(getattr(r, f.attname), connection) for f in fields]
+                                         for r in ratings])
+            return
+        try:
+            with atomic(using=self.db):
+                self.bulk_create(ratings)
+        except IntegrityError:
+            for rating in ratings:
+                self.get_or_create(target_ct_id=rating.target_ct_id, target_id=rating.target_id)
+
+    def reconcile(self, start_pk=None, end_pk=None, batch_size=1000, check_only=False, progress=None):
+        """
+        Recomputes counters of ratings with primary key in given range
+        from their events (by single GROUP BY query per batch of ratings,
+        events are never loaded) and updates the ratings whose counters
+        drifted. Counters of not yet compacted shards are taken into account.
+        If check_only is set, nothing is updated. Optional progress callback
+        is called with (checked, drifted, drifted targets of batch) after
+        every batch. Returns tuple (number of checked, number of drifted).
+        """
+        ratings = self.all()
+        if start_pk is not None:
+            ratings = ratings.filter(pk__gte=start_pk)
+        if end_pk is not None:
+            ratings = ratings.filter(pk__lte=end_pk)
+
+        checked, drifted, last_pk = 0, 0, None
+        while True:
+            with atomic(using=self.db):
+                batch = ratings.order_by('pk')
+                if last_pk is not None:
+                    batch = batch.filter(pk__gt=last_pk)
+                if not check_only:
+                    # votes applied meanwhile wait, so they are not overwritten
+                    batch = batch.select_for_update()
+                fields = ['pk', 'target_ct_id', 'target_id'] + COUNTER_FIELDS
+                batch = [dict(zip(fields, row)) for row in batch.values_list(*fields)[:batch_size]]
+                if not batch:
+                    return checked, drifted
+                last_pk = batch[-1]['pk']
+                by_counters, targets = self._find_drifted(batch)
+
+                if not check_only:
+                    for counters, pks in by_counters.items():
+                        rating = self.model()
+                        delta = RatingDelta()
+                        delta.add_counters(dict(counters))
+                        rating.apply_delta(delta, trend=False)
+                        values = dict((field, getattr(rating, field)) for field in COUNTER_FIELDS)
+                        self.filter(pk__in=pks).update(
+                            avg_rating=rating.avg_rating,
+                            percent=rating.percent,
+                            score=rating.score,
+                            **values
+                        )
+                    for ct_id, obj_id in targets:
+                        self._invalidate_cache(ct_id, obj_id)
+
+            checked += len(batch)
+            drifted += len(targets)
+            if progress is not None:
+                progress(checked, drifted, targets)
+
+    def _find_drifted(self, batch):
+        """
+        Returns tuple (pks of drifted ratings keyed by correct counters
+        as sorted items, targets of drifted ratings) for batch of dicts
+        with pk, target_ct_id, target_id and COUNTER_FIELDS of ratings.
+        """
+        from rabidratings.models import RatingEvent, RatingShard
+        q = get_targets_q((r['target_ct_id'], r['target_id']) for r in batch)
+        deltas = {}
+        for t in (RatingEvent.objects.filter(q).filter(value__gt=0)
+                  .values('target_ct', 'target_id', 'value').annotate(votes=Count('pk')).order_by()):
+            counters = {'total_rating': t['value'] * t['votes'], 'total_votes': t['votes']}
+            field = get_histogram_field(t['value'])
+            if field is not None:
+                counters[field] = t['votes']
+            deltas.setdefault((t['target_ct'], t['target_id']), RatingDelta()).add_counters(counters)
+        if any(get_shards_count(r['target_ct_id']) for r in batch):
+            # compacted counters of sharded ratings are events minus shards
+            for t in RatingShard.objects.filter(q).values('target_ct', 'target_id').annotate(
+                    **dict((field, Sum(field)) for field in COUNTER_FIELDS)).order_by():
+                deltas.setdefault((t['target_ct'], t['target_id']), RatingDelta()).add_counters(
+                    dict((field, -(t[field] or 0)) for field in COUNTER_FIELDS))
+
+        by_counters, targets = {}, []
+        for r in batch:
+            target = (r['target_ct_id'], r['target_id'])
+            expected = deltas.get(target, RatingDelta()).counters()
+            if any(expected[field] != r[field] for field in COUNTER_FIELDS):
+                by_counters.setdefault(tuple(sorted(expected.items())), []).append(r['pk'])
+                targets.append(target)
+        return by_counters, targets
+
+    def update_scores(self, batch_size=10000):
+        """
+        Recomputes ranking score of all ratings by set-based UPDATE
+        statements in ranges of primary key. Returns number of updated rows.
+        """
+        connection = connections[self.db]
+        qn = connection.ops.quote_name
+        col = lambda name: qn(self.model._meta.get_field(name).column)
+        assignments = '%s = %s' % (col('score'), get_score_sql(col('total_rating'), col('total_votes')))
+        return self._update_in_ranges(assignments, [], batch_size)
+
+    def renormalize_trends(self, batch_size=10000):
+        """
+        Rebases decayed trending values of ratings not voted in the current
+        epoch, so all of them are comparable (and stored values do not grow
+        without bounds). Returns number of updated rows.
+        """
+        connection = connections[self.db]
+        qn = connection.ops.quote_name
+        col = lambda name: qn(self.model._meta.get_field(name).column)
+        epoch = get_trend_epoch()
+        factor, factor_params = self._trend_factor_sql(connection, epoch)
+        assignments = '%s = %s * %s, %s = %s * %s, %s = %%s' % (
+            col('trend_mass'), col('trend_mass'), factor,
+            col('trend_sum'), col('trend_sum'), factor,
+            col('trend_epoch'),
+        )
+        params = factor_params + factor_params + [epoch]
+        return self._update_in_ranges(assignments, params, batch_size,
+                                      where='%s <> %%s' % col('trend_epoch'), where_params=[epoch])
+
+    def _update_in_ranges(self, assignments, params, batch_size, where=None, where_params=()):
+        connection = connections[self.db]
+        qn = connection.ops.quote_name
+        opts = self.model._meta
+        sql = 'UPDATE %s SET %s WHERE %s > %%s AND %s <= %%s' % (
+            qn(opts.db_table),
+            assignments,
+            qn(opts.pk.column),
+            qn(opts.pk.column),
+        )
+        if where:
+            sql += ' AND %s' % where
+        bounds = self.aggregate(min_pk=models.Min('pk'), max_pk=models.Max('pk'))
+        if bounds['min_pk'] is None:
+            return 0
+        updated = 0
+        cursor = connection.cursor()
+        for start in range(bounds['min_pk'] - 1, bounds['max_pk'], batch_size):
+            with atomic(using=self.db):
+                cursor.execute(sql, list(params) + [start, start + batch_size] + list(where_params))
+                updated += cursor.rowcount
+        return updated
+
+    def _trend_factor_sql(self, connection, epoch):
+        """
+        Returns SQL (and its params) of factor rebasing decayed trending
+        values of a row to given epoch. Values older than 64 half-lives
+        are dropped (some backends fail on underflow).
+        """
+        qn = connection.ops.quote_name
+        trend_epoch = qn(self.model._meta.get_field('trend_epoch').column)
+        half_life = float(conf.RABIDRATINGS_TRENDING_HALF_LIFE)
+        power = connection.ops.combine_expression('^', ['2.0', '(%s - %%s) / %%s' % trend_epoch])
+        sql = 'CASE WHEN %s = %%s THEN 1.0 WHEN %s < %%s THEN 0.0 ELSE %s END' % (trend_epoch, trend_epoch, power)
+        return sql, [epoch, epoch - 64 * half_life, epoch, half_life]
+
+    def _update_by_delta(self, target_ct_id, target_id, delta, returning=False):
+        """
+        Returns tuple (row was updated, rating with new counters or None
+        if they can not be returned by the UPDATE).
+        """
+        connection = connections[self.db]
+        qn = connection.ops.quote_name
+        opts = self.model._meta
+        col = lambda name: qn(opts.get_field(name).column)
+
+        total_rating, total_votes = col('total_rating'), col('total_votes')
+        new_avg = '(%s + %%s) * 1.0 / (%s + %%s)' % (total_rating, total_votes)
+        new_avg = 'CASE WHEN %s + %%s > 0 THEN %s ELSE 0 END' % (total_votes, new_avg)
+        avg_params = [delta.total_votes, delta.total_rating, delta.total_votes]
+        new_score = get_score_sql('%s + %%s' % total_rating, '(%s + %%s)' % total_votes)
+        score_params = [delta.total_votes, delta.total_rating, delta.total_votes]
+
+        epoch = get_trend_epoch()
+        weight = get_trend_weight(epoch=epoch)
+        factor, factor_params = self._trend_factor_sql(connection, epoch)
+        new_trend_sum = '%s * %s + %%s' % (col('trend_sum'), factor)
+        trend_sum_params = factor_params + [weight * delta.total_rating]
+
+        updated = now()
+
+        # derived columns go first - MySQL evaluates assignments from left
+        # to right and would see already updated totals otherwise
+        assignments = [
+            ('%s = %s / 20' % (col('avg_rating'), new_avg), avg_params),
+            ('%s = %s / 100' % (col('percent'), new_avg), avg_params),
+            ('%s = %s' % (col('score'), new_score), score_params),
+            ('%s = %s * %s + %%s' % (col('trend_mass'), col('trend_mass'), factor), factor_params + [weight * delta.total_votes]),
+            ('%s = CASE WHEN %s > 0 THEN %s ELSE 0 END' % (col('trend_sum'), new_trend_sum, new_trend_sum), trend_sum_params * 2),
+            ('%s = %%s' % col('trend_epoch'), [epoch]),
+            ('%s = %s + %%s' % (total_rating, total_rating), [delta.total_rating]),
+            ('%s = %s + %%s' % (total_votes, total_votes), [delta.total_votes]),
+        ] + [
+            ('%s = %s + %%s' % (col(field), col(field)), [votes])
+            for field, votes in sorted(delta.histogram.items()) if votes
+        ] + [
+            ('%s = %%s' % col('updated'), [opts.get_field('updated').get_db_prep_value(updated, connection)]),
+        ]
+        sql = 'UPDATE %s SET %s WHERE %s = %%s AND %s = %%s' % (
+            qn(opts.db_table),
+            ', '.join(a[0] for a in assignments),
+            col('target_ct'),
+            col('target_id'),
+        )
+        params = []
+        for a in assignments:
+            params.extend(a[1])
+        params.extend([target_ct_id, target_id])
+
+        returned = ['id', 'total_rating', 'total_votes', 'avg_rating', 'percent', 'score',
+                    'trend_mass', 'trend_sum', 'trend_epoch'] + HISTOGRAM_FIELDS
+        returning = returning and supports_returning(connection)
+        if returning:
+            sql += returning_sql(connection, [opts.get_field(f).column for f in returned])
+
+        cursor = connection.cursor()
+        cursor.execute(sql, params)
+        if not returning:
+            return bool(cursor.rowcount), None
+        row = cursor.fetchone()
+        if row is None:
+            return False, None
+        values = dict(zip(returned, row))
+        avg_field = opts.get_field('avg_rating')
+        values['avg_rating'] = Decimal(str(values['avg_rating'])).quantize(Decimal(1).scaleb(-avg_field.decimal_places))
+        return True, self.model(target_ct_id=target_ct_id, target_id=target_id, updated=updated, **values)
+
+
+class RatingLeaderManager(models.Manager):
+
+    def update_for(self, rating):
+        """
+        Updates leaderboard of the rating content type if the rating
+        enters it, leaves it or changes its place there.
+        Leaderboards drifting by concurrent updates are fixed by rebuild.
+        """
+        size = get_leaderboard_size(rating.target_ct_id)
+        if not size:
+            return
+        values = dict(score=rating.score, avg_rating=rating.avg_rating, total_votes=rating.total_votes)
+        leaders = self.filter(target_ct=rating.target_ct_id)
+        with atomic(using=self.db):
+            try:
+                leader = leaders.select_for_update().get(target_id=rating.target_id)
+            except self.model.DoesNotExist:
+                leader = None
+
+            if leader is not None:
+                leaders.filter(pk=leader.pk).update(**values)
+                if rating.score < leader.score:
+                    # the rating may fall behind the best one out of the leaderboard
+                    member_ids = list(leaders.values_list('target_id', flat=True))
+                    candidates = list(rating.__class__.objects
+                                      .filter(target_ct=rating.target_ct_id, score__gt=rating.score)
+                                      .exclude(target_id__in=member_ids)
+                                      .order_by('-score')[:1])
+                    if candidates and len(member_ids) >= size:
+                        leaders.filter(pk=leader.pk).delete()
+                    if candidates:
+                        self._add(candidates[0])
+                return
+
+            if not rating.total_votes:
+                return
+            stats = leaders.aggregate(count=models.Count('pk'), threshold=models.Min('score'))
+            if stats['count'] >= size and rating.score <= stats['threshold']:
+                return
+            self._add(rating)
+            if stats['count'] >= size:
+                # drop leaders pushed out by the new one
+                lowest = leaders.order_by('score', '-pk').values_list('pk', flat=True)[:stats['count'] + 1 - size]
+                leaders.filter(pk__in=list(lowest)).delete()
+
+    def rebuild(self, target_ct_id):
+        """
+        Replaces leaderboard of content type by current top rated ratings.
+        """
+        size = get_leaderboard_size(target_ct_id)
+        from rabidratings.models import Rating
+        ratings = Rating.objects.filter(target_ct=target_ct_id, total_votes__gt=0).order_by('-score')[:size]
+        with atomic(using=self.db):
+            self.filter(target_ct=target_ct_id).delete()
+            self.bulk_create([self.model(target_ct_id=target_ct_id, target_id=r.target_id,
+                                         score=r.score, avg_rating=r.avg_rating, total_votes=r.total_votes)
+                              for r in ratings])
+
+    def _add(self, rating):
+        try:
+            with atomic(using=self.db):
+                self.create(target_ct_id=rating.target_ct_id, target_id=rating.target_id,
+                            score=rating.score, avg_rating=rating.avg_rating, total_votes=rating.total_votes)
+        except IntegrityError:
+            # added meanwhile by concurrent vote
+            pass
+
+
+class RatingDayManager(models.Manager):
+
+    def apply_days(self, target_ct_id, target_id, days):
+        """
+        Adds changes of daily rollup ([total rating, total votes] by day)
+        of given target by single statement per day (native upsert
+        where backend supports it).
+        """
+        connection = connections[self.db]
+        opts = self.model._meta
+        for day, (total_rating, total_votes) in sorted(days.items()):
+            if not total_rating and not total_votes:
+                continue
+            if supports_upsert(connection):
+                fields = [opts.get_field(name) for name in ('target_ct', 'target_id', 'day', 'total_rating', 'total_votes')]
+                sql = upsert_add_sql(connection, opts.db_table, [f.column for f in fields],
+                                     [f.column for f in fields[:3]], [f.column for f in fields[3:]])
+                params = [f.get_db_prep_save(v, connection)
+                          for f, v in zip(fields, [target_ct_id, target_id, day, total_rating, total_votes])]
+                connection.cursor().execute(sql, params)
+                continue
+
+            qs = self.filter(target_ct=target_ct_id, target_id=target_id, day=day)
+            values = dict(total_rating=F('total_rating') + total_rating, total_votes=F('total_votes') + total_votes)
+            if qs.update(**values):
+                continue
+            try:
+                with atomic(using=self.db):
+                    self.create(target_ct_id=target_ct_id, target_id=target_id, day=day,
+                                total_rating=total_rating, total_votes=total_votes)
+            except IntegrityError:
+                qs.update(**values)
+
+    def get_window(self, obj, days=30, until=None):
+        """
+        Returns dict (total_rating, total_votes, avg_rating in stars)
+        of votes for obj first cast in the last days (up to until day,
+        today by default) by summing at most days rollup rows.
+        """
+        ct = ContentType.objects.get_for_model(obj.__class__)
+        until = until or get_day()
+        totals = self.filter(target_ct=ct, target_id=obj.pk, day__gt=until - timedelta(days=days), day__lte=until
+                             ).aggregate(total_rating=Sum('total_rating'), total_votes=Sum('total_votes'))
+        totals = dict((name, value or 0) for name, value in totals.items())
+        totals['avg_rating'] = totals['total_rating'] / 20.0 / totals['total_votes'] if totals['total_votes'] else 0.0
+        return totals
+
+    def get_daily(self, obj, days=30, until=None):
+        """
+        Returns list of dicts (day, total_rating, total_votes, avg_rating
+        in stars) for every of the last days (up to until day, today
+        by default), days without votes included.
+        """
+        ct = ContentType.objects.get_for_model(obj.__class__)
+        until = until or get_day()
+        rows = self.filter(target_ct=ct, target_id=obj.pk, day__gt=until - timedelta(days=days), day__lte=until)
+        rows = dict((row.day, row) for row in rows)
+        daily = []
+        for i in range(days - 1, -1, -1):
+            day = until - timedelta(days=i)
+            row = rows.get(day)
+            total_rating, total_votes = (row.total_rating, row.total_votes) if row else (0, 0)
+            daily.append({
+                'day': day,
+                'total_rating': total_rating,
+                'total_votes': total_votes,
+                'avg_rating': total_rating / 20.0 / total_votes if total_votes else 0.0,
+            })
+        return daily
+
+    def backfill(self, batch_size=1000, progress=None):
+        """
+        Rebuilds daily rollups of all ratings from their events, grouped
+        by day in db by single query per batch of ratings. Optional progress
+        callback is called with number of processed ratings after every batch.
+        Returns number of processed ratings.
+        """
+        from rabidratings.models import Rating, RatingEvent
+        connection = connections[self.db]
+        created = connection.ops.quote_name(RatingEvent._meta.get_field('created').column)
+        processed, last_pk = 0, 0
+        while True:
+            with atomic(using=self.db):
+                # votes applied meanwhile wait, so they are not lost
+                targets = list(Rating.objects.select_for_update().filter(pk__gt=last_pk).order_by('pk')
+                               .values_list('pk', 'target_ct_id', 'target_id')[:batch_size])
+                if not targets:
+                    return processed
+                last_pk = targets[-1][0]
+                q = get_targets_q((ct_id, obj_id) for pk, ct_id, obj_id in targets)
+                rows = (RatingEvent.objects.filter(q).filter(value__gt=0)
+                        .extra(select={'day': 'DATE(%s)' % created})
+                        .values('target_ct', 'target_id', 'day')
+                        .annotate(total_rating=Sum('value'), total_votes=Count('pk'))
+                        .order_by())
+                self.filter(q).delete()
+                self.bulk_create([self.model(target_ct_id=row['target_ct'], target_id=row['target_id'],
+                                             day=parse_day(row['day']), total_rating=row['total_rating'],
+                                             total_votes=row['total_votes'])
+                                  for row in rows])
+            processed += len(targets)
+            if progress is not None:
+                progress(processed)
+
+
+class RatingEventManager(BaseRatingManager):
+
+    def record_vote(self, target_ct_id, target_id, value, user=None, ip=None, voter_fp=None):
+        """
+        Records vote of user (or anonymous voter by fingerprint, which is
+        computed from ip if not given) and updates the rating
+        by fixed number of statements: previous vote of the voter is read,
+        the event is updated or inserted (unique conflict is detected by native
+        upsert where backend supports it) and the delta is applied to the rating,
+        whose new counters are read back by RETURNING where supported.
+
+        Returns tuple (event, rating with new counters).
+        """
+        lookup = dict(target_ct_id=target_ct_id, target_id=target_id)
+        if user is not None:
+            lookup['user'] = user
+        else:
+            lookup['voter_fp'] = voter_fp or get_voter_fingerprint(ip)
+        event = self.model(value=value, ip=ip, **lookup)
+        try:
+            event.clean()
+        except ValidationError, e:
+            raise IntegrityError(e.messages)
+
+        from rabidratings.models import Rating
+        with atomic(using=self.db):
+            previous = list(self.select_for_update().filter(**lookup).values_list('pk', 'value', 'created')[:1])
+            event.updated = now()
+            if previous:
+                event.pk, event.old_value, event.created = previous[0]
+                self.filter(pk=event.pk).update(value=value, updated=event.updated)
+            else:
+                event.old_value = 0
+                event.created = event.updated
+                if not self._insert_event(event):
+                    # voted meanwhile by concurrent request
+                    return self.record_vote(target_ct_id, target_id, value, user, ip, event.voter_fp)
+            event.is_changing = bool(previous)
+
+            delta = RatingDelta.for_event(event) if value > 0 else RatingDelta()
+            rating = Rating.objects.apply_delta(target_ct_id, target_id, delta,
+                                                voter=user.pk if user is not None else event.voter_fp, returning=True)
+            event.old_value = event.value
+            self.invalidate_voters([get_voter_key(user_id=event.user_id, voter_fp=event.voter_fp)])
+        return event, rating
+
+    def invalidate_voters(self, voter_keys):
+        """
+        Invalidates cached votes of voters (see rabidratings.cache.VoterCache)
+        when the transaction is committed.
+        """
+        voter_cache = get_voter_cache()
+        if voter_cache is not None:
+            voter_keys = set(voter_keys)
+            on_commit(lambda: [voter_cache.invalidate(k) for k in voter_keys], using=self.db)
+
+    def _insert_event(self, event):
+        """
+        Inserts event without updating the rating. Returns False if the voter
+        voted meanwhile (detected on backends with native upsert only).
+        """
+        connection = connections[self.db]
+        if not supports_upsert(connection):
+            super(self.model, event).save(force_insert=True, using=self.db)
+            return True
+
+        opts = self.model._meta
+        fields = [f for f in opts.local_fields if not f.primary_key]
+        voter = 'user' if event.user_id is not None else 'voter_fp'
+        unique = [opts.get_field(name).column for name in ('target_ct', 'target_id', voter)]
+        sql = insert_ignore_sql(connection, opts.db_table, [f.column for f in fields], unique)
+        params = [f.get_db_prep_save(getattr(event, f.attname), connection) for f in fields]
+        returning = supports_returning(connection)
+        if returning:
+            sql += returning_sql(connection, [opts.pk.column])
+
+        cursor = connection.cursor()
+        cursor.execute(sql, params)
+        if returning:
+            row = cursor.fetchone()
+            if row is None:
+                return False
+            event.pk = row[0]
+        else:
+            if not cursor.rowcount:
+                return False
+            event.pk = connection.ops.last_insert_id(cursor, opts.db_table, opts.pk.column)
+        return True
+
+    def for_user(self, user):
+        """
+        Returns votes of user, the newest first (read by the (user, updated)
+        index), with their rated objects loaded by one query per content type.
+        See rabidratings.pagination.UserVotesPaginator for pages of them.
+        """
+        return self.filter(user=user).order_by('-updated', '-pk').prefetch_related('target')
+
+    def record_many(self, voter, votes):
+        """
+        Records votes of one voter for many objects given as pairs
+        (rating key, value). voter is dict of user or ip and optionally
+        voter_fp (see rabidratings.utils.get_voter). The whole batch
+        is validated first (ValidationError is raised for invalid one),
+        then written by apply_votes and the new ratings are read back
+        in the same transaction by single query.
+
+        Returns dict of ratings keyed by rating key.
+        """
+        user = voter.get('user')
+        if user is None and conf.RABIDRATINGS_DISABLE_ANONYMOUS_USERS:
+            raise ValidationError(_("User is required for rating event"))
+        voter_fp = None
+        if user is None:
+            voter_fp = voter.get('voter_fp') or get_voter_fingerprint(voter.get('ip'))
+
+        from rabidratings.models import Rating
+        batch = []
+        for key, value in votes:
+            try:
+                ct_id, obj_id = [int(part) for part in Rating.split_key(key)]
+                value = int(value)
+                ContentType.objects.get_for_id(ct_id)
+            except (ValueError, ContentType.DoesNotExist):
+                raise ValidationError(_("Invalid vote for %s") % key)
+            if not 0 < value <= 100:
+                raise ValidationError(_("Invalid vote for %s") % key)
+            batch.append(dict(target_ct_id=ct_id, target_id=obj_id, value=value,
+                              user_id=user.pk if user is not None else None,
+                              ip=voter.get('ip'), voter_fp=voter_fp))
+
+        with atomic(using=self.db):
+            self.apply_votes(batch)
+            targets = set((v['target_ct_id'], v['target_id']) for v in batch)
+            ratings = list(Rating.objects.filter(get_targets_q(targets))) if targets else []
+        return dict((r.key, r) for r in Rating.objects.fold_shards_many(ratings))
+
+    def apply_votes(self, votes, batch_size=None):
+        """
+        Writes batch of votes (dicts with target_ct_id, target_id, value,
+        user_id or ip and optionally voter_fp and updated) by few bulk statements:
+        repeated votes of the same voter are collapsed (last wins),
+        new events are inserted by bulk_create, changed ones updated
+        per value and a single aggregated delta is applied to every Rating.
+
+        Returns dict of RatingDelta applied keyed by (target_ct_id, target_id).
+        """
+        collapsed = self.collapse_votes(votes)
+        if not collapsed:
+            return {}
+
+        with atomic(using=self.db):
+            try:
+                with atomic(using=self.db):
+                    deltas = self._write_votes(collapsed, batch_size)
+            except IntegrityError:
+                # some voter voted meanwhile by other way, save votes one by one
+                deltas = self._save_votes(collapsed)
+        return deltas
+
+    def collapse_votes(self, votes):
+        """
+        Returns list of the last votes of every voter for every object
+        from votes given in order they were cast (see apply_votes).
+        """
+        collapsed = {}
+        for vote in votes:
+            if vote['value'] > 0:
+                if not vote.get('user_id') and not vote.get('voter_fp'):
+                    vote = dict(vote, voter_fp=get_voter_fingerprint(vote.get('ip')))
+                collapsed[self._voter_key(vote)] = vote
+        return list(collapsed.values())
+
+    @staticmethod
+    def _voter_key(vote):
+        voter = ('user', vote['user_id']) if vote.get('user_id') else ('voter_fp', vote.get('voter_fp'))
+        return (int(vote['target_ct_id']), int(vote['target_id'])) + voter
+
+    def _existing_events(self, votes):
+        q = models.Q()
+        for ct_id in set(int(v['target_ct_id']) for v in votes):
+            ct_votes = [v for v in votes if int(v['target_ct_id']) == ct_id]
+            user_ids = set(v['user_id'] for v in ct_votes if v.get('user_id'))
+            fps = set(v['voter_fp'] for v in ct_votes if not v.get('user_id'))
+            voters = models.Q(user__in=user_ids) | models.Q(voter_fp__in=fps)
+            q |= models.Q(voters, target_ct=ct_id, target_id__in=set(int(v['target_id']) for v in ct_votes))
+        events = {}
+        # old values are taken away from ratings, so they can not change meanwhile
+        for event in self.select_for_update().filter(q):
+            vote = dict(target_ct_id=event.target_ct_id, target_id=event.target_id,
+                        user_id=event.user_id, voter_fp=event.voter_fp)
+            events[self._voter_key(vote)] = event
+        return events
+
+    def _write_votes(self, votes, batch_size):
+        existing = self._existing_events(votes)
+        deltas = {}
+        new_events = []
+        changed = {}
+        for vote in votes:
+            updated = vote.get('updated') or now()
+            target = (int(vote['target_ct_id']), int(vote['target_id']))
+            delta = deltas.setdefault(target, RatingDelta())
+            event = existing.get(self._voter_key(vote))
+            if event is None:
+                new_events.append(self.model(
+                    target_ct_id=target[0], target_id=target[1], value=vote['value'],
+                    user_id=vote.get('user_id'), ip=vote.get('ip'),
+                    voter_fp=None if vote.get('user_id') else vote['voter_fp'], created=updated, updated=updated,
+                ))
+                delta.add_vote(vote['value'], day=get_day(updated))
+            elif event.value != vote['value']:
+                changed.setdefault(vote['value'], []).append(event.pk)
+                delta.add_vote(vote['value'], event.value, get_day(event.created))
+
+        self.bulk_create(new_events, batch_size=batch_size)
+        for value, pks in changed.items():
+            self.filter(pk__in=pks).update(value=value, updated=now())
+        self.invalidate_voters(get_voter_key(user_id=v.get('user_id'), voter_fp=v.get('voter_fp')) for v in votes)
+
+        from rabidratings.models import Rating
+        for (ct_id, obj_id), delta in deltas.items():
+            Rating.objects.apply_delta(ct_id, obj_id, delta)
+        return deltas
+
+    def _save_votes(self, votes):
+        deltas = {}
+        for vote in votes:
+            lookup = dict(target_ct_id=vote['target_ct_id'], target_id=vote['target_id'])
+            if vote.get('user_id'):
+                lookup['user_id'] = vote['user_id']
+            else:
+                lookup['voter_fp'] = vote['voter_fp']
+            event = self._existing_events([vote]).get(self._voter_key(vote))
+            created = event is None
+            if created:
+                event, created = self.get_or_create(commit=False, **lookup)
+            if created:
+                event.ip = vote.get('ip')
+            old_value = 0 if created else event.value
+            event.is_changing = not created
+            event.old_value = old_value
+            event.value = vote['value']
+            event.save()
+
+            target = (int(vote['target_ct_id']), int(vote['target_id']))
+            deltas.setdefault(target, RatingDelta()).add_vote(event.value, old_value)
+        return deltas
+
+    def expire_anonymous(self, ttl=None, batch_size=1000, dry_run=False):
+        """
+        Anonymizes votes of anonymous voters not updated for ttl seconds
+        (RABIDRATINGS_ANONYMOUS_VOTE_TTL by default): their fingerprint and ip
+        are cleared, so they still count in ratings but the voter can vote again.
+        Events are processed in batches by primary key ranges.
+
+        Returns number of expired events.
+        """
+        if ttl is None:
+            ttl = conf.RABIDRATINGS_ANONYMOUS_VOTE_TTL
+        cutoff = now() - timedelta(seconds=ttl)
+        expired, last_pk = 0, 0
+        while True:
+            pks = list(self.filter(pk__gt=last_pk).order_by('pk').values_list('pk', flat=True)[:batch_size])
+            if not pks:
+                break
+            last_pk = pks[-1]
+            qs = self.filter(pk__gte=pks[0], pk__lte=last_pk, user__isnull=True,
+                             voter_fp__isnull=False, updated__lt=cutoff)
+            if dry_run:
+                expired += qs.count()
+                continue
+            with atomic(using=self.db):
+                fps = list(qs.values_list('voter_fp', flat=True))
+                expired += qs.update(voter_fp=None, ip=None)
+                self.invalidate_voters(get_voter_key(voter_fp=fp) for fp in fps)
+        return expired
+
+
+class RatingQuerySetMixin(object):
+    """
+    Mixin for QuerySet of rated model adding ordering by rating.
+    Unlike QuerySet.by_rating, objects without rating are not dropped
+    but ordered last.
+
+        class ArticleQuerySet(RatingQuerySetMixin, QuerySet):
+            pass
+
+        class Article(models.Model):
+            objects = ArticleQuerySet.as_manager()
+
+        Article.objects.order_by_rating()
+    """
+
+    def with_rating(self):
+        """
+        Annotates objects by rating_avg, rating_votes and rating_score
+        (zero if not rated).
+        """
+        from rabidratings.models import get_rating_subqueries
+        values = get_rating_subqueries(self.model)
+        if RawSQL is None:
+            return self.extra(select={
+                'rating_avg': values['avg_rating'],
+                'rating_votes': values['total_votes'],
+                'rating_score': values['score'],
+            })
+        return self.annotate(
+            rating_avg=RawSQL(values['avg_rating'], (), output_field=models.FloatField()),
+            rating_votes=RawSQL(values['total_votes'], (), output_field=models.IntegerField()),
+            rating_score=RawSQL(values['score'], (), output_field=models.FloatField()),
+        )
+
+    def order_by_rating(self, by_score=False):
+        if by_score:
+            order_by = ['-rating_score', '-rating_votes']
+        else:
+            order_by = ['-rating_avg', '-rating_votes']
+        order_by.extend(self.query.order_by[:])
+        return self.with_rating().order_by(*order_by)
+
+
+def get_subclasses_ct_ids(model):
+    '''
+    Return ids of content types of model and its subclasses
+    (resolved once per model)
+    '''
+    ct_ids = get_subclasses_ct_ids.cache.get(model, None)
+    if ct_ids is None:
+        ct_ids = [ContentType.objects.get_for_model(m).id for m in _get_subclasses(model)]
+        get_subclasses_ct_ids.cache[model] = ct_ids
+    return ct_ids
+get_subclasses_ct_ids.cache = {}
+
+
 def _get_subclasses(model):
     subclasses = [model]
     for f in model._meta.get_all_field_names():
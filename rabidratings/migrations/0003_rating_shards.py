@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contenttypes', '__latest__'),
+        ('rabidratings', '0002_auto_20150520_1716'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RatingShard',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('target_id', models.IntegerField(verbose_name='Target ID')),
+                ('shard', models.PositiveSmallIntegerField(verbose_name='Shard')),
+                ('total_rating', models.IntegerField(default=0, verbose_name='Total Rating Sum')),
+                ('total_votes', models.IntegerField(default=0, verbose_name='Total Votes')),
+                ('target_ct', models.ForeignKey(verbose_name='Target content type', to='contenttypes.ContentType')),
+            ],
+            options={
+                'verbose_name': 'Rating shard',
+                'verbose_name_plural': 'Rating shards',
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='ratingshard',
+            unique_together=set([('target_ct', 'target_id', 'shard')]),
+        ),
+    ]
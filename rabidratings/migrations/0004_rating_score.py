@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rabidratings', '0003_rating_shards'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='rating',
+            name='score',
+            field=models.FloatField(default=0.0, verbose_name='Ranking Score (computed)'),
+        ),
+        migrations.AlterIndexTogether(
+            name='rating',
+            index_together=set([('target_ct', 'score')]),
+        ),
+    ]
@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+from decimal import Decimal
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contenttypes', '__latest__'),
+        ('rabidratings', '0004_rating_score'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RatingLeader',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('target_id', models.IntegerField(verbose_name='Target ID')),
+                ('score', models.FloatField(default=0.0, verbose_name='Ranking Score')),
+                ('avg_rating', models.DecimalField(default=Decimal('0.0'), verbose_name='Average Rating', max_digits=2, decimal_places=1)),
+                ('total_votes', models.PositiveIntegerField(default=0, verbose_name='Total Votes')),
+                ('target_ct', models.ForeignKey(verbose_name='Target content type', to='contenttypes.ContentType')),
+            ],
+            options={
+                'verbose_name': 'Rating leader',
+                'verbose_name_plural': 'Rating leaders',
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='ratingleader',
+            unique_together=set([('target_ct', 'target_id')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='ratingleader',
+            index_together=set([('target_ct', 'score')]),
+        ),
+    ]
@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rabidratings', '0005_rating_leaderboards'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='rating',
+            name='trend_epoch',
+            field=models.IntegerField(default=0, verbose_name='Trending Epoch'),
+        ),
+        migrations.AddField(
+            model_name='rating',
+            name='trend_mass',
+            field=models.FloatField(default=0.0, verbose_name='Decayed Votes (computed)'),
+        ),
+        migrations.AddField(
+            model_name='rating',
+            name='trend_sum',
+            field=models.FloatField(default=0.0, verbose_name='Decayed Rating Sum (computed)'),
+        ),
+        migrations.AlterIndexTogether(
+            name='rating',
+            index_together=set([('target_ct', 'score'), ('target_ct', 'trend_sum')]),
+        ),
+    ]
@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+def get_histogram_field(value):
+    # frozen copy of rabidratings.aggregates.get_histogram_field
+    if not 0 < value <= 100:
+        return None
+    return 'votes_%s' % min((20, 40, 60, 80, 100), key=lambda v: (abs(v - value), v))
+
+
+def fill_histograms(apps, schema_editor, batch_size=1000):
+    '''
+    Count existing votes of every rating in its histogram, so changing them
+    later does not take them away from empty buckets
+    '''
+    Rating = apps.get_model('rabidratings', 'Rating')
+    RatingEvent = apps.get_model('rabidratings', 'RatingEvent')
+    db_alias = schema_editor.connection.alias
+    last_pk = 0
+    while True:
+        batch = list(Rating.objects.using(db_alias).filter(pk__gt=last_pk).order_by('pk')
+                     .values_list('pk', 'target_ct_id', 'target_id')[:batch_size])
+        if not batch:
+            return
+        last_pk = batch[-1][0]
+        ids_by_ct = {}
+        for pk, ct_id, obj_id in batch:
+            ids_by_ct.setdefault(ct_id, set()).add(obj_id)
+        q = models.Q(pk__in=[])
+        for ct_id, ids in ids_by_ct.items():
+            q |= models.Q(target_ct=ct_id, target_id__in=ids)
+        histograms = {}
+        for t in (RatingEvent.objects.using(db_alias).filter(q).filter(value__gt=0)
+                  .values('target_ct', 'target_id', 'value').annotate(votes=models.Count('pk')).order_by()):
+            field = get_histogram_field(t['value'])
+            if field is not None:
+                histogram = histograms.setdefault((t['target_ct'], t['target_id']), {})
+                histogram[field] = histogram.get(field, 0) + t['votes']
+        for pk, ct_id, obj_id in batch:
+            if (ct_id, obj_id) in histograms:
+                Rating.objects.using(db_alias).filter(pk=pk).update(**histograms[(ct_id, obj_id)])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rabidratings', '0006_rating_trend'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='rating',
+            name='votes_100',
+            field=models.PositiveIntegerField(default=0, verbose_name='Votes for 5 stars (computed)'),
+        ),
+        migrations.AddField(
+            model_name='rating',
+            name='votes_20',
+            field=models.PositiveIntegerField(default=0, verbose_name='Votes for 1 star (computed)'),
+        ),
+        migrations.AddField(
+            model_name='rating',
+            name='votes_40',
+            field=models.PositiveIntegerField(default=0, verbose_name='Votes for 2 stars (computed)'),
+        ),
+        migrations.AddField(
+            model_name='rating',
+            name='votes_60',
+            field=models.PositiveIntegerField(default=0, verbose_name='Votes for 3 stars (computed)'),
+        ),
+        migrations.AddField(
+            model_name='rating',
+            name='votes_80',
+            field=models.PositiveIntegerField(default=0, verbose_name='Votes for 4 stars (computed)'),
+        ),
+        migrations.AddField(
+            model_name='ratingshard',
+            name='votes_100',
+            field=models.IntegerField(default=0, verbose_name='Votes for 5 stars'),
+        ),
+        migrations.AddField(
+            model_name='ratingshard',
+            name='votes_20',
+            field=models.IntegerField(default=0, verbose_name='Votes for 1 star'),
+        ),
+        migrations.AddField(
+            model_name='ratingshard',
+            name='votes_40',
+            field=models.IntegerField(default=0, verbose_name='Votes for 2 stars'),
+        ),
+        migrations.AddField(
+            model_name='ratingshard',
+            name='votes_60',
+            field=models.IntegerField(default=0, verbose_name='Votes for 3 stars'),
+        ),
+        migrations.AddField(
+            model_name='ratingshard',
+            name='votes_80',
+            field=models.IntegerField(default=0, verbose_name='Votes for 4 stars'),
+        ),
+        migrations.RunPython(fill_histograms, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contenttypes', '__latest__'),
+        ('rabidratings', '0007_rating_histogram'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RatingDay',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('target_id', models.IntegerField(verbose_name='Target ID')),
+                ('day', models.DateField(verbose_name='Day')),
+                ('total_rating', models.IntegerField(default=0, verbose_name='Total Rating Sum')),
+                ('total_votes', models.IntegerField(default=0, verbose_name='Total Votes')),
+                ('target_ct', models.ForeignKey(verbose_name='Target content type', to='contenttypes.ContentType')),
+            ],
+            options={
+                'verbose_name': 'Rating day',
+                'verbose_name_plural': 'Rating days',
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='ratingday',
+            unique_together=set([('target_ct', 'target_id', 'day')]),
+        ),
+    ]
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from decimal import Decimal
+
+from django.db import migrations, models
+from django.utils.crypto import salted_hmac
+
+from rabidratings import conf
+
+
+def get_voter_fingerprint(ip):
+    # frozen copy of rabidratings.utils.get_voter_fingerprint without cookie
+    return salted_hmac('rabidratings.voter', '%s|' % (ip or '')).hexdigest()[:32]
+
+
+def get_histogram_field(value):
+    # frozen copy of rabidratings.aggregates.get_histogram_field
+    if not 0 < value <= 100:
+        return None
+    return 'votes_%s' % min((20, 40, 60, 80, 100), key=lambda v: (abs(v - value), v))
+
+
+def fill_voter_fingerprints(apps, schema_editor):
+    '''
+    Fingerprint votes of anonymous voters by their ip and delete
+    their duplicate votes for the same object (the latest one is kept)
+    taking them away from counters of the rating
+    '''
+    RatingEvent = apps.get_model('rabidratings', 'RatingEvent')
+    db_alias = schema_editor.connection.alias
+    events = RatingEvent.objects.using(db_alias).filter(user__isnull=True).order_by('-updated', '-pk')
+    seen = set()
+    duplicates = []
+    deleted = {}
+    for pk, ct_id, obj_id, ip, value in events.values_list(
+            'pk', 'target_ct_id', 'target_id', 'ip', 'value').iterator():
+        voter_fp = get_voter_fingerprint(ip)
+        key = (ct_id, obj_id, voter_fp)
+        if key in seen:
+            duplicates.append(pk)
+            if value > 0:
+                deleted.setdefault((ct_id, obj_id), []).append(value)
+            continue
+        seen.add(key)
+        RatingEvent.objects.using(db_alias).filter(pk=pk).update(voter_fp=voter_fp)
+    for i in range(0, len(duplicates), 1000):
+        RatingEvent.objects.using(db_alias).filter(pk__in=duplicates[i:i + 1000]).delete()
+    fix_ratings(apps, db_alias, deleted)
+
+
+def fix_ratings(apps, db_alias, deleted):
+    '''
+    Take values of deleted votes (lists keyed by target) away from counters
+    of ratings; counters of sharded ratings are fixed by rebuild_ratings
+    '''
+    Rating = apps.get_model('rabidratings', 'Rating')
+    prior_votes = float(conf.RABIDRATINGS_SCORE_PRIOR_VOTES)
+    for (ct_id, obj_id), values in deleted.items():
+        for rating in Rating.objects.using(db_alias).filter(target_ct_id=ct_id, target_id=obj_id):
+            rating.total_rating = max(rating.total_rating - sum(values), 0)
+            rating.total_votes = max(rating.total_votes - len(values), 0)
+            for value in values:
+                field = get_histogram_field(value)
+                if field is not None:
+                    setattr(rating, field, max(getattr(rating, field) - 1, 0))
+            if rating.total_votes:
+                rating.avg_rating = Decimal(str(float(rating.total_rating) / rating.total_votes / 20.0))
+                rating.percent = float(rating.avg_rating) / 5.0
+                rating.score = ((prior_votes * conf.RABIDRATINGS_SCORE_PRIOR_MEAN + rating.total_rating / 20.0) /
+                                (prior_votes + rating.total_votes))
+            else:
+                rating.avg_rating, rating.percent, rating.score = Decimal('0.0'), 0.0, 0.0
+            rating.save()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rabidratings', '0008_rating_days'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='ratingevent',
+            name='voter_fp',
+            field=models.CharField(verbose_name='Voter fingerprint', max_length=32, null=True, editable=False, blank=True),
+        ),
+        migrations.RunPython(fill_voter_fingerprints, migrations.RunPython.noop),
+        migrations.AlterUniqueTogether(
+            name='ratingevent',
+            unique_together=set([('target_ct', 'target_id', 'user'), ('target_ct', 'target_id', 'voter_fp')]),
+        ),
+    ]
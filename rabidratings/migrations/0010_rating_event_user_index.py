@@ -0,0 +1,18 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rabidratings', '0009_rating_event_voter_fp'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='ratingevent',
+            index_together=set([('user', 'updated')]),
+        ),
+    ]
@@ -15,6 +15,7 @@
 # You should have received a copy of the GNU General Public License
 # along with Django-Rabid-Ratings.  If not, see <http://www.gnu.org/licenses/>.
 #
+import calendar
 from decimal import Decimal
 
 from django.db import connection, models
@@ -34,11 +35,27 @@ except ImportError:
     now = datetime.now
 
 from rabidratings import conf
-from rabidratings.utils import get_natural_key
-from rabidratings.utils.transaction import atomic
+from rabidratings.utils import get_natural_key, get_voter_fingerprint
+from rabidratings.utils.transaction import atomic, on_commit
+from rabidratings.aggregates import (
+                                     HISTOGRAM_FIELDS,
+                                     HISTOGRAM_VALUES,
+                                     RatingDelta,
+                                     get_score,
+                                     get_score_sql,
+                                     get_trend_epoch,
+                                     get_trend_weight,
+                                     )
+from rabidratings.cache import get_rating_cache, get_voter_key
 from rabidratings.managers import (
-                                   _get_subclasses,
+                                   get_subclasses_ct_ids,
+                                   get_shards_count,
+                                   get_leaderboard_size,
                                    BaseRatingManager,
+                                   RatingEventManager,
+                                   RatingDayManager,
+                                   RatingLeaderManager,
+                                   RatingManager,
                                    )
 
 qn = connection.ops.quote_name
@@ -93,14 +110,29 @@ class Rating(BaseRating):
 
     Always use the following to get the Rating object:
        rating, created = Rating.objects.get_or_create(target_ct=ct, target_id=obj_id)
+
+    Votes should be applied by ``Rating.objects.apply_delta`` which updates
+    counters in database by single statement without reading the row.
     """
     total_rating = models.PositiveIntegerField(verbose_name=_('Total Rating Sum (computed)'), default=0)
     total_votes = models.PositiveIntegerField(verbose_name=_('Total Votes (computed)'), default=0)
     avg_rating = models.DecimalField(verbose_name=_('Average Rating (computed)'), default=Decimal("0.0"), max_digits=2, decimal_places=1)
     percent = models.FloatField(verbose_name=_('Percent Fill (computed)'), default=0.0)
+    score = models.FloatField(verbose_name=_('Ranking Score (computed)'), default=0.0)
+    trend_mass = models.FloatField(verbose_name=_('Decayed Votes (computed)'), default=0.0)
+    trend_sum = models.FloatField(verbose_name=_('Decayed Rating Sum (computed)'), default=0.0)
+    trend_epoch = models.IntegerField(verbose_name=_('Trending Epoch'), default=0)
+    votes_20 = models.PositiveIntegerField(verbose_name=_('Votes for 1 star (computed)'), default=0)
+    votes_40 = models.PositiveIntegerField(verbose_name=_('Votes for 2 stars (computed)'), default=0)
+    votes_60 = models.PositiveIntegerField(verbose_name=_('Votes for 3 stars (computed)'), default=0)
+    votes_80 = models.PositiveIntegerField(verbose_name=_('Votes for 4 stars (computed)'), default=0)
+    votes_100 = models.PositiveIntegerField(verbose_name=_('Votes for 5 stars (computed)'), default=0)
+
+    objects = RatingManager()
 
     class Meta:
         unique_together = (('target_ct', 'target_id'),)
+        index_together = (('target_ct', 'score'), ('target_ct', 'trend_sum'))
         verbose_name = _('Rating')
         verbose_name_plural = _('Ratings')
 
@@ -118,6 +150,17 @@ class Rating(BaseRating):
 
         super(Rating, self).save(*args, **kwargs)
 
+        if get_leaderboard_size(self.target_ct_id):
+            RatingLeader.objects.update_for(self)
+
+        rating_cache = get_rating_cache()
+        if rating_cache is not None:
+            if get_shards_count(self.target_ct_id):
+                # saved counters do not include shards
+                on_commit(lambda: rating_cache.delete(self.key), using=self._state.db)
+            else:
+                on_commit(lambda: rating_cache.set(self), using=self._state.db)
+
     def add_rating(self, event):
         """
         Adds the given RatingEvent to the key.
@@ -132,32 +175,157 @@ class Rating(BaseRating):
         2. rating.add_rating(event)
         3. rating.save()
 
+        Use ``Rating.objects.apply_delta`` to avoid this read-modify-write cycle.
         """
+        self.apply_delta(RatingDelta.for_event(event))
 
-        if getattr(event, 'is_changing', False) and event.old_value > 0:
-            # the user decided to change their vote, so take away the old value first
-            self.total_rating = self.total_rating - event.old_value
-            self.total_votes -= 1
-
-        self.total_rating = self.total_rating + event.value
-        self.total_votes += 1
+    def apply_delta(self, delta, trend=True):
+        """
+        Applies given RatingDelta to the counters in memory.
+        Decayed trending values are updated too unless trend is False.
+        """
+        self.total_rating += delta.total_rating
+        self.total_votes += delta.total_votes
+        for field, votes in delta.histogram.items():
+            setattr(self, field, getattr(self, field) + votes)
+        self.score = get_score(self.total_rating, self.total_votes)
+        if trend:
+            self.apply_trend(delta)
+
+        if not self.total_votes:
+            self.avg_rating = Decimal("0.0")
+            self.percent = 0.0
+            return
 
         self.avg_rating = Decimal(str(float(self.total_rating) / float(self.total_votes) / 20.0))
         self.percent = float(self.avg_rating) / 5.0
 
+    @property
+    def histogram(self):
+        """
+        Returns list of dicts (value, stars, verbal value, votes, percent
+        of all votes) for every value in RATING_VERBAL_VALUES.
+        """
+        histogram = []
+        for value, field in zip(HISTOGRAM_VALUES, HISTOGRAM_FIELDS):
+            votes = getattr(self, field)
+            histogram.append({
+                'value': value,
+                'stars': value // 20,
+                'verbal': conf.RATING_VERBAL_VALUES[value],
+                'votes': votes,
+                'percent': 100.0 * votes / self.total_votes if self.total_votes else 0.0,
+            })
+        return histogram
+
+    @property
+    def version(self):
+        """
+        Returns version of public values of the rating (for caching
+        of rendered rating): time of the last update and the counters,
+        which change without the time when shards are folded.
+        """
+        updated = calendar.timegm(self.updated.utctimetuple()) if self.updated else 0
+        return '%s-%s-%s' % (updated, self.total_votes, self.total_rating)
+
+    def apply_trend(self, delta, timestamp=None):
+        """
+        Adds votes of given RatingDelta made at timestamp (now by default)
+        to decayed trending values, rebasing them to the current epoch first.
+        """
+        epoch = get_trend_epoch(timestamp)
+        if self.trend_epoch != epoch:
+            factor = 2.0 ** ((self.trend_epoch - epoch) / float(conf.RABIDRATINGS_TRENDING_HALF_LIFE))
+            self.trend_mass *= factor
+            self.trend_sum *= factor
+            self.trend_epoch = epoch
+        weight = get_trend_weight(timestamp, epoch)
+        self.trend_mass += weight * delta.total_votes
+        self.trend_sum = max(self.trend_sum + weight * delta.total_rating, 0.0)
+
+
+class RatingShard(models.Model):
+    """
+    Part of rating counters for content types with many concurrent votes
+    (see RABIDRATINGS_RATING_SHARDS). Shards are folded into Rating
+    by compact_rating_shards command.
+    """
+    target_ct = models.ForeignKey(ContentType, verbose_name=_('Target content type'))
+    target_id = models.IntegerField(_('Target ID'))
+    shard = models.PositiveSmallIntegerField(_('Shard'))
+    total_rating = models.IntegerField(verbose_name=_('Total Rating Sum'), default=0)
+    total_votes = models.IntegerField(verbose_name=_('Total Votes'), default=0)
+    votes_20 = models.IntegerField(verbose_name=_('Votes for 1 star'), default=0)
+    votes_40 = models.IntegerField(verbose_name=_('Votes for 2 stars'), default=0)
+    votes_60 = models.IntegerField(verbose_name=_('Votes for 3 stars'), default=0)
+    votes_80 = models.IntegerField(verbose_name=_('Votes for 4 stars'), default=0)
+    votes_100 = models.IntegerField(verbose_name=_('Votes for 5 stars'), default=0)
+
+    class Meta:
+        unique_together = (('target_ct', 'target_id', 'shard'),)
+        verbose_name = _('Rating shard')
+        verbose_name_plural = _('Rating shards')
+
+
+class RatingLeader(models.Model):
+    """
+    Rating of one of top rated objects of content type by ranking score
+    (see RABIDRATINGS_LEADERBOARDS), so best rated objects are read
+    without ordering all ratings. Used by ``Rating.objects.top_rated``.
+    """
+    target_ct = models.ForeignKey(ContentType, verbose_name=_('Target content type'))
+    target_id = models.IntegerField(_('Target ID'))
+    score = models.FloatField(verbose_name=_('Ranking Score'), default=0.0)
+    avg_rating = models.DecimalField(verbose_name=_('Average Rating'), default=Decimal("0.0"), max_digits=2, decimal_places=1)
+    total_votes = models.PositiveIntegerField(verbose_name=_('Total Votes'), default=0)
+
+    objects = RatingLeaderManager()
+
+    class Meta:
+        unique_together = (('target_ct', 'target_id'),)
+        index_together = (('target_ct', 'score'),)
+        verbose_name = _('Rating leader')
+        verbose_name_plural = _('Rating leaders')
+
+
+class RatingDay(models.Model):
+    """
+    Daily rollup of votes for windowed averages and charts - number and sum
+    of votes by day they were first cast (changed vote stays in its day).
+    See ``RatingDay.objects.get_window`` and ``get_daily``.
+    """
+    target_ct = models.ForeignKey(ContentType, verbose_name=_('Target content type'))
+    target_id = models.IntegerField(_('Target ID'))
+    day = models.DateField(_('Day'))
+    total_rating = models.IntegerField(verbose_name=_('Total Rating Sum'), default=0)
+    total_votes = models.IntegerField(verbose_name=_('Total Votes'), default=0)
+
+    objects = RatingDayManager()
+
+    class Meta:
+        unique_together = (('target_ct', 'target_id', 'day'),)
+        verbose_name = _('Rating day')
+        verbose_name_plural = _('Rating days')
+
 
 class RatingEvent(BaseRating):
     """
     Each time someone votes, the vote will be recorded by ip address.
     Yes, this is not optimal for proxies, but good enough because if you
     are behind a proxy you should be working, and not rating stuff.
+    Anonymous voters are identified by voter_fp, the fingerprint
+    of ip address and optional voter cookie (see get_voter_fingerprint).
     """
     ip = models.GenericIPAddressField(_('IP address'), null=True)
+    voter_fp = models.CharField(_('Voter fingerprint'), max_length=32, null=True, blank=True, editable=False)
     user = models.ForeignKey(User, db_index=True, blank=True, null=True, verbose_name=_('User who has rated'))
     value = models.PositiveIntegerField(_('Value'), default=0)
 
+    objects = RatingEventManager()
+
     class Meta:
-        unique_together = (('target_ct', 'target_id', 'user',))
+        unique_together = (('target_ct', 'target_id', 'user',), ('target_ct', 'target_id', 'voter_fp'))
+        index_together = (('user', 'updated'),)
         verbose_name = _('Rating event')
         verbose_name_plural = _('Rating events')
 
@@ -171,19 +339,21 @@ class RatingEvent(BaseRating):
         except ValidationError, e:
             raise IntegrityError(e.messages)
 
+        if self.user_id is None and self.voter_fp is None and self.ip:
+            self.voter_fp = get_voter_fingerprint(self.ip)
+
         with atomic():
             if self.value > 0:
-                rating, created = Rating.objects.get_or_create(False, target_ct=self.target_ct, target_id=self.target_id)
-
                 #redundant check for save triggered outside of view (view's save saves 1 query)
                 if self.pk and getattr(self, 'is_changing', None) is None:
                     self.is_changing = True
                     self.old_value = self._default_manager.get(pk=self.pk).value
 
-                rating.add_rating(self)
-                rating.save()
+                Rating.objects.apply_delta(self.target_ct_id, self.target_id, RatingDelta.for_event(self),
+                                           voter=self.user_id or self.voter_fp)
                 self.old_value = self.value
             super(RatingEvent, self).save(*args, **kwargs)
+            RatingEvent.objects.invalidate_voters([get_voter_key(user_id=self.user_id, voter_fp=self.voter_fp)])
 
     @property
     def stars_value(self):
@@ -203,33 +373,114 @@ class RatingEvent(BaseRating):
             return ""
 
 
-def by_rating(self):
+def _get_rating_sql(model):
     '''
-    Added order by rating to queryset for using in target API
+    Return tuple (rating table, condition joining ratings to model table,
+    dict of SQL of rating values by name: avg_rating, total_votes, score
+    and trend) for objects of model and its subclasses
     '''
-    # TODO: use better way to get objects by rating (and maybe use left outer join)
-    opts = self.model._meta
+    opts = model._meta
     target_id_field = '%s.%s' % (qn(opts.db_table), qn(opts.pk.column))
 
-    str_cts = "(%s)" % (", ".join([str(ContentType.objects.get_for_model(m).id) for m in _get_subclasses(self.model)]),)
+    ct_ids = get_subclasses_ct_ids(model)
+    str_cts = "(%s)" % (", ".join([str(ct_id) for ct_id in ct_ids]),)
     rating_table = qn(Rating._meta.db_table)
-    order_by = ['-%s.avg_rating' % rating_table, '-%s.total_votes' % rating_table]
-    order_by.extend(self.query.order_by[:])
-    return self.extra(
-        tables=['%s' % rating_table],
-        where=['''%(rating_table)s.target_ct_id IN %(cts)s
+    where = '''%(rating_table)s.target_ct_id IN %(cts)s
                     and %(rating_table)s.target_id = %(target_id)s''' % {
                                                                          'rating_table': rating_table,
                                                                          'cts': str_cts,
                                                                          'target_id': target_id_field,
-                                                                         }],
+                                                                         }
+    values = {
+              'avg_rating': '%s.avg_rating' % rating_table,
+              'total_votes': '%s.total_votes' % rating_table,
+              'score': '%s.score' % rating_table,
+              'trend': '%s.trend_sum' % rating_table,
+              }
+    if any(get_shards_count(ct_id) for ct_id in ct_ids):
+        # order by totals folded with not yet compacted shards
+        shard_sum = '''COALESCE((SELECT SUM(%(shard_table)s.%%(column)s) FROM %(shard_table)s
+                        WHERE %(shard_table)s.target_ct_id = %(rating_table)s.target_ct_id
+                        AND %(shard_table)s.target_id = %(rating_table)s.target_id), 0)''' % {
+                                                                                              'shard_table': qn(RatingShard._meta.db_table),
+                                                                                              'rating_table': rating_table,
+                                                                                              }
+        total_rating = '%s.total_rating + %s' % (rating_table, shard_sum % {'column': 'total_rating'})
+        total_votes = '(%s.total_votes + %s)' % (rating_table, shard_sum % {'column': 'total_votes'})
+        values['total_votes'] = total_votes
+        # in stars as the stored avg_rating
+        values['avg_rating'] = '(%s) / 20.0 / CASE WHEN %s > 0 THEN %s ELSE 1 END' % (total_rating, total_votes, total_votes)
+        values['score'] = get_score_sql(total_rating, total_votes)
+    return rating_table, where, values
+
+
+def get_rating_subqueries(model):
+    '''
+    Return dict of SQL of rating values (see _get_rating_sql) for objects
+    of model as correlated subqueries, so objects without rating row
+    are not dropped (as by LEFT OUTER JOIN) but get zero values
+    '''
+    rating_table, where, values = _get_rating_sql(model)
+    rating_value = 'COALESCE((SELECT MAX(%%s) FROM %s WHERE %s), 0)' % (rating_table, where)
+    return dict((name, rating_value % value) for name, value in values.items())
+
+
+def get_rating_values_sql(model):
+    '''
+    Return tuple (extra tables, extra where, dict of SQL of rating values
+    by name) for selecting rating values of objects of model - by join
+    of ratings or by subqueries if RABIDRATINGS_LAZY_RATINGS is set
+    '''
+    if conf.RABIDRATINGS_LAZY_RATINGS:
+        return [], [], get_rating_subqueries(model)
+    rating_table, where, values = _get_rating_sql(model)
+    return [rating_table], [where], values
+
+
+def _order_by_rating_values(qs, order_by):
+    '''
+    Return queryset ordered by given rating values (names in _get_rating_sql,
+    selected with rabidratings_ prefix) before its previous ordering
+    '''
+    order_by = ['-rabidratings_%s' % name for name in order_by]
+    order_by.extend(qs.query.order_by[:])
+
+    tables, where, values = get_rating_values_sql(qs.model)
+    select = dict(('rabidratings_%s' % name, value) for name, value in values.items())
+    return qs.extra(
+        select=select,
+        tables=tables,
+        where=where,
         params=[],
         order_by=order_by
     )
 
+
+def by_rating(self, by_score=False):
+    '''
+    Added order by rating to queryset for using in target API
+    (objects without rating are dropped unless RABIDRATINGS_LAZY_RATINGS is set,
+    see RatingQuerySetMixin for ordering keeping them).
+    If by_score is True, objects are ordered by ranking score,
+    which takes the number of votes into account.
+    '''
+    if by_score:
+        return _order_by_rating_values(self, ['score', 'total_votes'])
+    return _order_by_rating_values(self, ['avg_rating', 'total_votes'])
+
 QuerySet.by_rating = by_rating
 
 
+def by_trending(self):
+    '''
+    Added order by trending (sum of recent votes decayed by
+    RABIDRATINGS_TRENDING_HALF_LIFE) to queryset for using in target API
+    '''
+    return _order_by_rating_values(self, ['trend', 'score'])
+
+QuerySet.by_trending = by_trending
+
+
 def create_rating_for_cts(sender, **kwargs):
     '''
     Create ratings for creating objects
@@ -0,0 +1,171 @@
+import base64
+import json
+
+from django.core.exceptions import ValidationError
+from django.core.paginator import InvalidPage
+from django.db import connections
+from django.db.models import Q
+from django.http import Http404
+from django.utils.dateparse import parse_datetime
+
+from rabidratings.models import RatingEvent, get_rating_values_sql
+
+# rating values (names in rabidratings.models._get_rating_sql)
+# the pages are ordered by, in descending order, before primary key
+ORDERING_KEYS = {
+    False: ('avg_rating', 'total_votes'),
+    True: ('score', 'total_votes'),
+}
+
+
+def encode_cursor(values):
+    return base64.urlsafe_b64encode(json.dumps(values)).rstrip('=')
+
+
+def decode_cursor(cursor, length=3):
+    try:
+        values = json.loads(base64.urlsafe_b64decode(str(cursor) + '=' * (-len(cursor) % 4)))
+    except (TypeError, ValueError, UnicodeEncodeError):
+        raise InvalidPage('Invalid cursor')
+    if not isinstance(values, list) or len(values) != length:
+        raise InvalidPage('Invalid cursor')
+    return values
+
+
+class KeysetPage(object):
+
+    def __init__(self, object_list, cursor, next_cursor):
+        self.object_list = object_list
+        self.cursor = cursor
+        self.next_cursor = next_cursor
+
+    def __repr__(self):
+        return '<Page after %s>' % (self.cursor or 'start')
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __getitem__(self, index):
+        return self.object_list[index]
+
+    def has_next(self):
+        return self.next_cursor is not None
+
+
+class KeysetPaginator(object):
+    """
+    Paginator of objects ordered by rating (as by QuerySet.by_rating)
+    and primary key. Pages are addressed by opaque cursor of the last object
+    of previous page and read by seek (WHERE values < cursor values)
+    instead of OFFSET, so deep pages cost the same as the first one.
+
+        paginator = KeysetPaginator(Article.objects.all(), 20)
+        page = paginator.page(request.GET.get('cursor'))
+        ... page.object_list, page.next_cursor
+
+    Previous ordering of the queryset is replaced.
+    """
+
+    def __init__(self, object_list, per_page, by_score=False):
+        self.object_list = object_list
+        self.per_page = int(per_page)
+        self.by_score = by_score
+
+    def page(self, cursor=None):
+        """
+        Returns KeysetPage following the cursor (the first page if cursor
+        is empty). Raises InvalidPage for malformed cursor.
+        """
+        qs = self.object_list.order_by('-pk').by_rating(by_score=self.by_score)
+        if cursor:
+            qs = self._seek(qs, decode_cursor(cursor))
+
+        objects = list(qs[:self.per_page + 1])
+        next_cursor = None
+        if len(objects) > self.per_page:
+            objects = objects[:self.per_page]
+            last = objects[-1]
+            next_cursor = encode_cursor([float(getattr(last, 'rabidratings_%s' % name) or 0)
+                                         for name in ORDERING_KEYS[self.by_score]] + [last.pk])
+        return KeysetPage(objects, cursor or None, next_cursor)
+
+    def _seek(self, qs, values):
+        opts = qs.model._meta
+        qn = connections[qs.db].ops.quote_name
+        tables, where, rating_values = get_rating_values_sql(qs.model)
+        first, second = [rating_values[name] for name in ORDERING_KEYS[self.by_score]]
+        pk = '%s.%s' % (qn(opts.db_table), qn(opts.pk.column))
+        seek = '(%(first)s < %%s OR (%(first)s = %%s AND (%(second)s < %%s OR (%(second)s = %%s AND %(pk)s < %%s))))' % {
+            'first': first,
+            'second': second,
+            'pk': pk,
+        }
+        try:
+            first_value, second_value = float(values[0]), float(values[1])
+            pk_value = opts.pk.to_python(values[2])
+        except (TypeError, ValueError, ValidationError):
+            raise InvalidPage('Invalid cursor')
+        return qs.extra(where=[seek], params=[first_value, first_value, second_value, second_value, pk_value])
+
+
+def get_keyset_page(request, object_list, per_page, by_score=False, cursor_param='cursor'):
+    '''
+    Return KeysetPage of objects ordered by rating for the cursor
+    in request's GET (Http404 is raised for invalid cursor)
+    '''
+    paginator = KeysetPaginator(object_list, per_page, by_score=by_score)
+    try:
+        return paginator.page(request.GET.get(cursor_param))
+    except InvalidPage:
+        raise Http404('Invalid cursor')
+
+
+class UserVotesPaginator(object):
+    """
+    Paginator of votes of user (RatingEvent.objects.for_user), the newest
+    first, addressed by cursor of the last vote of previous page like
+    KeysetPaginator. Every page is read by one query using the (user, updated)
+    index and one query per content type of rated objects.
+    """
+
+    def __init__(self, user, per_page):
+        self.user = user
+        self.per_page = int(per_page)
+
+    def page(self, cursor=None):
+        """
+        Returns KeysetPage of votes following the cursor (the first page
+        if cursor is empty). Raises InvalidPage for malformed cursor.
+        """
+        qs = RatingEvent.objects.for_user(self.user)
+        if cursor:
+            updated, pk = decode_cursor(cursor, 2)
+            try:
+                updated, pk = parse_datetime(updated), int(pk)
+            except (TypeError, ValueError):
+                raise InvalidPage('Invalid cursor')
+            if updated is None:
+                raise InvalidPage('Invalid cursor')
+            qs = qs.filter(Q(updated__lt=updated) | Q(updated=updated, pk__lt=pk))
+
+        events = list(qs[:self.per_page + 1])
+        next_cursor = None
+        if len(events) > self.per_page:
+            events = events[:self.per_page]
+            next_cursor = encode_cursor([events[-1].updated.isoformat(), events[-1].pk])
+        return KeysetPage(events, cursor or None, next_cursor)
+
+
+def get_user_votes_page(request, user, per_page, cursor_param='cursor'):
+    '''
+    Return KeysetPage of votes of user, the newest first, for the cursor
+    in request's GET (Http404 is raised for invalid cursor)
+    '''
+    paginator = UserVotesPaginator(user, per_page)
+    try:
+        return paginator.page(request.GET.get(cursor_param))
+    except InvalidPage:
+        raise Http404('Invalid cursor')
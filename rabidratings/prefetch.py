@@ -0,0 +1,112 @@
+from django.contrib.contenttypes.models import ContentType
+
+from rabidratings import conf
+from rabidratings.cache import get_rating_cache, get_voter_cache, get_voter_key
+from rabidratings.managers import get_targets_q
+from rabidratings.models import Rating, RatingEvent
+from rabidratings.utils import get_voter_lookup
+
+
+def get_rating_key(obj):
+    ct = ContentType.objects.get_for_model(obj.__class__)
+    return "%s_%s" % (ct.id, obj.pk)
+
+
+def get_prefetched_ratings(request):
+    '''
+    Return dict of (rating, voter's event) keyed by rating key
+    loaded by prefetch_ratings for the request
+    '''
+    if not hasattr(request, '_rabidratings_prefetched'):
+        request._rabidratings_prefetched = {}
+    return request._rabidratings_prefetched
+
+
+def get_voter_events(keys, request):
+    '''
+    Return dict of votes (RatingEvent or None if not voted) of request's voter
+    keyed by rating key, read through the voter cache if RABIDRATINGS_VOTER_CACHE is set
+    '''
+    lookup = get_voter_lookup(request)
+    voter_cache = get_voter_cache()
+    events = {}
+    if voter_cache is not None:
+        voter_key = get_voter_key(**lookup)
+        version = voter_cache.get_version(voter_key)
+        events = voter_cache.get_many(voter_key, keys, version)
+    missing = [key for key in keys if key not in events]
+    if missing:
+        q = get_targets_q(Rating.split_key(key) for key in missing)
+        loaded = dict((key, None) for key in missing)
+        loaded.update((e.key, e) for e in RatingEvent.objects.filter(q, **lookup))
+        if voter_cache is not None:
+            voter_cache.set_many(voter_key, loaded, version)
+        events.update(loaded)
+    return events
+
+
+def get_voter_event(obj, request):
+    '''
+    Return vote of request's voter for the object (None if not voted)
+    read through the voter cache if RABIDRATINGS_VOTER_CACHE is set
+    '''
+    key = get_rating_key(obj)
+    lookup = get_voter_lookup(request)
+    voter_cache = get_voter_cache()
+    if voter_cache is not None:
+        voter_key = get_voter_key(**lookup)
+        version = voter_cache.get_version(voter_key)
+        cached = voter_cache.get_many(voter_key, [key], version)
+        if key in cached:
+            return cached[key]
+    try:
+        event = RatingEvent.objects.get_for_object(obj, False, **lookup)
+    except RatingEvent.DoesNotExist:
+        event = None
+    if voter_cache is not None:
+        voter_cache.set_many(voter_key, {key: event}, version)
+    return event
+
+
+def get_ratings(keys):
+    '''
+    Return dict of ratings keyed by rating key loaded by single query
+    (read through the cache if RABIDRATINGS_CACHE is set); rating without
+    row is omitted unless RABIDRATINGS_LAZY_RATINGS is set
+    '''
+    rating_cache = get_rating_cache()
+    ratings = rating_cache.get_many(keys) if rating_cache is not None else {}
+    missing = [key for key in keys if key not in ratings]
+    if missing:
+        q = get_targets_q(Rating.split_key(key) for key in missing)
+        loaded = dict((r.key, r) for r in Rating.objects.fold_shards_many(list(Rating.objects.filter(q))))
+        if conf.RABIDRATINGS_LAZY_RATINGS:
+            for key in missing:
+                if key not in loaded:
+                    ct_id, obj_id = Rating.split_key(key)
+                    loaded[key] = Rating(target_ct_id=int(ct_id), target_id=int(obj_id))
+        if rating_cache is not None:
+            rating_cache.set_many(loaded.values())
+        ratings.update(loaded)
+    return ratings
+
+
+def prefetch_ratings(objects, request):
+    '''
+    Load ratings of all objects and votes of request's voter for them
+    by two queries (ratings and votes are read through the caches if
+    RABIDRATINGS_CACHE and RABIDRATINGS_VOTER_CACHE are set) and store them
+    on request, so show_rating does not hit db for every object of the list.
+    Rating is None for object without rating row, event is None if voter
+    has not voted for the object.
+    '''
+    keys = [get_rating_key(obj) for obj in objects]
+    if not keys:
+        return {}
+    ratings = get_ratings(keys)
+    events = get_voter_events(keys, request)
+
+    prefetched = get_prefetched_ratings(request)
+    for key in keys:
+        prefetched[key] = (ratings.get(key), events.get(key))
+    return prefetched
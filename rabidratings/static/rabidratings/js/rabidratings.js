@@ -19,6 +19,9 @@ var RabidRatings = function (options) {
 	rr = {
 		options: {
 			url: null,
+			voterUrl: null, /* URL of votes of voter for ratings displayed by show_public_rating */
+			responseFormat: null, /* 'data' if vote response has only values and html is built here */
+			texts: {result: 'Rating from you', change: 'You can change the view', error: 'I can not save your rating, please try again later'},
 			leftMargin: 0,  /* The width in pixels of the margin before the stars. */
 			starWidth: 25,  /* The width in pixels of each star. */
 			starMargin: 1,  /* The width in pixels between each star. */
@@ -47,126 +50,174 @@ var RabidRatings = function (options) {
 
 			}, this));
 
-			$.each($('.rabidRatingUser'), $.proxy(function(index, el) {
-				if (($.browser.msie && $.browser.version=="6.0")) {
-					//Replaces all the fancy with a text description of the votes for IE6.
-					//If you want IE6 users to have something fancier to look at, add it here.
-					$('.ratingText', el).insertBefore(el);
-					$(el).remove();
-					return;
+			$.each($('.rabidRatingUser').not('.rabidRatingDeferred'), $.proxy(function(index, el) {
+				this.initUser(el, $('.rabidRatingStatistics')[index]);
+			}, this));
+
+			this.loadDeferred();
+		},
+
+		initUser: function(el, elStatistics) {
+			if (($.browser.msie && $.browser.version=="6.0")) {
+				//Replaces all the fancy with a text description of the votes for IE6.
+				//If you want IE6 users to have something fancier to look at, add it here.
+				$('.ratingText', el).insertBefore(el);
+				$(el).remove();
+				return;
+			}
+
+			//Does this if the browser is NOT IE6. IE6 users don't deserve fancy ratings. >:(
+			el.id = $(el).attr('id');
+			el.wrapper = $('.wrapper', el);
+			el.textEl = $('.ratingText', el);
+			el.offset = $(el).offset().left;
+			el.fill = $('.ratingFill', el);
+			el.starPercent = this.getStarPercentFromId(el.id);
+			el.ratableId   = this.getRatableId(el.id);
+			el.csrf = this.getCsrfProtection();
+			this.fillVote(el.starPercent, el);
+
+			// used for statistics part
+			if (elStatistics) {
+				elStatistics.fill = $('.ratingFill', elStatistics);
+				elStatistics.textEl = $('.ratingText', elStatistics);
+				elStatistics.totalVotes = $('.totalVotes', elStatistics);
+				elStatistics.ratingAvg = $('.ratingAvg', elStatistics.textEl);
+				elStatistics.starPercent = this.getStarPercentFromId(elStatistics.id);
+				this.fillVote(elStatistics.starPercent, elStatistics);
+			}
+			// end used for statistics part
+
+			el.currentFill = this.getFillPercent(el.starPercent);
+
+			el.mouseCrap = $.proxy(function(e) {
+				var fill = e.pageX - $(el).offset().left;
+				if (($.browser.msie && $.browser.version=="7.0")) {
+					// damn IE7 - hack - hardcoded position
+					fill = e.pageX - 820;
 				}
+				var fillPercent = this.getVotePercent(fill);
+				var step = (100 / this.options.scale) * this.options.snap;
+				var nextStep = Math.floor(fillPercent / step) + 1;
+				$(el.textEl).html(this.options.verbalValues[nextStep]);
+				this.fillVote(nextStep * step, el);
+			}, this);
+
+			el.mouseenter = function(e) {
+				el.oldText = $(el.textEl).html();
+				el.wrapper.mousemove(el.mouseCrap)
+			}
 
-				//Does this if the browser is NOT IE6. IE6 users don't deserve fancy ratings. >:(
-				el.id = $(el).attr('id');
-				el.wrapper = $('.wrapper', el);
-				el.textEl = $('.ratingText', el);
-				el.offset = $(el).offset().left;
-				el.fill = $('.ratingFill', el);
-				el.starPercent = this.getStarPercentFromId(el.id);
-				el.ratableId   = this.getRatableId(el.id);
-				el.csrf = this.getCsrfProtection();
-				this.fillVote(el.starPercent, el);
-
-				// used for statistics part
-				elStatistics = $('.rabidRatingStatistics')[index];
-				if (elStatistics) {
-					elStatistics.fill = $('.ratingFill', elStatistics);
-					elStatistics.textEl = $('.ratingText', elStatistics);
-					elStatistics.totalVotes = $('.totalVotes', elStatistics);
-					elStatistics.ratingAvg = $('.ratingAvg', elStatistics.textEl);
-					elStatistics.starPercent = this.getStarPercentFromId(elStatistics.id);
-					this.fillVote(elStatistics.starPercent, elStatistics);
+			el.mouseleave = function(e) {
+				$(el).unbind('mousemove', el.mouseCrap);
+				$(el.fill).css('width',el.currentFill);
+				$(el.textEl).html(el.oldText);
+			}
+
+			el.click = $.proxy(function(e) {
+				el.currentFill = el.newFill;
+				$(el.wrapper).unbind();
+				$(el.textEl).addClass('loading');
+				var votePercent = this.getVotePercent(el.newFill);
+				if (this.options.url != null) {
+					var data = {
+						vote: votePercent,
+						id: el.ratableId,
+						csrf_token: el.csrf,
+						csrf_name: 'csrfmiddlewaretoken',
+						csrf_xname: 'X-CSRFToken',
+						csrfmiddlewaretoken: el.csrf
+					};
+					if (this.options.responseFormat == 'data') data.format = 'data';
+					$.ajax({
+						beforeSend: function(xhrObj){
+							xhrObj.setRequestHeader('X-CSRFToken', el.csrf);
+						},
+						url: this.options.url,
+						type: 'POST',
+						dataType: "json",
+						success: el.setResultVaules,
+						error: $.proxy(function(xhr) {
+							var data = null;
+							try { data = $.parseJSON(xhr.responseText); } catch (e) {}
+							$(el.textEl).removeClass('loading');
+							el.showError(data && data.error || this.options.texts.error);
+						}, this),
+						data: data
+					});
 				}
-				// end used for statistics part
+			}, this)
 
-				el.currentFill = this.getFillPercent(el.starPercent);
+			this.bindPossibilityVote(el);
 
-				el.mouseCrap = $.proxy(function(e) {
-					var fill = e.pageX - $(el).offset().left;
-					if (($.browser.msie && $.browser.version=="7.0")) {
-						// damn IE7 - hack - hardcoded position
-						fill = e.pageX - 820;
+			el.setResultVaules = $.proxy(function(data) {
+				if (data.code == 200) {
+					if (data.stars_value !== undefined) {
+						// data response format, build the html
+						data.text = '<div>' + this.options.texts.result + ': <strong>' + data.stars_value + ' - ' +
+							$('<div/>').text(data.verbal_value).html() + '</strong>.<br />' + this.options.texts.change + '.</div>';
+						data.avg_rating = String(data.avg_rating);
 					}
-					var fillPercent = this.getVotePercent(fill);
-					var step = (100 / this.options.scale) * this.options.snap;
-					var nextStep = Math.floor(fillPercent / step) + 1;
-					$(el.textEl).html(this.options.verbalValues[nextStep]);
-					this.fillVote(nextStep * step, el);
-				}, this);
-
-				el.mouseenter = function(e) {
+					$(el.textEl).removeClass('loading');
+					$(el.textEl).html(data.text);
 					el.oldText = $(el.textEl).html();
-					el.wrapper.mousemove(el.mouseCrap)
+					// used for statistics part
+					if (elStatistics) {
+						$(elStatistics.totalVotes).html(data.total_votes);
+						$(elStatistics.ratingAvg).html(data.avg_rating);
+						var percent = this.computeStarPercent(data.avg_rating.replace(",", "."), this.options.scale)
+						this.fillVote(percent, elStatistics);
+					}
+					// end used for statistics part
+					this.bindPossibilityVote(el);
 				}
-
-				el.mouseleave = function(e) {
-					$(el).unbind('mousemove', el.mouseCrap);
-					$(el.fill).css('width',el.currentFill);
-					$(el.textEl).html(el.oldText);
+				else {
+					el.showError(data.error); return false;
 				}
+			}, this);
 
-				el.click = $.proxy(function(e) {
-					el.currentFill = el.newFill;
-					$(el.wrapper).unbind();
-					$(el.textEl).addClass('loading');
-					var votePercent = this.getVotePercent(el.newFill);
-					if (this.options.url != null) {
-						$.ajax({
-							beforeSend: function(xhrObj){
-								xhrObj.setRequestHeader('X-CSRFToken', el.csrf);
-							},
-							url: this.options.url,
-							type: 'POST',
-							dataType: "json",
-							success: el.setResultVaules,
-							data: {
-								vote: votePercent,
-								id: el.ratableId,
-								csrf_token: el.csrf,
-								csrf_name: 'csrfmiddlewaretoken',
-								csrf_xname: 'X-CSRFToken',
-								csrfmiddlewaretoken: el.csrf
-							}
-						});
-					}
-				}, this)
+			el.showError = $.proxy(function(error) {
+				$(el.textEl).addClass('ratingError');
+				oldTxt = $(el.textEl).html();
+				$(el.textEl).html(error);
+				$(el).delay(1000).queue($.proxy(function() {
+					$(el.textEl).html(oldTxt);
+					$(el.textEl).removeClass('ratingError');
+					this.bindPossibilityVote(el);
+					this.fillVote(el.starPercent, el);
+					if (elStatistics) this.fillVote(elStatistics.starPercent, elStatistics);
+				}, this));
+			}, this);
+		},
 
-				this.bindPossibilityVote(el);
-
-				el.setResultVaules = $.proxy(function(data) {
-					if (data.code == 200) {
-						$(el.textEl).removeClass('loading');
-						$(el.textEl).html(data.text);
-						el.oldText = $(el.textEl).html();
-						// used for statistics part
-						if (elStatistics) {
-							$(elStatistics.totalVotes).html(data.total_votes);
-							$(elStatistics.ratingAvg).html(data.avg_rating);
-							var percent = this.computeStarPercent(data.avg_rating.replace(",", "."), this.options.scale)
-							this.fillVote(percent, elStatistics);
+		loadDeferred: function() {
+			/* Fills voter's part of ratings displayed by show_public_rating
+			 * (the page itself may be cached) by one request for all of them. */
+			var deferred = $('.rabidRatingDeferred');
+			if (!deferred.length || this.options.voterUrl == null) return;
+			var keys = $.map(deferred, function(el) { return $(el).attr('data-rating-key'); });
+			$.ajax({
+				url: this.options.voterUrl,
+				type: 'GET',
+				dataType: 'json',
+				cache: false,
+				data: {ids: keys.join(',')},
+				success: $.proxy(function(data) {
+					$.each(deferred, $.proxy(function(index, el) {
+						var key = $(el).attr('data-rating-key');
+						var rating = data.ratings[key];
+						if (!rating) return;
+						if (!data.can_vote) {
+							$(el).replaceWith(rating.text);
+							return;
 						}
-						// end used for statistics part
-						this.bindPossibilityVote(el);
-					}
-					else {
-						el.showError(data.error); return false;
-					}
-				}, this);
-
-				el.showError = $.proxy(function(error) {
-					$(el.textEl).addClass('ratingError');
-					oldTxt = $(el.textEl).html();
-					$(el.textEl).html(error);
-					$(el).delay(1000).queue($.proxy(function() {
-						$(el.textEl).html(oldTxt);
-						$(el.textEl).removeClass('ratingError');
-						this.bindPossibilityVote(el);
-						this.fillVote(el.starPercent, el);
-						if (elStatistics) this.fillVote(elStatistics.starPercent, elStatistics);
+						$(el).attr('id', 'rabidRatingUser-' + key + '-' + rating.user_rating + '_' + this.options.scale);
+						$(el).removeClass('rabidRatingDeferred').show();
+						$('.ratingText', el).html(rating.text);
+						this.initUser(el, $('.rabidRatingStatistics[data-rating-key="' + key + '"]')[0]);
 					}, this));
-				}, this);
-
-			}, this));
+				}, this)
+			});
 		},
 
 		fillVote: function(percent, el) {
@@ -224,6 +275,9 @@ var RabidRatings = function (options) {
 $(function(e) {
 	var rating = new RabidRatings({
 		url: rabidratings_submit_url,
+		voterUrl: rabidratings_voter_url,
+		responseFormat: rabidratings_response_format,
+		texts: rabidratings_texts,
 		verbalValues: rabidratings_verbal_values
 	});
 });
@@ -17,47 +17,92 @@
 # along with Django-Rabid-Ratings.  If not, see <http://www.gnu.org/licenses/>.
 #
 from django import template
+from django.template.loader import render_to_string
+from django.utils.safestring import mark_safe
+from django.utils.translation import get_language
+
 from rabidratings import conf
 
 from rabidratings.conf import RABIDRATINGS_STATIC_URL
-from rabidratings.models import Rating, RatingEvent
+from rabidratings.models import Rating
+from rabidratings.prefetch import get_prefetched_ratings, get_rating_key, get_voter_event, prefetch_ratings
+from rabidratings.utils import get_cache
 
 register = template.Library()
 
 
+@register.simple_tag(takes_context=True)
+def load_ratings(context, object_list):
+    """ Loads ratings for all objects of the list for show_rating by two queries. """
+    prefetch_ratings(object_list, context.get('request'))
+    return ''
+
+
 @register.inclusion_tag("rabidratings/rating.html", takes_context=True)
 def show_rating(context, obj, show_parts='all'):
     """ Displays necessary html for the rating. """
 
     request = context.get('request')
-    rating = Rating.objects.get_for_object(obj)
-
-    if hasattr(request, 'user') and request.user.is_authenticated():
-        lookup = dict(user=request.user)
+    prefetched = get_prefetched_ratings(request).get(get_rating_key(obj))
+    if prefetched is not None:
+        rating, rating_event = prefetched
     else:
-        lookup = dict(ip=request.META['REMOTE_ADDR'])
+        rating = None
+        rating_event = get_voter_event(obj, request)
+    if rating is None:
+        rating = Rating.objects.get_for_object(obj)
 
-    try:
-        rating_event = RatingEvent.objects.get_for_object(obj, False, **lookup)
-    except RatingEvent.DoesNotExist:
+    if rating_event is None:
         user_rating = 0
         user_rating_updated = None
     else:
         user_rating = rating_event.stars_value
         user_rating_updated = rating_event.updated
 
-    return {
+    result = _get_public_context(rating, show_parts)
+    result.update({
         'request': request,
+        'user_rating': user_rating,
+        'user_rating_updated': user_rating_updated,
+        'user': request.user,
+    })
+    return result
+
+
+@register.simple_tag(takes_context=True)
+def show_public_rating(context, obj, show_parts='all'):
+    """
+    Displays public part of the rating, which does not depend on the request,
+    so pages (or fragments) using it can be cached. Voter's part is only
+    a placeholder filled by rabidratings.js from voter_ratings view.
+    Rendered html is cached by version of the rating in RABIDRATINGS_CACHE if set.
+    """
+    request = context.get('request')
+    prefetched = get_prefetched_ratings(request).get(get_rating_key(obj)) if request is not None else None
+    rating = prefetched[0] if prefetched is not None else None
+    if rating is None:
+        rating = Rating.objects.get_for_object(obj)
+
+    cache = get_cache(conf.RABIDRATINGS_CACHE) if conf.RABIDRATINGS_CACHE else None
+    cache_key = 'rabidratings:public:%s:%s:%s:%s' % (rating.key, rating.version, show_parts, get_language())
+    html = cache.get(cache_key) if cache is not None else None
+    if html is None:
+        html = render_to_string('rabidratings/rating_public.html', _get_public_context(rating, show_parts))
+        if cache is not None:
+            cache.set(cache_key, html, conf.RABIDRATINGS_CACHE_TIMEOUT)
+    return mark_safe(html)
+
+
+def _get_public_context(rating, show_parts):
+    return {
         'rating_key': rating.key,
         'total_votes': rating.total_votes,
         'total_ratings': rating.total_rating,
         'rating': rating.avg_rating,
         'percent': rating.percent,
+        'histogram': rating.histogram,
         'max_stars': 5,
-        'user_rating': user_rating,
         'show_parts': show_parts,
-        'user_rating_updated': user_rating_updated,
-        'user': request.user,
     }
 
 
@@ -67,6 +112,7 @@ def rating_header_js(context):
     return {
             'rabidratings_static_url': RABIDRATINGS_STATIC_URL,
             'verbal_values': conf.RATING_VERBAL_VALUES,
+            'response_format': conf.RABIDRATINGS_VOTE_RESPONSE_FORMAT,
     }
 
 
@@ -0,0 +1,96 @@
+import time
+
+from rabidratings import conf
+from rabidratings.utils import get_cache
+
+
+class VoteThrottle(object):
+    """
+    Limits rate of votes in front of the database by token buckets kept
+    in Django cache backend: one per voter (RABIDRATINGS_VOTER_RATE)
+    and one per rated object (RABIDRATINGS_TARGET_RATE). Every vote takes
+    one token from both buckets, which are refilled continuously up to
+    their capacity.
+
+    Results of votes are remembered for RABIDRATINGS_DUPLICATE_VOTE_TTL,
+    so repeated identical vote (double click, retry) is answered without
+    touching the database.
+
+    Buckets are read and written without a lock, so concurrent votes
+    of the same voter may occasionally pass over the limit.
+    """
+    key_prefix = 'rabidratings:throttle'
+
+    def __init__(self, cache_alias=None, voter_rate=None, target_rate=None, duplicate_ttl=None):
+        self.cache_alias = cache_alias or conf.RABIDRATINGS_THROTTLE_CACHE
+        self.voter_rate = voter_rate or conf.RABIDRATINGS_VOTER_RATE
+        self.target_rate = target_rate or conf.RABIDRATINGS_TARGET_RATE
+        self.duplicate_ttl = duplicate_ttl or conf.RABIDRATINGS_DUPLICATE_VOTE_TTL
+
+    @property
+    def cache(self):
+        return get_cache(self.cache_alias)
+
+    def _key(self, *parts):
+        return ':'.join((self.key_prefix,) + tuple(str(part) for part in parts))
+
+    def allow(self, voter_key, rating_keys):
+        """
+        Takes a token for voter and for every rated object by few cache
+        round trips. Returns False (and takes nothing) if any bucket is empty.
+        """
+        buckets = {}
+        if self.voter_rate:
+            buckets[self._key('voter', voter_key)] = self.voter_rate
+        if self.target_rate:
+            for rating_key in rating_keys:
+                buckets[self._key('target', rating_key)] = self.target_rate
+        if not buckets:
+            return True
+
+        timestamp = time.time()
+        states = self.cache.get_many(buckets.keys())
+        tokens = {}
+        for key, (capacity, period) in buckets.items():
+            available, updated = states.get(key, (capacity, timestamp))
+            available = min(capacity, available + (timestamp - updated) * capacity / float(period))
+            if available < 1:
+                return False
+            tokens[key] = available - 1
+        for key, available in tokens.items():
+            self.cache.set(key, (available, timestamp), buckets[key][1])
+        return True
+
+    def get_result(self, voter_key, rating_key, value, response_format='html'):
+        """
+        Returns result of the same vote recorded recently or None. Only the last
+        vote of voter for the object is remembered, so the result of changed
+        vote changed back is not reused.
+        """
+        item = self.cache.get(self._key('vote', voter_key, rating_key))
+        if item is not None and item[:2] == (value, response_format):
+            return item[2]
+        return None
+
+    def set_result(self, voter_key, rating_key, value, result, response_format='html'):
+        self.cache.set(self._key('vote', voter_key, rating_key), (value, response_format, result), self.duplicate_ttl)
+
+    def forget(self, voter_key, rating_keys):
+        """
+        Forgets results of votes of voter for given objects (e.g. voted by batch).
+        """
+        self.cache.delete_many([self._key('vote', voter_key, rating_key) for rating_key in rating_keys])
+
+
+def get_vote_throttle():
+    '''
+    Return VoteThrottle if RABIDRATINGS_THROTTLE_CACHE is set, None otherwise
+    '''
+    if not conf.RABIDRATINGS_THROTTLE_CACHE:
+        return None
+    throttle = get_vote_throttle.cache.get(conf.RABIDRATINGS_THROTTLE_CACHE, None)
+    if not throttle:
+        throttle = VoteThrottle()
+        get_vote_throttle.cache[conf.RABIDRATINGS_THROTTLE_CACHE] = throttle
+    return throttle
+get_vote_throttle.cache = {}
@@ -2,8 +2,11 @@ from django.conf.urls import url, patterns
 from django.template.defaultfilters import slugify
 from django.utils.translation import ugettext_lazy as _
 
-from rabidratings.views import record_vote
+from rabidratings.views import ratings, record_vote, record_votes, voter_ratings
 
 urlpatterns = patterns('',
     url(r'^%s/' % slugify(_("submit")), record_vote, name='record_vote'),
+    url(r'^%s/' % slugify(_("submit-many")), record_votes, name='record_votes'),
+    url(r'^%s/' % slugify(_("votes")), voter_ratings, name='voter_ratings'),
+    url(r'^%s/' % slugify(_("ratings")), ratings, name='ratings'),
 )
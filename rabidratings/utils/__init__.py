@@ -1,7 +1,17 @@
 from django.core.exceptions import ImproperlyConfigured
+from django.utils.crypto import get_random_string, salted_hmac
 from django.utils.importlib import import_module
+
+from rabidratings import conf
 from rabidratings.utils.views import HttpResponseJson
 
+try:
+    from django.core.cache import caches
+except ImportError:
+    from django.core.cache import get_cache
+else:
+    get_cache = lambda alias: caches[alias]
+
 
 def import_module_member(modstr):
     try:
@@ -17,3 +27,51 @@ def import_module_member(modstr):
 def get_natural_key(model_class):
     app_label = model_class._meta.app_label
     return '%s.%s' % (app_label, model_class.__name__.lower())
+
+
+def get_voter_fingerprint(ip, cookie=None):
+    '''
+    Return fixed-width (32 hex digits) fingerprint of anonymous voter
+    by ip address and optional voter cookie, keyed by SECRET_KEY
+    '''
+    value = '%s|%s' % (ip or '', cookie or '')
+    return salted_hmac('rabidratings.voter', value).hexdigest()[:32]
+
+
+def get_voter_cookie(request):
+    '''
+    Return value of voter cookie of request (None if RABIDRATINGS_VOTER_COOKIE
+    is not set); new value is generated for request without the cookie
+    and kept on request to be set on the response
+    '''
+    name = conf.RABIDRATINGS_VOTER_COOKIE
+    if not name:
+        return None
+    cookie = getattr(request, 'COOKIES', {}).get(name)
+    if not cookie:
+        if not getattr(request, '_rabidratings_voter_cookie', None):
+            request._rabidratings_voter_cookie = get_random_string(32)
+        cookie = request._rabidratings_voter_cookie
+    return cookie
+
+
+def get_voter(request):
+    '''
+    Return voter of request as keyword arguments of RatingEvent
+    (user if authenticated, ip address and its fingerprint otherwise)
+    '''
+    user = getattr(request, 'user', None)
+    if user and user.is_authenticated():
+        return dict(user=user)
+    ip = request.META['REMOTE_ADDR']
+    return dict(ip=ip, voter_fp=get_voter_fingerprint(ip, get_voter_cookie(request)))
+
+
+def get_voter_lookup(request):
+    '''
+    Return lookup of RatingEvent for voter of request
+    (user if authenticated, voter fingerprint otherwise)
+    '''
+    voter = get_voter(request)
+    voter.pop('ip', None)
+    return voter
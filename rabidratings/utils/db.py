@@ -0,0 +1,65 @@
+def get_vendor(connection):
+    return getattr(connection, 'vendor', None)
+
+
+def supports_upsert(connection):
+    '''
+    Return True if backend can insert row and skip or update it
+    on unique conflict by single statement
+    '''
+    vendor = get_vendor(connection)
+    if vendor == 'sqlite':
+        return connection.Database.sqlite_version_info >= (3, 24, 0)
+    if vendor == 'postgresql':
+        connection.ensure_connection()
+        return connection.pg_version >= 90500
+    return vendor == 'mysql'
+
+
+def supports_returning(connection):
+    '''
+    Return True if backend can return columns of inserted or updated rows
+    '''
+    vendor = get_vendor(connection)
+    if vendor == 'sqlite':
+        return connection.Database.sqlite_version_info >= (3, 35, 0)
+    return vendor == 'postgresql'
+
+
+def insert_ignore_sql(connection, table, columns, conflict_columns):
+    '''
+    Return INSERT statement (with placeholders for one row of columns)
+    which silently skips the row conflicting on conflict_columns.
+    Requires supports_upsert(connection).
+    '''
+    qn = connection.ops.quote_name
+    values = (qn(table), ', '.join(qn(c) for c in columns), ', '.join(['%s'] * len(columns)))
+    if get_vendor(connection) == 'mysql':
+        return 'INSERT IGNORE INTO %s (%s) VALUES (%s)' % values
+    return 'INSERT INTO %s (%s) VALUES (%s) ON CONFLICT (%s) DO NOTHING' % (
+        values + (', '.join(qn(c) for c in conflict_columns),))
+
+
+def returning_sql(connection, columns):
+    '''
+    Return RETURNING clause for columns. Requires supports_returning(connection).
+    '''
+    qn = connection.ops.quote_name
+    return ' RETURNING %s' % ', '.join(qn(c) for c in columns)
+
+
+def upsert_add_sql(connection, table, columns, conflict_columns, add_columns):
+    '''
+    Return INSERT statement (with placeholders for one row of columns)
+    which adds values of add_columns to the existing row conflicting
+    on conflict_columns instead. Requires supports_upsert(connection).
+    '''
+    qn = connection.ops.quote_name
+    sql = 'INSERT INTO %s (%s) VALUES (%s)' % (
+        qn(table), ', '.join(qn(c) for c in columns), ', '.join(['%s'] * len(columns)))
+    if get_vendor(connection) == 'mysql':
+        return sql + ' ON DUPLICATE KEY UPDATE %s' % ', '.join(
+            '%s = %s + VALUES(%s)' % (qn(c), qn(c), qn(c)) for c in add_columns)
+    return sql + ' ON CONFLICT (%s) DO UPDATE SET %s' % (
+        ', '.join(qn(c) for c in conflict_columns),
+        ', '.join('%s = %s.%s + EXCLUDED.%s' % (qn(c), qn(table), qn(c), qn(c)) for c in add_columns))
@@ -1,10 +1,10 @@
-from django.db import IntegrityError, transaction
+from contextlib import contextmanager
+
+from django.db import DEFAULT_DB_ALIAS, IntegrityError, connections, transaction
 
 try:
     atomic = transaction.atomic
 except AttributeError:
-    from contextlib import contextmanager
-
     @contextmanager
     def atomic(using=None):
         sid = transaction.savepoint(using=using)
@@ -15,3 +15,40 @@ except AttributeError:
             raise
         else:
             transaction.savepoint_commit(sid, using=using)
+
+
+try:
+    on_commit = transaction.on_commit
+except AttributeError:
+    # Django < 1.9 has no commit hooks: callbacks registered inside atomic
+    # blocks of this module run when the outermost of them exits successfully
+    # and are discarded with the block exited by exception
+    _atomic = atomic
+
+    @contextmanager
+    def atomic(using=None):
+        connection = connections[using or DEFAULT_DB_ALIAS]
+        depth = getattr(connection, 'rabidratings_atomic_depth', 0)
+        if not depth:
+            connection.rabidratings_on_commit = []
+        start = len(connection.rabidratings_on_commit)
+        connection.rabidratings_atomic_depth = depth + 1
+        try:
+            with _atomic(using=using):
+                yield
+        except:
+            del connection.rabidratings_on_commit[start:]
+            raise
+        finally:
+            connection.rabidratings_atomic_depth = depth
+        if not depth:
+            callbacks, connection.rabidratings_on_commit = connection.rabidratings_on_commit, []
+            for func in callbacks:
+                func()
+
+    def on_commit(func, using=None):
+        connection = connections[using or DEFAULT_DB_ALIAS]
+        if getattr(connection, 'rabidratings_atomic_depth', 0):
+            connection.rabidratings_on_commit.append(func)
+        else:
+            func()
@@ -15,65 +15,319 @@
 # You should have received a copy of the GNU General Public License
 # along with Django-Rabid-Ratings.  If not, see <http://www.gnu.org/licenses/>.
 #
+import calendar
+import hashlib
 import logging
 
 from django.contrib.contenttypes.models import ContentType
-from django.views.decorators.http import require_POST
+from django.core.exceptions import ValidationError
+from django.http import HttpResponseNotModified
+from django.views.decorators.http import require_GET, require_POST
 from django.template.loader import render_to_string
-from django.views.decorators.csrf import csrf_protect
+from django.utils.cache import add_never_cache_headers, patch_cache_control, patch_vary_headers
+from django.utils.http import http_date, parse_etags, parse_http_date_safe, quote_etag
+from django.views.decorators.csrf import csrf_protect, ensure_csrf_cookie
+try:
+    from django.utils.timezone import now
+except ImportError:
+    from datetime import datetime
+    now = datetime.now
 
-from rabidratings.utils import HttpResponseJson
+from rabidratings.buffer import get_vote_buffer
+from rabidratings.cache import get_voter_key
+from rabidratings.prefetch import get_ratings, get_voter_events
+from rabidratings.throttle import get_vote_throttle
+from rabidratings import conf
+from rabidratings.utils import HttpResponseJson, get_voter
 from rabidratings.models import Rating, RatingEvent
 
 
 logger = logging.getLogger(__name__)
 
+# max number of ratings returned by ratings and voter_ratings at once
+RATINGS_MAX_KEYS = 100
+
+
+def get_rating_keys(value):
+    '''
+    Return list of valid rating keys given by comma separated string
+    (invalid and repeated ones are skipped)
+    '''
+    keys = []
+    for key in value.split(','):
+        try:
+            ct_id, obj_id = Rating.split_key(key)
+            key = '%d_%d' % (int(ct_id), int(obj_id))
+        except ValueError:
+            continue
+        if key not in keys:
+            keys.append(key)
+    return keys[:RATINGS_MAX_KEYS]
+
+
+class VoteError(Exception):
+    """
+    Vote is refused with given HTTP status code.
+    """
+
+    def __init__(self, code):
+        super(VoteError, self).__init__('Vote refused with status %s' % code)
+        self.code = code
+
 
 @csrf_protect
 @require_POST
 def record_vote(request):
     """
-    Records the vote - note, we drop down and need to commit this transaction
-    manually since we need to read, compute, and then write a new value.
+    Records the vote - the event and the rating counters are written in one
+    transaction by RatingEvent.objects.record_vote using fixed number of statements.
+    Rendered html (or only values if ``format`` is 'data', see
+    RABIDRATINGS_VOTE_RESPONSE_FORMAT) is returned in JSON with status code
+    400 for invalid vote, 403 for not allowed anonymous voter, 404 for unknown
+    content type, 429 for too many votes (see RABIDRATINGS_THROTTLE_CACHE)
+    and 500 if the vote can not be saved.
     This will not work with mysql ISAM tables, so if you are using mysql, it is
     highly recommended to change this table to InnoDB to support transactions using
     the following:
        alter table rabidratings_rating engine=innodb;
     """
     logger.debug(request)
+    data_format = request.POST.get('format', conf.RABIDRATINGS_VOTE_RESPONSE_FORMAT) == 'data'
     try:
-        ct_id, obj_id = Rating.split_key(request.POST['id'])
-        ct = ContentType.objects.get_for_id(ct_id)
+        try:
+            ct_id, obj_id = Rating.split_key(request.POST['id'])
+            ct_id, obj_id = int(ct_id), int(obj_id)
+            value = int(float(request.POST['vote']))
+        except (KeyError, ValueError):
+            raise VoteError(400)
+        if not 0 <= value <= 100:
+            raise VoteError(400)
+        try:
+            ct = ContentType.objects.get_for_id(ct_id)
+        except ContentType.DoesNotExist:
+            raise VoteError(404)
+
+        voter = get_voter(request)
+        if 'user' not in voter and conf.RABIDRATINGS_DISABLE_ANONYMOUS_USERS:
+            raise VoteError(403)
 
-        # lookup for model RatingEvent
-        lookup = dict(target_ct=ct, target_id=obj_id)
-        if request.user and request.user.is_authenticated():
-            lookup['user'] = request.user
+        throttle = get_vote_throttle()
+        if throttle is not None:
+            voter_key = get_voter_key(voter.get('user'), voter_fp=voter.get('voter_fp'))
+            rating_key = '%d_%d' % (ct_id, obj_id)
+            response_format = 'data' if data_format else 'html'
+            result = throttle.get_result(voter_key, rating_key, value, response_format)
+            if result is not None:
+                # repeated vote, nothing has changed since
+                return _vote_response(request, result)
+            if not throttle.allow(voter_key, [rating_key]):
+                raise VoteError(429)
+
+        vote_buffer = get_vote_buffer()
+        if vote_buffer is not None:
+            # vote is written later by flush_rating_votes, totals are not affected yet
+            event = RatingEvent(target_ct=ct, target_id=obj_id, value=value, **voter)
+            event.clean()
+            vote_buffer.push(dict(
+                target_ct_id=ct.id,
+                target_id=obj_id,
+                user_id=event.user_id,
+                ip=event.ip,
+                voter_fp=event.voter_fp,
+                value=event.value,
+                updated=now(),
+            ))
+            rating = Rating.objects.get_or_create(commit=False, target_ct=ct, target_id=obj_id)[0]
+            rating = Rating.objects.fold_shards(rating)
         else:
-            lookup['ip'] = request.META['REMOTE_ADDR']
+            event, rating = RatingEvent.objects.record_vote(ct.id, obj_id, value, **voter)
 
-        event, created = RatingEvent.objects.get_or_create(commit=False, **lookup)
-        if not created:
-            event.is_changing = True
-            event.old_value = event.value
-        event.value = int(float(request.POST['vote']))
-        event.save()
+        if data_format:
+            # html is built by rabidratings.js
+            result = dict(
+                code=200,
+                total_votes=rating.total_votes,
+                avg_rating=float(rating.avg_rating),
+                percent=rating.percent,
+                stars_value=event.stars_value,
+                verbal_value=unicode(event.verbal_value),
+            )
+        else:
+            result = dict(
+                code=200,
+                total_votes=rating.total_votes,
+                text=render_to_string('rabidratings/rating_result_text.html', {'event': event}),
+                avg_rating=render_to_string('rabidratings/avg_rating_vaule.html', {'value': rating.avg_rating})
+            )
+        if throttle is not None:
+            throttle.set_result(voter_key, rating_key, value, result, response_format)
 
-        rating, created = Rating.objects.get_or_create(commit=False, target_ct=ct, target_id=obj_id)
+    except Exception as e:
+        result = dict(code=_get_error_code(e))
+        if not data_format and result['code'] != 429:
+            result['error'] = render_to_string('rabidratings/rating_result_error_text.html')
 
-        result = dict(
-            code=200,
+    return _vote_response(request, result)
+
+
+def _get_error_code(e):
+    if isinstance(e, VoteError):
+        logger.debug(e)
+        return e.code
+    logger.error(e, exc_info=True)
+    return 500
+
+
+def _vote_response(request, result):
+    logger.debug(result)
+    response = HttpResponseJson(result, status_code=result['code'])
+    voter_cookie = getattr(request, '_rabidratings_voter_cookie', None)
+    if voter_cookie:
+        response.set_cookie(conf.RABIDRATINGS_VOTER_COOKIE, voter_cookie, max_age=60 * 60 * 24 * 365 * 10, httponly=True)
+    return response
+
+
+@csrf_protect
+@require_POST
+def record_votes(request):
+    """
+    Records votes for many objects at once, given as repeated ``id`` and ``vote``
+    parameters, by RatingEvent.objects.record_many in one transaction.
+    Returns new values of all the ratings (and the voter's votes) in JSON
+    with the same status codes as record_vote.
+    """
+    logger.debug(request)
+    try:
+        keys, values = request.POST.getlist('id'), request.POST.getlist('vote')
+        if not keys or len(keys) != len(values) or len(keys) > RATINGS_MAX_KEYS:
+            raise VoteError(400)
+        try:
+            keys = ['%d_%d' % tuple(int(part) for part in Rating.split_key(key)) for key in keys]
+            values = [int(float(value)) for value in values]
+        except ValueError:
+            raise VoteError(400)
+
+        voter = get_voter(request)
+        if 'user' not in voter and conf.RABIDRATINGS_DISABLE_ANONYMOUS_USERS:
+            raise VoteError(403)
+        throttle = get_vote_throttle()
+        if throttle is not None:
+            voter_key = get_voter_key(voter.get('user'), voter_fp=voter.get('voter_fp'))
+            if not throttle.allow(voter_key, keys):
+                raise VoteError(429)
+        try:
+            ratings = RatingEvent.objects.record_many(voter, zip(keys, values))
+        except ValidationError:
+            raise VoteError(400)
+        if throttle is not None:
+            # results of single votes for these objects are outdated
+            throttle.forget(voter_key, keys)
+
+        votes = dict(zip(keys, values))
+        result = dict(code=200, ratings=dict((key, dict(
             total_votes=rating.total_votes,
-            text=render_to_string('rabidratings/rating_result_text.html', {'event': event}),
-            avg_rating=render_to_string('rabidratings/avg_rating_vaule.html', {'value': rating.avg_rating})
-        )
+            avg_rating=float(rating.avg_rating),
+            percent=rating.percent,
+            user_rating=votes[key] / 20,
+        )) for key, rating in ratings.items()))
 
     except Exception as e:
-        logger.error(e, exc_info=True)
-        result = dict(
-            code=500,
-            error=render_to_string('rabidratings/rating_result_error_text.html')
+        result = dict(code=_get_error_code(e))
+
+    return _vote_response(request, result)
+
+
+@ensure_csrf_cookie
+@require_GET
+def voter_ratings(request):
+    """
+    Returns votes of request's voter for ratings given by comma separated
+    keys in ``ids`` (by one query, or none if cached by RABIDRATINGS_VOTER_CACHE),
+    used by rabidratings.js to fill voter's part of ratings displayed
+    by show_public_rating. The response is never cached, unlike the page.
+    """
+    keys = get_rating_keys(request.GET.get('ids', ''))
+    user = getattr(request, 'user', None)
+    can_vote = bool(user and user.is_authenticated())
+    events = get_voter_events(keys, request) if can_vote and keys else {}
+    ratings = {}
+    for key in keys:
+        event = events.get(key)
+        user_rating = event.stars_value if event is not None else 0
+        ratings[key] = dict(
+            user_rating=user_rating,
+            text=render_to_string('rabidratings/rating_user_text.html', {'user': user, 'user_rating': user_rating}),
         )
 
-    logger.debug(result)
-    return HttpResponseJson(result)
+    response = HttpResponseJson(dict(code=200, can_vote=can_vote, ratings=ratings))
+    add_never_cache_headers(response)
+    return response
+
+
+@require_GET
+def ratings(request):
+    """
+    Returns ratings given by comma separated keys in ``keys`` by single query
+    (ratings are read through the cache if RABIDRATINGS_CACHE is set) and
+    votes of request's voter for them if ``votes`` is set.
+
+    The response has ETag derived from versions of the ratings (and votes)
+    and Last-Modified of the latest of them, so it is revalidated
+    by conditional request answered by 304 Not Modified.
+    """
+    keys = get_rating_keys(request.GET.get('keys', ''))
+    with_votes = bool(request.GET.get('votes'))
+    ratings = get_ratings(keys)
+    events = get_voter_events(keys, request) if with_votes and keys else {}
+
+    etag = hashlib.md5()
+    modified = []
+    result = {}
+    for key in keys:
+        rating = ratings.get(key)
+        if rating is None:
+            ct_id, obj_id = Rating.split_key(key)
+            rating = Rating(target_ct_id=int(ct_id), target_id=int(obj_id))
+        etag.update('%s:%s;' % (key, rating.version))
+        if rating.updated is not None:
+            modified.append(rating.updated)
+        result[key] = dict(
+            total_votes=rating.total_votes,
+            total_rating=rating.total_rating,
+            avg_rating=float(rating.avg_rating),
+            percent=rating.percent,
+            score=rating.score,
+            histogram=[h['votes'] for h in rating.histogram],
+        )
+        if with_votes:
+            event = events.get(key)
+            result[key]['user_rating'] = event.stars_value if event is not None else 0
+            if event is not None:
+                etag.update('%s:%s;' % (event.value, event.updated.isoformat()))
+                modified.append(event.updated)
+    etag = etag.hexdigest()
+    last_modified = http_date(calendar.timegm(max(modified).utctimetuple())) if modified else None
+
+    if _is_not_modified(request, etag, last_modified):
+        response = HttpResponseNotModified()
+    else:
+        response = HttpResponseJson(dict(code=200, ratings=result))
+    response['ETag'] = quote_etag(etag)
+    if last_modified:
+        response['Last-Modified'] = last_modified
+    if with_votes:
+        patch_cache_control(response, private=True, max_age=0, must_revalidate=True)
+        patch_vary_headers(response, ('Cookie',))
+    else:
+        patch_cache_control(response, public=True, max_age=0, must_revalidate=True)
+    return response
+
+
+def _is_not_modified(request, etag, last_modified):
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+    if if_none_match:
+        etags = parse_etags(if_none_match)
+        return etag in etags or '*' in etags
+    if_modified_since = parse_http_date_safe(request.META.get('HTTP_IF_MODIFIED_SINCE'))
+    return (if_modified_since is not None and last_modified is not None and
+            parse_http_date_safe(last_modified) <= if_modified_since)
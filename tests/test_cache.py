@@ -0,0 +1,128 @@
+import time
+
+from django.contrib.contenttypes.models import ContentType
+from django.contrib.auth.models import User
+from django.test import TestCase, RequestFactory
+
+from nose import tools
+
+from rabidratings import conf
+from rabidratings.cache import RatingCache, get_rating_cache, get_voter_cache, get_voter_key
+from rabidratings.models import Rating, RatingEvent
+from rabidratings.prefetch import get_voter_event, get_voter_events
+from rabidratings.utils.transaction import atomic
+
+
+class TestRatingCache(TestCase):
+
+    def setUp(self):
+        super(TestRatingCache, self).setUp()
+        conf.RABIDRATINGS_CACHE = 'locmem'
+        get_rating_cache.cache.clear()
+        get_rating_cache().cache.clear()
+        self.user = User.objects.create_user(username='johan')
+        self.test_obj1 = User.objects.create_user(username='test_obj1')
+        self.ct = ContentType.objects.get_for_model(User)
+
+    def tearDown(self):
+        conf.RABIDRATINGS_CACHE = None
+        get_rating_cache.cache.clear()
+        super(TestRatingCache, self).tearDown()
+
+    def test_get_for_object_reads_through_cache(self):
+        rating = Rating.objects.get_for_object(self.test_obj1)
+        get_rating_cache().reset_stats()
+        with self.assertNumQueries(0):
+            tools.assert_equals(Rating.objects.get_for_object(self.test_obj1), rating)
+        tools.assert_equals(get_rating_cache().stats, dict(hits=1, misses=0))
+
+    def test_vote_invalidates_cached_rating(self):
+        tools.assert_equals(Rating.objects.get_for_object(self.test_obj1).total_votes, 0)
+        RatingEvent.objects.record_vote(self.ct.id, self.test_obj1.id, 80, user=self.user)
+        tools.assert_equals(Rating.objects.get_for_object(self.test_obj1).total_votes, 1)
+
+    def test_cached_rating_is_invalidated_after_commit(self):
+        key = Rating.objects.get_for_object(self.test_obj1).key
+        with atomic():
+            RatingEvent.objects.record_vote(self.ct.id, self.test_obj1.id, 80, user=self.user)
+            tools.assert_equals(list(get_rating_cache().get_many([key])), [key])
+        tools.assert_equals(get_rating_cache().get_many([key]), {})
+
+    def test_cached_rating_is_kept_after_rollback(self):
+        key = Rating.objects.get_for_object(self.test_obj1).key
+        try:
+            with atomic():
+                RatingEvent.objects.record_vote(self.ct.id, self.test_obj1.id, 80, user=self.user)
+                raise ValueError
+        except ValueError:
+            pass
+        tools.assert_equals(get_rating_cache().get_many([key])[key].total_votes, 0)
+
+    def test_expired_rating_is_refreshed_by_single_client(self):
+        rating_cache = RatingCache('locmem', timeout=1, stale_timeout=60)
+        rating = Rating.objects.get_for_object(self.test_obj1)
+        rating_cache.set_many([rating])
+        rating_cache.cache.set(rating_cache._key(rating.key), (rating, time.time() - 1))
+        tools.assert_equals(rating_cache.get_many([rating.key]), {})
+        tools.assert_equals(rating_cache.get_many([rating.key]), {rating.key: rating})
+        rating_cache.set(rating)
+        tools.assert_equals(rating_cache.get_many([rating.key]), {rating.key: rating})
+
+
+class TestVoterCache(TestCase):
+
+    def setUp(self):
+        super(TestVoterCache, self).setUp()
+        conf.RABIDRATINGS_VOTER_CACHE = 'locmem'
+        get_voter_cache.cache.clear()
+        get_voter_cache().cache.clear()
+        self.user = User.objects.create_user(username='johan')
+        self.objects = [User.objects.create_user(username='test_obj%d' % i) for i in range(3)]
+        self.ct = ContentType.objects.get_for_model(User)
+        self.request = RequestFactory().get('/')
+        self.request.user = self.user
+
+    def tearDown(self):
+        conf.RABIDRATINGS_VOTER_CACHE = None
+        get_voter_cache.cache.clear()
+        super(TestVoterCache, self).tearDown()
+
+    def test_not_voted_is_cached(self):
+        tools.assert_equals(get_voter_event(self.objects[0], self.request), None)
+        with self.assertNumQueries(0):
+            tools.assert_equals(get_voter_event(self.objects[0], self.request), None)
+
+    def test_vote_invalidates_cached_votes_of_voter(self):
+        keys = ['%s_%s' % (self.ct.id, obj.id) for obj in self.objects]
+        tools.assert_equals(get_voter_events(keys, self.request), dict.fromkeys(keys))
+        RatingEvent.objects.record_vote(self.ct.id, self.objects[1].id, 80, user=self.user)
+        with self.assertNumQueries(1):
+            events = get_voter_events(keys, self.request)
+        tools.assert_equals(events[keys[1]].value, 80)
+        with self.assertNumQueries(0):
+            tools.assert_equals(get_voter_event(self.objects[1], self.request).value, 80)
+
+    def test_votes_of_voter_are_invalidated_after_commit(self):
+        key = '%s_%s' % (self.ct.id, self.objects[0].id)
+        get_voter_event(self.objects[0], self.request)
+        with atomic():
+            RatingEvent.objects.record_vote(self.ct.id, self.objects[0].id, 80, user=self.user)
+            tools.assert_equals(get_voter_cache().get_many(get_voter_key(self.user), [key]), {key: None})
+        tools.assert_equals(get_voter_cache().get_many(get_voter_key(self.user), [key]), {})
+
+    def test_votes_loaded_before_vote_are_not_cached(self):
+        voter_cache = get_voter_cache()
+        voter_key = get_voter_key(self.user)
+        key = '%s_%s' % (self.ct.id, self.objects[0].id)
+        version = voter_cache.get_version(voter_key)
+        # vote is committed after the reader loaded "not voted" from db
+        voter_cache.invalidate(voter_key)
+        voter_cache.set_many(voter_key, {key: None}, version)
+        tools.assert_equals(voter_cache.get_many(voter_key, [key]), {})
+
+    def test_votes_of_other_voters_stay_cached(self):
+        other = User.objects.create_user(username='joe')
+        key = '%s_%s' % (self.ct.id, self.objects[0].id)
+        get_voter_event(self.objects[0], self.request)
+        RatingEvent.objects.record_vote(self.ct.id, self.objects[0].id, 80, user=other)
+        tools.assert_equals(get_voter_cache().get_many(get_voter_key(self.user), [key]), {key: None})
@@ -1,13 +1,22 @@
+from datetime import timedelta
 from decimal import Decimal
 
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.auth.models import User
 from django.test import TestCase
+from django.core.exceptions import ValidationError
 from django.db import IntegrityError
+from django.db.models.query import QuerySet
+from django.core.management import call_command
+from django.utils import timezone
 
 from nose import tools
 
-from rabidratings.models import Rating, RatingEvent
+from rabidratings import conf
+from rabidratings.aggregates import RatingDelta, get_score, get_trend_epoch
+from rabidratings.managers import RatingQuerySetMixin
+from rabidratings.models import Rating, RatingDay, RatingEvent, RatingLeader, RatingShard
+from rabidratings.utils import get_voter_fingerprint
 
 
 class TestRatingModel(TestCase):
@@ -88,6 +97,50 @@ class TestRatingModel(TestCase):
         tools.assert_raises(Rating.DoesNotExist, Rating.objects.get_for_object, self.test_obj2, False)
         tools.assert_equals(Rating.objects.count(), 0)
 
+    def test_apply_delta_creates_rating(self):
+        ct = ContentType.objects.get_for_model(self.test_obj2.__class__)
+        Rating.objects.apply_delta(ct.id, self.test_obj2.id, RatingDelta(80, 1))
+        rating = Rating.objects.get_for_object(self.test_obj2, False)
+        tools.assert_equals(rating.total_votes, 1)
+        tools.assert_equals(rating.avg_rating, Decimal('4.0'))
+        tools.assert_equals(rating.percent, 0.8)
+
+    def test_apply_delta_by_single_statement(self):
+        rating = Rating.objects.get_for_object(self.test_obj2)
+        with self.assertNumQueries(1):
+            Rating.objects.apply_delta(rating.target_ct_id, rating.target_id, RatingDelta(80, 1))
+
+    def test_apply_delta_does_not_lose_concurrent_votes(self):
+        stale_rating = Rating.objects.get_for_object(self.test_obj2)
+        Rating.objects.apply_delta(stale_rating.target_ct_id, stale_rating.target_id, RatingDelta(80, 1))
+        Rating.objects.apply_delta(stale_rating.target_ct_id, stale_rating.target_id, RatingDelta(40, 1))
+        delta = RatingDelta()
+        delta.add_vote(100, old_value=40)
+        Rating.objects.apply_delta(stale_rating.target_ct_id, stale_rating.target_id, delta)
+        rating = Rating.objects.get(pk=stale_rating.pk)
+        tools.assert_equals(rating.total_rating, 180)
+        tools.assert_equals(rating.total_votes, 2)
+        tools.assert_equals(rating.avg_rating, Decimal('4.5'))
+
+    def test_apply_delta_updates_score(self):
+        rating = Rating.objects.get_for_object(self.test_obj2)
+        tools.assert_equals(rating.score, 0.0)
+        Rating.objects.apply_delta(rating.target_ct_id, rating.target_id, RatingDelta(180, 2))
+        rating = Rating.objects.get(pk=rating.pk)
+        tools.assert_almost_equals(rating.score, get_score(180, 2))
+        rating.apply_delta(RatingDelta(20, 1))
+        tools.assert_almost_equals(rating.score, get_score(200, 3))
+
+    def test_score_prefers_more_votes(self):
+        tools.assert_true(get_score(400, 5) > get_score(100, 1))
+        tools.assert_equals(get_score(0, 0), 0.0)
+
+    def test_update_scores_command(self):
+        rating = Rating.objects.get_for_object(self.test_obj2)
+        Rating.objects.filter(pk=rating.pk).update(total_rating=160, total_votes=2)
+        call_command('update_rating_scores', batch_size=1)
+        tools.assert_almost_equals(Rating.objects.get(pk=rating.pk).score, get_score(160, 2))
+
 
 class TestRatingEventModel(TestCase):
 
@@ -136,6 +189,85 @@ class TestRatingEventModel(TestCase):
         RatingEvent.objects.create(**lookup)
         tools.assert_equals(RatingEvent.objects.count(), 2)
 
+    def test_apply_votes_collapses_votes_of_same_voter(self):
+        ct_id = self.content_type_user.id
+        votes = [
+            dict(target_ct_id=ct_id, target_id=self.test_obj1.id, user_id=self.user1.id, value=20),
+            dict(target_ct_id=ct_id, target_id=self.test_obj1.id, user_id=self.user1.id, value=80),
+            dict(target_ct_id=ct_id, target_id=self.test_obj1.id, user_id=self.user2.id, value=40),
+            dict(target_ct_id=ct_id, target_id=self.test_obj2.id, user_id=self.user1.id, value=100),
+        ]
+        RatingEvent.objects.apply_votes(votes)
+        tools.assert_equals(RatingEvent.objects.count(), 3)
+        rating = Rating.objects.get_for_object(self.test_obj1, False)
+        tools.assert_equals(rating.total_votes, 2)
+        tools.assert_equals(rating.total_rating, 120)
+        rating = Rating.objects.get_for_object(self.test_obj2, False)
+        tools.assert_equals(rating.total_votes, 1)
+        tools.assert_equals(rating.avg_rating, Decimal('5.0'))
+
+    def test_apply_votes_changes_existing_vote(self):
+        event = RatingEvent(value=80, **self.lookup)
+        event.save()
+        votes = [dict(target_ct_id=self.content_type_user.id, target_id=self.test_obj1.id, user_id=self.user1.id, value=40)]
+        RatingEvent.objects.apply_votes(votes)
+        tools.assert_equals(RatingEvent.objects.get(pk=event.pk).value, 40)
+        rating = Rating.objects.get_for_object(self.test_obj1, False)
+        tools.assert_equals(rating.total_votes, 1)
+        tools.assert_equals(rating.avg_rating, Decimal('2.0'))
+
+    def test_record_many(self):
+        ct_id = self.content_type_user.id
+        RatingEvent.objects.record_vote(ct_id, self.test_obj1.id, 20, user=self.user1)
+        keys = ['%s_%s' % (ct_id, self.test_obj1.id), '%s_%s' % (ct_id, self.test_obj2.id)]
+        ratings = RatingEvent.objects.record_many(dict(user=self.user1), [(keys[0], 80), (keys[1], 60)])
+        tools.assert_equals(sorted(ratings), sorted(keys))
+        tools.assert_equals([(ratings[k].total_votes, ratings[k].total_rating) for k in keys], [(1, 80), (1, 60)])
+        tools.assert_equals(sorted(RatingEvent.objects.values_list('value', flat=True)), [60, 80])
+
+    def test_record_many_validates_whole_batch(self):
+        key = '%s_%s' % (self.content_type_user.id, self.test_obj1.id)
+        for votes in ([(key, 80), ('invalid', 80)], [(key, 80), ('999999_1', 80)], [(key, 0)], [(key, 500)]):
+            tools.assert_raises(ValidationError, RatingEvent.objects.record_many, dict(user=self.user1), votes)
+        tools.assert_raises(ValidationError, RatingEvent.objects.record_many, dict(ip='10.0.0.1'), [(key, 80)])
+        tools.assert_equals(RatingEvent.objects.count(), 0)
+
+    def test_record_vote(self):
+        event, rating = RatingEvent.objects.record_vote(self.content_type_user.id, self.test_obj1.id, 80, user=self.user1)
+        tools.assert_equals(RatingEvent.objects.get().value, 80)
+        tools.assert_equals((rating.total_votes, rating.avg_rating, rating.percent), (1, Decimal('4.0'), 0.8))
+        event, rating = RatingEvent.objects.record_vote(self.content_type_user.id, self.test_obj1.id, 40, user=self.user1)
+        tools.assert_equals(RatingEvent.objects.get().value, 40)
+        tools.assert_equals((rating.total_votes, rating.avg_rating, rating.percent), (1, Decimal('2.0'), 0.4))
+        tools.assert_equals(Rating.objects.get(), rating)
+
+    def test_record_vote_maintains_histogram(self):
+        ct_id = self.content_type_user.id
+        RatingEvent.objects.record_vote(ct_id, self.test_obj1.id, 80, user=self.user1)
+        RatingEvent.objects.record_vote(ct_id, self.test_obj1.id, 100, user=self.user2)
+        event, rating = RatingEvent.objects.record_vote(ct_id, self.test_obj1.id, 20, user=self.user1)
+        tools.assert_equals([h['votes'] for h in rating.histogram], [1, 0, 0, 0, 1])
+        rating = Rating.objects.get(pk=rating.pk)
+        tools.assert_equals((rating.votes_20, rating.votes_80, rating.votes_100), (1, 0, 1))
+        tools.assert_equals(rating.histogram[0]['percent'], 50.0)
+
+    def test_add_rating_moves_changed_vote_between_buckets(self):
+        rating = Rating(target_ct=self.content_type_user, target_id=self.test_obj1.id)
+        event = RatingEvent(target_ct=self.content_type_user, target_id=self.test_obj1.id, user=self.user1, value=60)
+        rating.add_rating(event)
+        event.is_changing, event.old_value, event.value = True, 60, 100
+        rating.add_rating(event)
+        tools.assert_equals((rating.total_votes, rating.votes_60, rating.votes_100), (1, 0, 1))
+
+    def test_record_vote_query_budget(self):
+        Rating.objects.get_or_create(target_ct=self.content_type_user, target_id=self.test_obj1.id)
+        # savepoint, previous vote lookup, event upsert, rating update returning counters,
+        # daily rollup upsert, savepoint release
+        with self.assertNumQueries(6):
+            RatingEvent.objects.record_vote(self.content_type_user.id, self.test_obj1.id, 80, user=self.user1)
+        with self.assertNumQueries(6):
+            RatingEvent.objects.record_vote(self.content_type_user.id, self.test_obj1.id, 40, user=self.user1)
+
     def test_ratingevent_stars_value(self):
         ratingevent = RatingEvent.objects.get_or_create(**self.lookup)[0]
         ratingevent.value = 80
@@ -147,6 +279,72 @@ class TestRatingEventModel(TestCase):
         tools.assert_equals(ratingevent.verbal_value, '')
 
 
+class TestShardedRating(TestCase):
+
+    def setUp(self):
+        super(TestShardedRating, self).setUp()
+        self.old_shards = conf.RABIDRATINGS_RATING_SHARDS
+        conf.RABIDRATINGS_RATING_SHARDS = {'auth.user': 4}
+        self.users = [User.objects.create_user(username='voter%d' % i) for i in range(5)]
+        self.test_obj1 = User.objects.create_user(username='test_obj1')
+        self.test_obj2 = User.objects.create_user(username='test_obj2')
+        self.ct = ContentType.objects.get_for_model(User)
+
+    def tearDown(self):
+        conf.RABIDRATINGS_RATING_SHARDS = self.old_shards
+        super(TestShardedRating, self).tearDown()
+
+    def vote(self, obj, user, value):
+        event = RatingEvent.objects.get_or_create(target_ct=self.ct, target_id=obj.id, user=user)[0]
+        event.value = value
+        event.save()
+
+    def test_votes_are_written_to_shards_and_folded_on_read(self):
+        for user in self.users:
+            self.vote(self.test_obj1, user, 80)
+        self.vote(self.test_obj1, self.users[0], 20)
+        tools.assert_true(RatingShard.objects.count() > 0)
+        tools.assert_equals(Rating.objects.get().total_votes, 0)
+
+        rating = Rating.objects.get_for_object(self.test_obj1)
+        tools.assert_equals(rating.total_votes, 5)
+        tools.assert_equals(rating.total_rating, 340)
+        tools.assert_equals(rating.avg_rating, Decimal('3.4'))
+        tools.assert_equals((rating.votes_20, rating.votes_80), (1, 4))
+
+    def test_compaction_folds_histogram(self):
+        self.vote(self.test_obj1, self.users[0], 60)
+        self.vote(self.test_obj1, self.users[1], 100)
+        self.vote(self.test_obj1, self.users[0], 40)
+        call_command('compact_rating_shards')
+        rating = Rating.objects.get()
+        tools.assert_equals([h['votes'] for h in rating.histogram], [0, 1, 0, 0, 1])
+        tools.assert_equals(Rating.objects.reconcile(check_only=True), (1, 0))
+
+    def test_compaction_folds_shards_into_rating(self):
+        for user in self.users:
+            self.vote(self.test_obj1, user, 60)
+        call_command('compact_rating_shards')
+        rating = Rating.objects.get()
+        tools.assert_equals(rating.total_votes, 5)
+        tools.assert_equals(rating.avg_rating, Decimal('3.0'))
+        tools.assert_false(RatingShard.objects.exclude(total_rating=0, total_votes=0).exists())
+        tools.assert_equals(Rating.objects.get_for_object(self.test_obj1).total_votes, 5)
+
+    def test_get_objects_by_folded_rating(self):
+        self.vote(self.test_obj1, self.users[0], 40)
+        self.vote(self.test_obj2, self.users[0], 100)
+        list_users = list(User.objects.filter(username__startswith='test_').by_rating())
+        tools.assert_equals(list_users, [self.test_obj2, self.test_obj1])
+
+    def test_with_rating_of_folded_rating(self):
+        for user, value in zip(self.users, (80, 60)):
+            self.vote(self.test_obj1, user, value)
+        users = RatedUserQuerySet(User).filter(pk=self.test_obj1.pk).with_rating()
+        tools.assert_equals([(u.rating_avg, u.rating_votes) for u in users], [(3.5, 2)])
+        tools.assert_equals(Rating.objects.get_for_object(self.test_obj1).avg_rating, Decimal('3.5'))
+
+
 class TestQuerySetWithRating(TestCase):
 
     def setUp(self):
@@ -176,3 +374,345 @@ class TestQuerySetWithRating(TestCase):
         list_users = list(User.objects.filter(username__startswith='test_').by_rating())
         
         tools.assert_equals(list_users, [self.test_obj2, self.test_obj1, self.test_obj3])
+
+    def test_get_objects_by_rating_with_lazy_ratings(self):
+        conf.RABIDRATINGS_LAZY_RATINGS = True
+        try:
+            ct = ContentType.objects.get_for_model(User)
+            RatingEvent.objects.record_vote(ct.id, self.test_obj2.id, 80, user=self.user)
+            RatingEvent.objects.record_vote(ct.id, self.test_obj3.id, 40, user=self.user)
+            list_users = list(User.objects.filter(username__startswith='test_').by_rating())
+            tools.assert_equals(list_users, [self.test_obj2, self.test_obj3, self.test_obj1])
+        finally:
+            conf.RABIDRATINGS_LAZY_RATINGS = False
+
+    def test_get_objects_by_score(self):
+        ct = ContentType.objects.get_for_model(User)
+        Rating.objects.apply_delta(ct.id, self.test_obj1.id, RatingDelta(100, 1))
+        Rating.objects.apply_delta(ct.id, self.test_obj2.id, RatingDelta(400, 5))
+        Rating.objects.get_or_create(target_ct=ct, target_id=self.test_obj3.id)
+        qs = User.objects.filter(username__startswith='test_')
+        tools.assert_equals(list(qs.by_rating()), [self.test_obj1, self.test_obj2, self.test_obj3])
+        tools.assert_equals(list(qs.by_rating(by_score=True)), [self.test_obj2, self.test_obj1, self.test_obj3])
+
+
+class TestTrendingRating(TestCase):
+
+    def setUp(self):
+        super(TestTrendingRating, self).setUp()
+        self.test_obj1 = User.objects.create_user(username='test_obj1')
+        self.test_obj2 = User.objects.create_user(username='test_obj2')
+        self.ct = ContentType.objects.get_for_model(User)
+
+    def test_newer_votes_weigh_more(self):
+        epoch = get_trend_epoch()
+        rating = Rating(target_ct=self.ct, target_id=self.test_obj1.id)
+        rating.apply_trend(RatingDelta(100, 1), timestamp=epoch)
+        rating.apply_trend(RatingDelta(20, 1), timestamp=epoch + conf.RABIDRATINGS_TRENDING_HALF_LIFE)
+        tools.assert_almost_equals(rating.trend_mass, 3.0)
+        tools.assert_almost_equals(rating.trend_sum, 140.0)
+
+    def test_trend_is_rebased_to_new_epoch(self):
+        epoch = get_trend_epoch()
+        rating = Rating(target_ct=self.ct, target_id=self.test_obj1.id)
+        rating.apply_trend(RatingDelta(100, 1), timestamp=epoch - conf.RABIDRATINGS_TRENDING_EPOCH)
+        rating.apply_trend(RatingDelta(100, 1), timestamp=epoch)
+        factor = 2.0 ** (-conf.RABIDRATINGS_TRENDING_EPOCH / float(conf.RABIDRATINGS_TRENDING_HALF_LIFE))
+        tools.assert_equals(rating.trend_epoch, epoch)
+        tools.assert_almost_equals(rating.trend_mass, 1.0 + factor)
+
+    def test_apply_delta_updates_trend(self):
+        Rating.objects.apply_delta(self.ct.id, self.test_obj1.id, RatingDelta(80, 1))
+        Rating.objects.apply_delta(self.ct.id, self.test_obj1.id, RatingDelta(40, 1))
+        rating = Rating.objects.get_for_object(self.test_obj1)
+        tools.assert_equals(rating.trend_epoch, get_trend_epoch())
+        tools.assert_almost_equals(rating.trend_sum / rating.trend_mass, 60.0, places=3)
+
+    def test_get_objects_by_trending_after_renormalization(self):
+        Rating.objects.apply_delta(self.ct.id, self.test_obj1.id, RatingDelta(100, 1))
+        Rating.objects.apply_delta(self.ct.id, self.test_obj2.id, RatingDelta(60, 1))
+        last_epoch = get_trend_epoch() - conf.RABIDRATINGS_TRENDING_EPOCH
+        Rating.objects.filter(target_id=self.test_obj1.id).update(trend_mass=1.0, trend_sum=100.0, trend_epoch=last_epoch)
+        call_command('renormalize_rating_trends')
+        factor = 2.0 ** (-conf.RABIDRATINGS_TRENDING_EPOCH / float(conf.RABIDRATINGS_TRENDING_HALF_LIFE))
+        tools.assert_almost_equals(Rating.objects.get_for_object(self.test_obj1).trend_sum, 100.0 * factor)
+        list_users = list(User.objects.filter(username__startswith='test_').by_trending())
+        tools.assert_equals(list_users, [self.test_obj2, self.test_obj1])
+
+
+class RatedUserQuerySet(RatingQuerySetMixin, QuerySet):
+    pass
+
+
+class TestRatingQuerySetMixin(TestCase):
+
+    def setUp(self):
+        super(TestRatingQuerySetMixin, self).setUp()
+        self.user = User.objects.create_user(username='johan')
+        self.test_obj1 = User.objects.create_user(username='test_obj1')
+        self.test_obj2 = User.objects.create_user(username='test_obj2')
+        self.test_obj3 = User.objects.create_user(username='test_obj3')
+        self.ct = ContentType.objects.get_for_model(User)
+        self.qs = RatedUserQuerySet(User).filter(username__startswith='test_')
+
+    def test_order_by_rating_keeps_unrated_objects_last(self):
+        RatingEvent.objects.record_vote(self.ct.id, self.test_obj2.id, 80, user=self.user)
+        RatingEvent.objects.record_vote(self.ct.id, self.test_obj3.id, 40, user=self.user)
+        tools.assert_equals(list(self.qs.order_by_rating()), [self.test_obj2, self.test_obj3, self.test_obj1])
+
+    def test_order_by_rating_keeps_previous_ordering(self):
+        RatingEvent.objects.record_vote(self.ct.id, self.test_obj2.id, 80, user=self.user)
+        tools.assert_equals(list(self.qs.order_by('-username').order_by_rating()),
+                            [self.test_obj2, self.test_obj3, self.test_obj1])
+
+    def test_with_rating_annotates_objects(self):
+        RatingEvent.objects.record_vote(self.ct.id, self.test_obj2.id, 80, user=self.user)
+        values = dict((u.pk, (u.rating_avg, u.rating_votes)) for u in self.qs.with_rating())
+        tools.assert_equals(values[self.test_obj2.pk], (4.0, 1))
+        tools.assert_equals(values[self.test_obj1.pk], (0, 0))
+
+    def test_order_by_rating_by_score(self):
+        Rating.objects.apply_delta(self.ct.id, self.test_obj1.id, RatingDelta(100, 1))
+        Rating.objects.apply_delta(self.ct.id, self.test_obj2.id, RatingDelta(400, 5))
+        tools.assert_equals(list(self.qs.order_by_rating(by_score=True)),
+                            [self.test_obj2, self.test_obj1, self.test_obj3])
+
+
+class TestRatingLeaderboard(TestCase):
+
+    def setUp(self):
+        super(TestRatingLeaderboard, self).setUp()
+        conf.RABIDRATINGS_LEADERBOARDS = {'auth.user': 2}
+        self.test_obj1 = User.objects.create_user(username='test_obj1')
+        self.test_obj2 = User.objects.create_user(username='test_obj2')
+        self.test_obj3 = User.objects.create_user(username='test_obj3')
+        self.ct = ContentType.objects.get_for_model(User)
+
+    def tearDown(self):
+        conf.RABIDRATINGS_LEADERBOARDS = {}
+        super(TestRatingLeaderboard, self).tearDown()
+
+    def test_top_rated_are_kept_in_leaderboard(self):
+        Rating.objects.apply_delta(self.ct.id, self.test_obj1.id, RatingDelta(60, 1))
+        Rating.objects.apply_delta(self.ct.id, self.test_obj2.id, RatingDelta(100, 1))
+        Rating.objects.apply_delta(self.ct.id, self.test_obj3.id, RatingDelta(400, 5))
+        tools.assert_equals(RatingLeader.objects.count(), 2)
+        top = Rating.objects.top_rated(User)
+        tools.assert_equals(top, [self.test_obj3, self.test_obj2])
+        tools.assert_equals(top[0].rating_votes, 5)
+        tools.assert_equals(Rating.objects.top_rated(User, n=1), [self.test_obj3])
+        tools.assert_equals(Rating.objects.top_rated(User, min_votes=2), [self.test_obj3])
+
+    def test_leader_falling_behind_is_replaced(self):
+        Rating.objects.apply_delta(self.ct.id, self.test_obj1.id, RatingDelta(60, 1))
+        Rating.objects.apply_delta(self.ct.id, self.test_obj2.id, RatingDelta(100, 1))
+        Rating.objects.apply_delta(self.ct.id, self.test_obj3.id, RatingDelta(80, 1))
+        Rating.objects.apply_delta(self.ct.id, self.test_obj2.id, RatingDelta(40, 2))
+        tools.assert_equals(Rating.objects.top_rated(User), [self.test_obj3, self.test_obj1])
+
+    def test_rebuild_command(self):
+        Rating.objects.apply_delta(self.ct.id, self.test_obj1.id, RatingDelta(60, 1))
+        Rating.objects.apply_delta(self.ct.id, self.test_obj2.id, RatingDelta(100, 1))
+        RatingLeader.objects.all().delete()
+        call_command('rebuild_rating_leaderboards')
+        tools.assert_equals(Rating.objects.top_rated(User), [self.test_obj2, self.test_obj1])
+
+
+class TestCleanupOldRatings(TestCase):
+
+    def setUp(self):
+        super(TestCleanupOldRatings, self).setUp()
+        self.user = User.objects.create_user(username='johan')
+        self.ct = ContentType.objects.get_for_model(User)
+        self.objects = [User.objects.create_user(username='test_obj%s' % i) for i in range(3)]
+        for obj in self.objects:
+            RatingEvent.objects.record_vote(self.ct.id, obj.id, 80, user=self.user)
+        old_date = Rating.objects.get_for_object(self.objects[0]).updated.replace(year=2000)
+        Rating.objects.filter(target_id__in=[o.id for o in self.objects[:2]]).update(updated=old_date)
+
+    def test_old_ratings_are_deleted_in_batches(self):
+        call_command('cleanup_old_ratings', batch_size=1, verbosity=0)
+        tools.assert_equals(list(Rating.objects.values_list('target_id', flat=True)), [self.objects[2].id])
+        tools.assert_equals(list(RatingEvent.objects.values_list('target_id', flat=True)), [self.objects[2].id])
+
+    def test_dry_run_deletes_nothing(self):
+        call_command('cleanup_old_ratings', dry_run=True, verbosity=0)
+        tools.assert_equals(Rating.objects.count(), 3)
+        tools.assert_equals(RatingEvent.objects.count(), 3)
+
+
+class TestCreateRatingsForExistsObjects(TestCase):
+
+    def setUp(self):
+        super(TestCreateRatingsForExistsObjects, self).setUp()
+        self.cts_for_create_rating = conf.RABIDRATINGS_CTS_FOR_CREATE_RATING
+        self.objects = [User.objects.create_user(username='test_obj%s' % i) for i in range(5)]
+        Rating.objects.get_for_object(self.objects[1])
+
+    def tearDown(self):
+        conf.RABIDRATINGS_CTS_FOR_CREATE_RATING = self.cts_for_create_rating
+        super(TestCreateRatingsForExistsObjects, self).tearDown()
+
+    def test_missing_ratings_are_created_in_batches(self):
+        tools.assert_equals(Rating.objects.create_missing(User, batch_size=2), 4)
+        tools.assert_equals(sorted(Rating.objects.values_list('target_id', flat=True)),
+                            sorted(o.id for o in self.objects))
+        tools.assert_equals(Rating.objects.create_missing(User, batch_size=2), 0)
+
+    def test_command(self):
+        from rabidratings.management.commands import create_ratings_for_exists_objects
+        create_ratings_for_exists_objects.RABIDRATINGS_CTS_FOR_CREATE_RATING = ('auth.user',)
+        try:
+            call_command('create_ratings_for_exists_objects', batch_size=3, verbosity=0)
+        finally:
+            create_ratings_for_exists_objects.RABIDRATINGS_CTS_FOR_CREATE_RATING = self.cts_for_create_rating
+        tools.assert_equals(Rating.objects.count(), 5)
+
+
+class TestRebuildRatings(TestCase):
+
+    def setUp(self):
+        super(TestRebuildRatings, self).setUp()
+        self.user = User.objects.create_user(username='johan')
+        self.user2 = User.objects.create_user(username='joe')
+        self.ct = ContentType.objects.get_for_model(User)
+        self.test_obj1 = User.objects.create_user(username='test_obj1')
+        self.test_obj2 = User.objects.create_user(username='test_obj2')
+        RatingEvent.objects.record_vote(self.ct.id, self.test_obj1.id, 80, user=self.user)
+        RatingEvent.objects.record_vote(self.ct.id, self.test_obj1.id, 40, user=self.user2)
+        RatingEvent.objects.record_vote(self.ct.id, self.test_obj2.id, 100, user=self.user)
+        # event deleted by hand does not decrement counters
+        RatingEvent.objects.filter(target_id=self.test_obj1.id, user=self.user2).delete()
+
+    def test_check_only_reports_drifted_ratings(self):
+        tools.assert_equals(Rating.objects.reconcile(check_only=True), (2, 1))
+        tools.assert_equals(Rating.objects.get_for_object(self.test_obj1).total_votes, 2)
+
+    def test_drifted_ratings_are_fixed(self):
+        call_command('rebuild_ratings', batch_size=1, verbosity=0)
+        rating = Rating.objects.get_for_object(self.test_obj1)
+        tools.assert_equals((rating.total_rating, rating.total_votes), (80, 1))
+        tools.assert_equals(rating.avg_rating, Decimal('4.0'))
+        tools.assert_almost_equals(rating.score, get_score(80, 1))
+        tools.assert_equals((rating.votes_40, rating.votes_80), (0, 1))
+        tools.assert_equals(Rating.objects.reconcile(check_only=True), (2, 0))
+
+    def test_zero_votes_are_ignored(self):
+        now = timezone.now()
+        RatingEvent.objects.bulk_create([RatingEvent(target_ct=self.ct, target_id=self.test_obj1.id,
+                                                     user=self.user2, value=0, created=now, updated=now)])
+        Rating.objects.reconcile()
+        rating = Rating.objects.get_for_object(self.test_obj1)
+        tools.assert_equals((rating.total_rating, rating.total_votes), (80, 1))
+        tools.assert_equals(rating.avg_rating, Decimal('4.0'))
+
+    def test_histogram_does_not_count_zero_votes(self):
+        now = timezone.now()
+        RatingEvent.objects.bulk_create([RatingEvent(target_ct=self.ct, target_id=self.test_obj1.id,
+                                                     user=self.user2, value=0, created=now, updated=now)])
+        Rating.objects.reconcile()
+        tools.assert_equals(Rating.objects.get_for_object(self.test_obj1).votes_20, 0)
+        delta = RatingDelta()
+        delta.add_vote(0)
+        delta.add_vote(500)
+        tools.assert_equals(delta.histogram, {})
+
+    def test_histogram_is_backfilled(self):
+        Rating.objects.update(votes_80=0, votes_100=0)
+        Rating.objects.reconcile()
+        tools.assert_equals(Rating.objects.get_for_object(self.test_obj2).votes_100, 1)
+
+
+class TestRatingDay(TestCase):
+
+    def setUp(self):
+        super(TestRatingDay, self).setUp()
+        self.users = [User.objects.create_user(username='voter%d' % i) for i in range(3)]
+        self.test_obj1 = User.objects.create_user(username='test_obj1')
+        self.ct = ContentType.objects.get_for_model(User)
+
+    def test_votes_are_rolled_up_by_day(self):
+        RatingEvent.objects.record_vote(self.ct.id, self.test_obj1.id, 80, user=self.users[0])
+        RatingEvent.objects.record_vote(self.ct.id, self.test_obj1.id, 40, user=self.users[1])
+        RatingEvent.objects.record_vote(self.ct.id, self.test_obj1.id, 100, user=self.users[0])
+        day = RatingDay.objects.get()
+        tools.assert_equals((day.total_rating, day.total_votes), (140, 2))
+
+    def test_changed_vote_stays_in_its_day(self):
+        event = RatingEvent.objects.record_vote(self.ct.id, self.test_obj1.id, 80, user=self.users[0])[0]
+        yesterday = RatingDay.objects.get().day - timedelta(days=1)
+        RatingDay.objects.update(day=yesterday)
+        RatingEvent.objects.filter(pk=event.pk).update(created=event.created - timedelta(days=1))
+        RatingEvent.objects.record_vote(self.ct.id, self.test_obj1.id, 20, user=self.users[0])
+        tools.assert_equals(list(RatingDay.objects.values_list('day', 'total_rating', 'total_votes')),
+                            [(yesterday, 20, 1)])
+
+    def test_window_and_daily_helpers(self):
+        RatingEvent.objects.record_vote(self.ct.id, self.test_obj1.id, 80, user=self.users[0])
+        today = RatingDay.objects.get().day
+        RatingDay.objects.create(target_ct=self.ct, target_id=self.test_obj1.id, day=today - timedelta(days=2),
+                                 total_rating=40, total_votes=1)
+        RatingDay.objects.create(target_ct=self.ct, target_id=self.test_obj1.id, day=today - timedelta(days=40),
+                                 total_rating=20, total_votes=1)
+        window = RatingDay.objects.get_window(self.test_obj1, days=30)
+        tools.assert_equals(window, dict(total_rating=120, total_votes=2, avg_rating=3.0))
+        daily = RatingDay.objects.get_daily(self.test_obj1, days=3)
+        tools.assert_equals([(d['day'], d['total_votes']) for d in daily],
+                            [(today - timedelta(days=2), 1), (today - timedelta(days=1), 0), (today, 1)])
+
+    def test_backfill_command(self):
+        RatingEvent.objects.record_vote(self.ct.id, self.test_obj1.id, 80, user=self.users[0])
+        RatingEvent.objects.record_vote(self.ct.id, self.test_obj1.id, 60, user=self.users[1])
+        expected = list(RatingDay.objects.values_list('day', 'total_rating', 'total_votes'))
+        RatingDay.objects.all().delete()
+        call_command('backfill_rating_days', verbosity=0)
+        tools.assert_equals(list(RatingDay.objects.values_list('day', 'total_rating', 'total_votes')), expected)
+        tools.assert_equals(expected[0][1:], (140, 2))
+
+
+class TestAnonymousVotes(TestCase):
+
+    def setUp(self):
+        super(TestAnonymousVotes, self).setUp()
+        conf.RABIDRATINGS_DISABLE_ANONYMOUS_USERS = False
+        self.test_obj1 = User.objects.create_user(username='test_obj1')
+        self.ct = ContentType.objects.get_for_model(User)
+
+    def tearDown(self):
+        conf.RABIDRATINGS_DISABLE_ANONYMOUS_USERS = True
+        super(TestAnonymousVotes, self).tearDown()
+
+    def test_voter_is_deduplicated_by_fingerprint(self):
+        RatingEvent.objects.record_vote(self.ct.id, self.test_obj1.id, 80, ip='10.0.0.1')
+        event = RatingEvent.objects.record_vote(self.ct.id, self.test_obj1.id, 40, ip='10.0.0.1')[0]
+        tools.assert_equals(len(event.voter_fp), 32)
+        tools.assert_equals(list(RatingEvent.objects.values_list('ip', 'value')), [('10.0.0.1', 40)])
+        tools.assert_equals(Rating.objects.get_for_object(self.test_obj1).total_votes, 1)
+
+    def test_voter_cookie_distinguishes_voters_behind_same_ip(self):
+        for cookie in ('a', 'b'):
+            RatingEvent.objects.record_vote(self.ct.id, self.test_obj1.id, 80, ip='10.0.0.1',
+                                            voter_fp=get_voter_fingerprint('10.0.0.1', cookie))
+        tools.assert_equals(Rating.objects.get_for_object(self.test_obj1).total_votes, 2)
+
+    def test_duplicate_fingerprint_is_rejected(self):
+        RatingEvent(target_ct=self.ct, target_id=self.test_obj1.id, ip='10.0.0.1', value=80).save()
+        event = RatingEvent(target_ct=self.ct, target_id=self.test_obj1.id, ip='10.0.0.1', value=60)
+        tools.assert_raises(IntegrityError, event.save)
+
+    def test_apply_votes_by_ip(self):
+        votes = [dict(target_ct_id=self.ct.id, target_id=self.test_obj1.id, ip='10.0.0.1', value=value)
+                 for value in (40, 80)]
+        RatingEvent.objects.apply_votes(votes[:1])
+        RatingEvent.objects.apply_votes(votes[1:])
+        tools.assert_equals(list(RatingEvent.objects.values_list('value', flat=True)), [80])
+        tools.assert_equals(Rating.objects.get_for_object(self.test_obj1).total_rating, 80)
+
+    def test_expired_votes_are_anonymized(self):
+        event = RatingEvent.objects.record_vote(self.ct.id, self.test_obj1.id, 80, ip='10.0.0.1')[0]
+        RatingEvent.objects.filter(pk=event.pk).update(updated=event.updated - timedelta(days=2))
+        tools.assert_equals(RatingEvent.objects.expire_anonymous(ttl=60 * 60 * 24 * 3), 0)
+        call_command('expire_anonymous_votes', ttl=60 * 60 * 24, verbosity=0)
+        tools.assert_equals(list(RatingEvent.objects.values_list('ip', 'voter_fp')), [(None, None)])
+        RatingEvent.objects.record_vote(self.ct.id, self.test_obj1.id, 60, ip='10.0.0.1')
+        tools.assert_equals(Rating.objects.get_for_object(self.test_obj1).total_votes, 2)
@@ -0,0 +1,102 @@
+from django.contrib.contenttypes.models import ContentType
+from django.contrib.auth.models import Group, User
+from django.core.paginator import InvalidPage
+from django.http import Http404
+from django.test import TestCase
+from django.test.client import RequestFactory
+
+from nose import tools
+
+from rabidratings import conf
+from rabidratings.aggregates import RatingDelta
+from rabidratings.models import Rating, RatingEvent
+from rabidratings.pagination import KeysetPaginator, UserVotesPaginator, get_keyset_page, get_user_votes_page
+
+
+class TestKeysetPaginator(TestCase):
+
+    def setUp(self):
+        super(TestKeysetPaginator, self).setUp()
+        ct = ContentType.objects.get_for_model(User)
+        self.objects = []
+        for i, (total_rating, total_votes) in enumerate([(80, 1), (100, 1), (80, 1), (160, 2), (40, 1)]):
+            obj = User.objects.create_user(username='test_obj%s' % i)
+            Rating.objects.apply_delta(ct.id, obj.id, RatingDelta(total_rating, total_votes))
+            self.objects.append(obj)
+        self.qs = User.objects.filter(username__startswith='test_')
+        self.expected = list(self.qs.order_by('-pk').by_rating())
+
+    def _all_pages(self, paginator):
+        pages, cursor = [], None
+        while True:
+            page = paginator.page(cursor)
+            pages.append(list(page))
+            if not page.has_next():
+                return pages
+            cursor = page.next_cursor
+
+    def test_pages_follow_rating_order(self):
+        pages = self._all_pages(KeysetPaginator(self.qs, 2))
+        tools.assert_equals([len(p) for p in pages], [2, 2, 1])
+        tools.assert_equals(sum(pages, []), self.expected)
+        tools.assert_equals(self.expected[0], self.objects[1])
+
+    def test_pages_follow_rating_order_with_lazy_ratings(self):
+        conf.RABIDRATINGS_LAZY_RATINGS = True
+        try:
+            unrated = User.objects.create_user(username='test_unrated')
+            pages = self._all_pages(KeysetPaginator(self.qs, 2))
+            tools.assert_equals(sum(pages, []), self.expected + [unrated])
+        finally:
+            conf.RABIDRATINGS_LAZY_RATINGS = False
+
+    def test_deep_page_is_read_by_seek(self):
+        paginator = KeysetPaginator(self.qs, 2)
+        cursor = paginator.page().next_cursor
+        with self.assertNumQueries(1):
+            page = paginator.page(cursor)
+        tools.assert_equals(list(page), self.expected[2:4])
+
+    def test_invalid_cursor(self):
+        tools.assert_raises(InvalidPage, KeysetPaginator(self.qs, 2).page, 'invalid')
+        request = RequestFactory().get('/', {'cursor': 'W10'})
+        tools.assert_raises(Http404, get_keyset_page, request, self.qs, 2)
+
+
+class TestUserVotesPaginator(TestCase):
+
+    def setUp(self):
+        super(TestUserVotesPaginator, self).setUp()
+        self.user = User.objects.create_user(username='johan')
+        targets = [User.objects.create_user(username='test_obj%s' % i) for i in range(3)]
+        targets += [Group.objects.create(name='test_group%s' % i) for i in range(2)]
+        for target in targets:
+            ct = ContentType.objects.get_for_model(target)
+            RatingEvent.objects.record_vote(ct.id, target.pk, 80, user=self.user)
+        # the same time of votes is ordered by pk
+        RatingEvent.objects.filter(pk__in=[e.pk for e in RatingEvent.objects.all()[:2]]).update(
+            updated=RatingEvent.objects.get(target_id=targets[0].pk, target_ct__model='user').updated)
+        self.expected = list(RatingEvent.objects.filter(user=self.user).order_by('-updated', '-pk'))
+
+    def test_pages_follow_updated_order(self):
+        paginator = UserVotesPaginator(self.user, 2)
+        events, cursor = [], None
+        while True:
+            page = paginator.page(cursor)
+            events.extend(page)
+            if not page.has_next():
+                break
+            cursor = page.next_cursor
+        tools.assert_equals(events, self.expected)
+
+    def test_targets_are_loaded_per_content_type(self):
+        with self.assertNumQueries(3):
+            page = UserVotesPaginator(self.user, 50).page()
+            targets = [event.target for event in page]
+        tools.assert_equals(len(targets), 5)
+        tools.assert_equals(set(type(t) for t in targets), set([User, Group]))
+
+    def test_invalid_cursor(self):
+        tools.assert_raises(InvalidPage, UserVotesPaginator(self.user, 2).page, 'W10')
+        request = RequestFactory().get('/', {'cursor': 'WyJ4IiwgMV0'})
+        tools.assert_raises(Http404, get_user_votes_page, request, self.user, 2)
@@ -8,8 +8,11 @@ from django.test import TestCase, RequestFactory
 
 from nose import tools
 
+from rabidratings import conf
 from rabidratings.models import Rating, RatingEvent
-from rabidratings.templatetags.rabidratings_tags import show_rating
+from rabidratings.prefetch import prefetch_ratings
+from rabidratings.templatetags.rabidratings_tags import show_public_rating, show_rating
+from rabidratings.utils import get_cache
 
 
 class TestShowRating(TestCase):
@@ -34,6 +37,7 @@ class TestShowRating(TestCase):
             'rating': Decimal("0.0"),
             'request': self.rf,
             'percent': 0.0,
+            'histogram': Rating.objects.get().histogram,
             'max_stars': 5,
             'user_rating': 0,
             'show_parts': 'all',
@@ -64,6 +68,7 @@ class TestShowRating(TestCase):
             'rating': Decimal("4"),
             'request': self.rf,
             'percent': 0.8,
+            'histogram': Rating.objects.get().histogram,
             'max_stars': 5,
             'user_rating': 4,
             'show_parts': 'all',
@@ -87,6 +92,7 @@ class TestShowRating(TestCase):
             'rating': Decimal("0.0"),
             'request': self.rf,
             'percent': 0.0,
+            'histogram': Rating.objects.get().histogram,
             'max_stars': 5,
             'user_rating': 0,
             'show_parts': 'all',
@@ -129,3 +135,101 @@ class TestShowRating(TestCase):
                      'object': self.test_obj1})
         t = template.Template('{% load rabidratings_tags %}{% show_rating object %}')
         tools.assert_equals(u'NOT FOR ANONYMOUSSTATISTIC or ALL', t.render(c).strip().replace("\n", "").replace("\t", ""))
+
+
+class TestShowPublicRating(TestCase):
+
+    def setUp(self):
+        super(TestShowPublicRating, self).setUp()
+        conf.RABIDRATINGS_CACHE = 'locmem'
+        get_cache('locmem').clear()
+        self.user = User.objects.create_user(username='johan', password='johan')
+        self.test_obj1 = User.objects.create_user(username='test_obj1')
+        self.ct = ContentType.objects.get_for_model(User)
+
+    def tearDown(self):
+        conf.RABIDRATINGS_CACHE = None
+        super(TestShowPublicRating, self).tearDown()
+
+    def test_voter_part_is_placeholder(self):
+        RatingEvent.objects.record_vote(self.ct.id, self.test_obj1.id, 80, user=self.user)
+        html = show_public_rating(Context({}), self.test_obj1)
+        tools.assert_in('rabidRatingUser-%s_%s-0_5' % (self.ct.id, self.test_obj1.id), html)
+        tools.assert_in('rabidRatingDeferred', html)
+        tools.assert_in('<strong class="totalVotes">1</strong>', html)
+
+    def test_rendered_rating_is_cached_by_version(self):
+        show_public_rating(Context({}), self.test_obj1)
+        with self.assertNumQueries(0):
+            show_public_rating(Context({}), self.test_obj1)
+        RatingEvent.objects.record_vote(self.ct.id, self.test_obj1.id, 80, user=self.user)
+        tools.assert_in('<strong class="totalVotes">1</strong>', show_public_rating(Context({}), self.test_obj1))
+
+
+class TestShowLazyRating(TestCase):
+
+    def setUp(self):
+        super(TestShowLazyRating, self).setUp()
+        conf.RABIDRATINGS_LAZY_RATINGS = True
+        self.user = User.objects.create_user(username='johan', password='johan')
+        self.test_obj1 = User.objects.create_user(username='test_obj1')
+        self.rf = RequestFactory()
+        self.rf.user = self.user
+
+    def tearDown(self):
+        conf.RABIDRATINGS_LAZY_RATINGS = False
+        super(TestShowLazyRating, self).tearDown()
+
+    def test_show_rating_tag_does_not_create_rating(self):
+        c = Context({'request': self.rf})
+        result = show_rating(c, self.test_obj1)
+        ct = ContentType.objects.get_for_model(User)
+        tools.assert_equals(result['rating_key'], '%s_%s' % (ct.id, self.test_obj1.id))
+        tools.assert_equals(result['total_votes'], 0)
+        tools.assert_equals(result['rating'], Decimal("0.0"))
+        tools.assert_equals(Rating.objects.count(), 0)
+        tools.assert_equals([h['votes'] for h in result['histogram']], [0, 0, 0, 0, 0])
+
+    def test_rating_is_created_by_first_vote(self):
+        c = Context({'request': self.rf})
+        key = show_rating(c, self.test_obj1)['rating_key']
+        self.client.login(username='johan', password='johan')
+        self.client.post('/submit/', dict(id=key, vote='80'))
+        tools.assert_equals(Rating.objects.get().total_votes, 1)
+        result = show_rating(c, self.test_obj1)
+        tools.assert_equals(result['total_votes'], 1)
+        tools.assert_equals([(h['stars'], h['votes']) for h in result['histogram'] if h['votes']], [(4, 1)])
+
+
+class TestLoadRatings(TestCase):
+
+    def setUp(self):
+        super(TestLoadRatings, self).setUp()
+        self.user = User.objects.create_user(username='johan', password='johan')
+        self.objects = [User.objects.create_user(username='test_obj%d' % i) for i in range(3)]
+        self.ct = ContentType.objects.get_for_model(User)
+        for obj in self.objects:
+            Rating.objects.get_or_create(target_ct=self.ct, target_id=obj.id)
+        RatingEvent.objects.record_vote(self.ct.id, self.objects[0].id, 80, user=self.user)
+        self.rf = RequestFactory()
+        self.rf.user = self.user
+
+    def test_prefetch_ratings_by_two_queries(self):
+        with self.assertNumQueries(2):
+            prefetched = prefetch_ratings(self.objects, self.rf)
+        tools.assert_equals(len(prefetched), 3)
+
+    def test_show_rating_uses_prefetched_ratings(self):
+        prefetch_ratings(self.objects, self.rf)
+        c = Context({'request': self.rf})
+        with self.assertNumQueries(0):
+            results = [show_rating(c, obj) for obj in self.objects]
+        tools.assert_equals([r['total_votes'] for r in results], [1, 0, 0])
+        tools.assert_equals([r['user_rating'] for r in results], [4, 0, 0])
+
+    def test_load_ratings_tag(self):
+        c = Context({'request': self.rf, 'object_list': self.objects})
+        t = template.Template('{% load rabidratings_tags %}{% load_ratings object_list %}'
+                              '{% for object in object_list %}{% show_rating object "statistics" %}{% endfor %}')
+        with self.assertNumQueries(2):
+            t.render(c)
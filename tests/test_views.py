@@ -1,11 +1,16 @@
 import json
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.auth.models import User
+from django.core.management import call_command
 from django.test import TestCase
+from django.utils.six import StringIO
 
 from nose import tools
 
+from rabidratings import conf
+from rabidratings.buffer import get_vote_buffer
 from rabidratings.models import Rating, RatingEvent
+from rabidratings.throttle import get_vote_throttle
 
 
 class TestRatingsVote(TestCase):
@@ -39,8 +44,8 @@ class TestRatingsVote(TestCase):
         )
         self.client.login(username='johan', password='johan')
         response = self.client.post('/submit/', data)
-        tools.assert_equals(200, response.status_code)
-        tools.assert_equals(500, json.loads(response.content)['code'])
+        tools.assert_equals(400, response.status_code)
+        tools.assert_equals(400, json.loads(response.content)['code'])
         tools.assert_equals(RatingEvent.objects.count(), 0)
         tools.assert_equals(Rating.objects.count(), 1)
 
@@ -50,11 +55,50 @@ class TestRatingsVote(TestCase):
             vote='80'
         )
         response = self.client.post('/submit/', data)
-        tools.assert_equals(200, response.status_code)
-        tools.assert_equals(500, json.loads(response.content)['code'])
+        tools.assert_equals(403, response.status_code)
+        tools.assert_equals(403, json.loads(response.content)['code'])
         tools.assert_equals(RatingEvent.objects.count(), 0)
         tools.assert_equals(Rating.objects.count(), 1)
 
+    def test_record_vote_out_of_range(self):
+        self.client.login(username='johan', password='johan')
+        for vote in ('500', '-20'):
+            response = self.client.post('/submit/', dict(id=self.rating.key, vote=vote))
+            tools.assert_equals(400, response.status_code)
+        tools.assert_equals(RatingEvent.objects.count(), 0)
+
+    def test_record_vote_for_unknown_content_type(self):
+        self.client.login(username='johan', password='johan')
+        response = self.client.post('/submit/', dict(id='999999_1', vote='80'))
+        tools.assert_equals(404, response.status_code)
+
+    def test_record_vote_data_format(self):
+        self.client.login(username='johan', password='johan')
+        response = self.client.post('/submit/', dict(id=self.rating.key, vote='80', format='data'))
+        tools.assert_equals(200, response.status_code)
+        tools.assert_equals(json.loads(response.content), dict(
+            code=200, total_votes=1, avg_rating=4.0, percent=0.8, stars_value=4, verbal_value='fair'))
+
+        response = self.client.post('/submit/', dict(id=self.rating.key, format='data'))
+        tools.assert_equals(400, response.status_code)
+        tools.assert_equals(json.loads(response.content), dict(code=400))
+
+    def test_record_vote_by_anonymous_voter_sets_voter_cookie(self):
+        conf.RABIDRATINGS_DISABLE_ANONYMOUS_USERS = False
+        conf.RABIDRATINGS_VOTER_COOKIE = 'voter'
+        try:
+            response = self.client.post('/submit/', dict(id=self.rating.key, vote='80'))
+            tools.assert_equals(200, json.loads(response.content)['code'])
+            tools.assert_equals(len(response.cookies['voter'].value), 32)
+            # voter with the cookie changes the vote, new voter from the same ip adds one
+            self.client.post('/submit/', dict(id=self.rating.key, vote='60'))
+            self.client.cookies.clear()
+            self.client.post('/submit/', dict(id=self.rating.key, vote='100'))
+        finally:
+            conf.RABIDRATINGS_DISABLE_ANONYMOUS_USERS = True
+            conf.RABIDRATINGS_VOTER_COOKIE = None
+        tools.assert_equals(sorted(RatingEvent.objects.values_list('value', flat=True)), [60, 100])
+
     def test_record_vote_by_user_for_obj_again(self):
         data = dict(
             id=self.rating.key,
@@ -97,3 +141,242 @@ class TestRatingsVote(TestCase):
         tools.assert_equals(RatingEvent.objects.count(), 2)
         tools.assert_equals(Rating.objects.count(), 1)
         tools.assert_equals('3.2', json.loads(response.content)['avg_rating'])
+
+
+class TestRecordVotes(TestCase):
+
+    def setUp(self):
+        super(TestRecordVotes, self).setUp()
+        self.user = User.objects.create_user(username='johan', password='johan')
+        self.objects = [User.objects.create_user(username='test_obj%d' % i) for i in range(3)]
+        self.ct = ContentType.objects.get_for_model(User)
+        self.keys = ['%s_%s' % (self.ct.id, obj.id) for obj in self.objects]
+
+    def test_record_votes(self):
+        self.client.login(username='johan', password='johan')
+        response = self.client.post('/submit-many/', dict(id=self.keys, vote=['80', '60', '100']))
+        tools.assert_equals(200, response.status_code)
+        ratings = json.loads(response.content)['ratings']
+        tools.assert_equals([(ratings[k]['total_votes'], ratings[k]['avg_rating'], ratings[k]['user_rating'])
+                             for k in self.keys], [(1, 4.0, 4), (1, 3.0, 3), (1, 5.0, 5)])
+        tools.assert_equals(RatingEvent.objects.count(), 3)
+
+    def test_invalid_batch_is_not_recorded(self):
+        self.client.login(username='johan', password='johan')
+        response = self.client.post('/submit-many/', dict(id=self.keys, vote=['80', '60']))
+        tools.assert_equals(400, response.status_code)
+        response = self.client.post('/submit-many/', dict(id=self.keys[:2] + ['999999_1'], vote=['80', '60', '20']))
+        tools.assert_equals(400, response.status_code)
+        tools.assert_equals(RatingEvent.objects.count(), 0)
+
+    def test_anonymous_voter_is_refused(self):
+        response = self.client.post('/submit-many/', dict(id=self.keys[:1], vote=['80']))
+        tools.assert_equals(403, response.status_code)
+
+
+class TestBufferedRatingsVote(TestCase):
+
+    def setUp(self):
+        super(TestBufferedRatingsVote, self).setUp()
+        self.old_buffer = conf.RABIDRATINGS_VOTE_BUFFER, conf.RABIDRATINGS_VOTE_BUFFER_CACHE
+        conf.RABIDRATINGS_VOTE_BUFFER = 'rabidratings.buffer.CacheVoteBuffer'
+        conf.RABIDRATINGS_VOTE_BUFFER_CACHE = 'locmem'
+        get_vote_buffer.cache.clear()
+        get_vote_buffer().cache.clear()
+        self.user = User.objects.create_user(username='johan', password='johan')
+        self.test_obj1 = User.objects.create_user(username='test_obj1')
+        ct = ContentType.objects.get_for_model(self.test_obj1.__class__)
+        self.rating = Rating.objects.get_or_create(target_ct=ct, target_id=self.test_obj1.id)[0]
+
+    def tearDown(self):
+        conf.RABIDRATINGS_VOTE_BUFFER, conf.RABIDRATINGS_VOTE_BUFFER_CACHE = self.old_buffer
+        get_vote_buffer.cache.clear()
+        super(TestBufferedRatingsVote, self).tearDown()
+
+    def test_record_vote_is_written_by_flush(self):
+        self.client.login(username='johan', password='johan')
+        for vote in ('40', '80'):
+            response = self.client.post('/submit/', dict(id=self.rating.key, vote=vote))
+            tools.assert_equals(200, json.loads(response.content)['code'])
+        tools.assert_equals(RatingEvent.objects.count(), 0)
+        tools.assert_equals(len(get_vote_buffer()), 2)
+
+        call_command('flush_rating_votes')
+        tools.assert_equals(len(get_vote_buffer()), 0)
+        tools.assert_equals(RatingEvent.objects.get().value, 80)
+        rating = Rating.objects.get(pk=self.rating.pk)
+        tools.assert_equals(rating.total_votes, 1)
+        tools.assert_equals(rating.total_rating, 80)
+
+    def test_failed_votes_are_retried_before_newer_votes(self):
+        self.client.login(username='johan', password='johan')
+        for vote in ('40', '80'):
+            self.client.post('/submit/', dict(id=self.rating.key, vote=vote))
+
+        def fail(votes, batch_size=None):
+            raise ValueError('database is down')
+        RatingEvent.objects.apply_votes = fail
+        try:
+            tools.assert_raises(ValueError, call_command, 'flush_rating_votes', batch_size=1)
+        finally:
+            del RatingEvent.objects.apply_votes
+        tools.assert_equals(len(get_vote_buffer()), 2)
+
+        call_command('flush_rating_votes', batch_size=1)
+        tools.assert_equals(RatingEvent.objects.get().value, 80)
+        tools.assert_equals(Rating.objects.get(pk=self.rating.pk).total_rating, 80)
+
+    def test_vote_failing_repeatedly_is_dropped(self):
+        other = User.objects.create_user(username='joe')
+        get_vote_buffer().push(dict(target_ct_id=self.rating.target_ct_id, target_id=self.test_obj1.id,
+                                    value='invalid', user_id=self.user.id))
+        get_vote_buffer().push(dict(target_ct_id=self.rating.target_ct_id, target_id=self.test_obj1.id,
+                                    value=80, user_id=other.id))
+        stderr = StringIO()
+        tools.assert_raises(TypeError, call_command, 'flush_rating_votes', max_retries=1, stderr=stderr)
+        # valid vote of the batch is written
+        tools.assert_equals(RatingEvent.objects.get().user, other)
+        tools.assert_equals(len(get_vote_buffer()), 1)
+
+        call_command('flush_rating_votes', max_retries=1, stderr=stderr)
+        tools.assert_equals(len(get_vote_buffer()), 0)
+        tools.assert_in('dropped', stderr.getvalue())
+
+    def test_record_vote_by_anonymous_user_is_not_buffered(self):
+        response = self.client.post('/submit/', dict(id=self.rating.key, vote='80'))
+        tools.assert_equals(403, response.status_code)
+        tools.assert_equals(len(get_vote_buffer()), 0)
+
+
+class TestVoterRatings(TestCase):
+
+    def setUp(self):
+        super(TestVoterRatings, self).setUp()
+        self.user = User.objects.create_user(username='johan', password='johan')
+        self.objects = [User.objects.create_user(username='test_obj%d' % i) for i in range(2)]
+        self.ct = ContentType.objects.get_for_model(User)
+        self.keys = ['%s_%s' % (self.ct.id, obj.id) for obj in self.objects]
+        RatingEvent.objects.record_vote(self.ct.id, self.objects[0].id, 80, user=self.user)
+
+    def test_votes_of_user(self):
+        self.client.login(username='johan', password='johan')
+        response = self.client.get('/votes/', {'ids': ','.join(self.keys + ['invalid'])})
+        data = json.loads(response.content)
+        tools.assert_true(data['can_vote'])
+        tools.assert_equals(sorted(data['ratings']), sorted(self.keys))
+        tools.assert_equals([data['ratings'][k]['user_rating'] for k in self.keys], [4, 0])
+        tools.assert_in('no-cache', response['Cache-Control'])
+        tools.assert_in('csrftoken', response.cookies)
+
+    def test_anonymous_can_not_vote(self):
+        response = self.client.get('/votes/', {'ids': ','.join(self.keys)})
+        data = json.loads(response.content)
+        tools.assert_false(data['can_vote'])
+        tools.assert_equals([data['ratings'][k]['user_rating'] for k in self.keys], [0, 0])
+
+
+class TestRatings(TestCase):
+
+    def setUp(self):
+        super(TestRatings, self).setUp()
+        self.user = User.objects.create_user(username='johan', password='johan')
+        self.objects = [User.objects.create_user(username='test_obj%d' % i) for i in range(2)]
+        self.ct = ContentType.objects.get_for_model(User)
+        self.keys = ['%s_%s' % (self.ct.id, obj.id) for obj in self.objects]
+        RatingEvent.objects.record_vote(self.ct.id, self.objects[0].id, 80, user=self.user)
+
+    def test_ratings_by_single_query(self):
+        with self.assertNumQueries(1):
+            response = self.client.get('/ratings/', {'keys': ','.join(self.keys)})
+        ratings = json.loads(response.content)['ratings']
+        tools.assert_equals([ratings[k]['total_votes'] for k in self.keys], [1, 0])
+        tools.assert_equals(ratings[self.keys[0]]['avg_rating'], 4.0)
+        tools.assert_equals(ratings[self.keys[0]]['histogram'], [0, 0, 0, 1, 0])
+        tools.assert_not_in('user_rating', ratings[self.keys[0]])
+        tools.assert_in('public', response['Cache-Control'])
+
+    def test_ratings_with_votes_of_user(self):
+        self.client.login(username='johan', password='johan')
+        response = self.client.get('/ratings/', {'keys': ','.join(self.keys), 'votes': '1'})
+        ratings = json.loads(response.content)['ratings']
+        tools.assert_equals([ratings[k]['user_rating'] for k in self.keys], [4, 0])
+        tools.assert_in('private', response['Cache-Control'])
+        tools.assert_in('Cookie', response['Vary'])
+
+    def test_conditional_request(self):
+        response = self.client.get('/ratings/', {'keys': ','.join(self.keys)})
+        etag = response['ETag']
+        response = self.client.get('/ratings/', {'keys': ','.join(self.keys)}, HTTP_IF_NONE_MATCH=etag)
+        tools.assert_equals(response.status_code, 304)
+        response = self.client.get('/ratings/', {'keys': ','.join(self.keys)},
+                                   HTTP_IF_MODIFIED_SINCE=response['Last-Modified'])
+        tools.assert_equals(response.status_code, 304)
+
+        RatingEvent.objects.record_vote(self.ct.id, self.objects[1].id, 60, user=self.user)
+        response = self.client.get('/ratings/', {'keys': ','.join(self.keys)}, HTTP_IF_NONE_MATCH=etag)
+        tools.assert_equals(response.status_code, 200)
+        tools.assert_not_equals(response['ETag'], etag)
+
+
+class TestThrottledRatingsVote(TestCase):
+
+    def setUp(self):
+        super(TestThrottledRatingsVote, self).setUp()
+        self.old_settings = conf.RABIDRATINGS_THROTTLE_CACHE, conf.RABIDRATINGS_VOTER_RATE
+        conf.RABIDRATINGS_THROTTLE_CACHE = 'locmem'
+        conf.RABIDRATINGS_VOTER_RATE = (2, 60)
+        get_vote_throttle.cache.clear()
+        get_vote_throttle().cache.clear()
+        self.user = User.objects.create_user(username='johan', password='johan')
+        self.objects = [User.objects.create_user(username='test_obj%d' % i) for i in range(3)]
+        self.ct = ContentType.objects.get_for_model(User)
+        self.keys = ['%s_%s' % (self.ct.id, obj.id) for obj in self.objects]
+        self.client.login(username='johan', password='johan')
+
+    def tearDown(self):
+        conf.RABIDRATINGS_THROTTLE_CACHE, conf.RABIDRATINGS_VOTER_RATE = self.old_settings
+        get_vote_throttle.cache.clear()
+        super(TestThrottledRatingsVote, self).tearDown()
+
+    def test_too_many_votes_are_refused(self):
+        for key in self.keys[:2]:
+            response = self.client.post('/submit/', dict(id=key, vote='80'))
+            tools.assert_equals(200, response.status_code)
+        response = self.client.post('/submit/', dict(id=self.keys[2], vote='80'))
+        tools.assert_equals(429, response.status_code)
+        tools.assert_equals(json.loads(response.content), dict(code=429))
+        tools.assert_equals(RatingEvent.objects.count(), 2)
+
+    def test_repeated_vote_is_answered_from_cache(self):
+        first = self.client.post('/submit/', dict(id=self.keys[0], vote='80'))
+        for i in range(3):
+            # only session and user are loaded
+            with self.assertNumQueries(2):
+                response = self.client.post('/submit/', dict(id=self.keys[0], vote='80'))
+            tools.assert_equals(json.loads(response.content), json.loads(first.content))
+        # changed vote is not a duplicate
+        response = self.client.post('/submit/', dict(id=self.keys[0], vote='60'))
+        tools.assert_equals(RatingEvent.objects.get().value, 60)
+
+    def test_vote_changed_back_is_recorded(self):
+        conf.RABIDRATINGS_VOTER_RATE = (10, 60)
+        get_vote_throttle.cache.clear()
+        for vote in ('80', '60', '80'):
+            response = self.client.post('/submit/', dict(id=self.keys[0], vote=vote, format='data'))
+            tools.assert_equals(RatingEvent.objects.get().value, int(vote))
+        tools.assert_equals(json.loads(response.content)['avg_rating'], 4.0)
+        self.client.post('/submit-many/', dict(id=self.keys[0], vote='60'))
+        response = self.client.post('/submit/', dict(id=self.keys[0], vote='80', format='data'))
+        tools.assert_equals(RatingEvent.objects.get().value, 80)
+
+    def test_batch_takes_token_for_every_object(self):
+        conf.RABIDRATINGS_TARGET_RATE = (1, 60)
+        get_vote_throttle.cache.clear()
+        try:
+            response = self.client.post('/submit-many/', dict(id=self.keys[:2], vote=['80', '60']))
+            tools.assert_equals(200, response.status_code)
+            response = self.client.post('/submit-many/', dict(id=self.keys[1:], vote=['80', '60']))
+            tools.assert_equals(429, response.status_code)
+        finally:
+            conf.RABIDRATINGS_TARGET_RATE = (100, 10)
+            get_vote_throttle.cache.clear()